@@ -1,17 +1,51 @@
 import os
+import csv
+import json
+import click
+import smtplib
+import multiprocessing
+import re
+import math
+import base64
 import webbrowser
 import threading
 import time
 import uuid
+import hashlib
+import bisect
+import random
+import unicodedata
+from array import array
+from io import BytesIO, TextIOWrapper
+from collections import Counter, OrderedDict, defaultdict
+from itertools import chain
 from datetime import datetime, timezone, timedelta
-from flask import Flask, render_template, request, redirect, url_for, flash, session, jsonify
+from flask import Flask, render_template, request, redirect, url_for, flash, session, jsonify, send_from_directory, stream_with_context
 from flask_sqlalchemy import SQLAlchemy
-from flask_mail import Mail
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from sqlalchemy import event
+from sqlalchemy.dialects.postgresql import insert as insert_postgresql
+from sqlalchemy.dialects.sqlite import insert as insert_sqlite
+from sqlalchemy.exc import IntegrityError, OperationalError
+from sqlalchemy.orm import joinedload
+from flask_mail import Mail, Message
 from werkzeug.security import generate_password_hash, check_password_hash
 from werkzeug.utils import secure_filename
 from itsdangerous import URLSafeTimedSerializer
 from dotenv import load_dotenv
 from functools import wraps
+from flask.json.provider import DefaultJSONProvider
+
+try:
+    from PIL import Image, ImageOps, features as pil_features
+except ImportError:  # Pillow es opcional: sin él las fotos de perfil se guardan tal cual se suben
+    Image = None
+
+try:
+    import orjson
+except ImportError:  # opcional: sin él jsonify usa el codificador de la biblioteca estándar
+    orjson = None
 
 # ————— CONFIGURACIÓN INICIAL —————
 load_dotenv()
@@ -25,13 +59,55 @@ os.makedirs(static_fotos_dir, exist_ok=True)
 
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif'}
 MAX_FILE_SIZE = 2 * 1024 * 1024  # 2 MB
+# Variantes de las fotos de perfil: lado en píxeles y si se recorta a cuadrado (≈2x el tamaño mostrado)
+FOTO_VARIANTES = {'avatar': (96, True), 'tarjeta': (240, True), 'completa': (800, False)}
+FOTO_MAX_PIXELES = 40_000_000
+FOTO_CACHE_SEGUNDOS = 365 * 24 * 3600  # los nombres de foto nunca se reutilizan para otro contenido
+ACTIVIDADES_POR_PAGINA = 5
+DEGUSTACIONES_POR_PAGINA = 20
+ACTIVIDADES_MAX_POR_PAGINA = 50
+COMENTARIOS_POR_ACTIVIDAD = 3
+DEGUSTACIONES_LOTE_MAX = 200
+LOCALES_POR_PAGINA = 50
+LOCALES_MAX_POR_PAGINA = 200
+LOCALES_RADIO_KM = 5
+LOCALES_RADIO_MAX_KM = 100
+
+def url_base_datos(url):
+    """URL de SQLAlchemy a partir de DATABASE_URL; sin ella, el SQLite de instance/"""
+    if not url:
+        return f'sqlite:///{os.path.join(instance_dir, "beersp.db")}'
+    # Render y Heroku exportan postgres://, que SQLAlchemy ya no acepta
+    if url.startswith('postgres://'):
+        url = 'postgresql://' + url[len('postgres://'):]
+    return url
+
+def opciones_motor(url):
+    """Pool de conexiones: una por hilo del servidor WSGI más margen para picos"""
+    if url in ('sqlite://', 'sqlite:///:memory:'):
+        return {}  # SQLite en memoria usa una única conexión por hilo, sin pool configurable
+    return {
+        'pool_size': int(os.getenv('DB_POOL_SIZE', 8)),
+        'max_overflow': int(os.getenv('DB_MAX_OVERFLOW', 16)),
+        'pool_timeout': int(os.getenv('DB_POOL_TIMEOUT', 30)),
+        # Cierra conexiones más viejas que esto (los servidores cortan las inactivas) y las comprueba al cogerlas
+        'pool_recycle': int(os.getenv('DB_POOL_RECYCLE', 1800)),
+        'pool_pre_ping': os.getenv('DB_POOL_PRE_PING', 'true').lower() == 'true',
+    }
 
 # ————— APP FLASK —————
 app = Flask(__name__)
 app.config['SECRET_KEY'] = os.getenv('SECRET_KEY') or 'una_clave_secreta_muy_segura_2025'
-app.config['SQLALCHEMY_DATABASE_URI'] = f'sqlite:///{os.path.join(instance_dir, "beersp.db")}'
+app.config['SQLALCHEMY_DATABASE_URI'] = url_base_datos(os.getenv('DATABASE_URL'))
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 
+# Perfil de SQLite para producción: WAL deja leer mientras se escribe y synchronous=NORMAL evita
+# un fsync por commit (en WAL sólo se sincroniza en los checkpoints). Se aplica a cada conexión.
+app.config['SQLITE_PERFIL_PRODUCCION'] = os.getenv('SQLITE_PERFIL_PRODUCCION', 'true').lower() == 'true'
+app.config['SQLITE_BUSY_TIMEOUT_MS'] = int(os.getenv('SQLITE_BUSY_TIMEOUT_MS', 5000))
+app.config['SQLITE_CACHE_KB'] = int(os.getenv('SQLITE_CACHE_KB', 20000))
+app.config['SQLITE_MMAP_MB'] = int(os.getenv('SQLITE_MMAP_MB', 128))
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = opciones_motor(app.config['SQLALCHEMY_DATABASE_URI'])
 
 app.config['MAIL_SERVER'] = os.getenv('MAIL_SERVER')
 app.config['MAIL_PORT'] = int(os.getenv('MAIL_PORT', 587))
@@ -40,6 +116,48 @@ app.config['MAIL_USERNAME'] = os.getenv('MAIL_USERNAME')
 app.config['MAIL_PASSWORD'] = os.getenv('MAIL_PASSWORD')
 app.config['MAIL_DEFAULT_SENDER'] = ("BeerSp 🍻", os.getenv('MAIL_USERNAME'))
 
+# Hash de contraseñas: método de werkzeug (su factor de trabajo) y pool de procesos que lo calcula.
+# HASH_PROCESOS=0 calcula en el propio hilo de la petición.
+app.config['HASH_METODO'] = os.getenv('HASH_METODO', 'scrypt:32768:8:1')
+app.config['HASH_PROCESOS'] = int(os.getenv('HASH_PROCESOS', min(4, os.cpu_count() or 1)))
+app.config['HASH_COLA_MAX'] = int(os.getenv('HASH_COLA_MAX', 32))
+app.config['HASH_ESPERA_SEGUNDOS'] = float(os.getenv('HASH_ESPERA_SEGUNDOS', 5))
+
+# Formato de las variantes de foto: webp (si Pillow lo soporta) o jpeg
+app.config['FOTO_FORMATO'] = os.getenv('FOTO_FORMATO', 'webp').lower()
+app.config['FOTO_CALIDAD'] = int(os.getenv('FOTO_CALIDAD', 80))
+
+# Cola de correo saliente: las rutas solo encolan y un hilo en segundo plano envía con reintentos
+app.config['CORREO_HILO_ENVIO'] = os.getenv('CORREO_HILO_ENVIO', 'true').lower() == 'true'
+app.config['CORREO_INTERVALO_SEGUNDOS'] = float(os.getenv('CORREO_INTERVALO_SEGUNDOS', 10))
+app.config['CORREO_LOTE'] = int(os.getenv('CORREO_LOTE', 50))
+app.config['CORREO_MAX_INTENTOS'] = int(os.getenv('CORREO_MAX_INTENTOS', 6))
+app.config['CORREO_REINTENTO_BASE_SEGUNDOS'] = int(os.getenv('CORREO_REINTENTO_BASE_SEGUNDOS', 30))
+
+# Borrado de cuentas: la cuenta se oculta al momento y un hilo borra sus datos en lotes con commit
+app.config['BORRADO_HILO'] = os.getenv('BORRADO_HILO', 'true').lower() == 'true'
+app.config['BORRADO_LOTE'] = int(os.getenv('BORRADO_LOTE', 500))
+app.config['BORRADO_INTERVALO_SEGUNDOS'] = float(os.getenv('BORRADO_INTERVALO_SEGUNDOS', 30))
+
+# Timeline materializado de amigos (fan-out en escritura), desactivado por defecto.
+# Al hacerse amigos se copian como mucho TIMELINE_BACKFILL degustaciones anteriores de cada uno
+# (0 = todo el historial); la reconstrucción aplica el mismo tope.
+app.config['TIMELINE_ENABLED'] = os.getenv('TIMELINE_ENABLED', 'false').lower() == 'true'
+app.config['TIMELINE_BACKFILL'] = int(os.getenv('TIMELINE_BACKFILL', 200))
+
+# Búsqueda de cervezas y usuarios con SQLite FTS5 (se desactiva sola si el motor no la soporta)
+app.config['BUSQUEDA_FTS'] = os.getenv('BUSQUEDA_FTS', 'true').lower() == 'true'
+
+# Sugerencias aleatorias del buscador vacío: ponderadas por nº de valoraciones y refresco de pesos
+app.config['SUGERENCIAS_POR_POPULARIDAD'] = os.getenv('SUGERENCIAS_POR_POPULARIDAD', 'true').lower() == 'true'
+app.config['SUGERENCIAS_REFRESCO_SEGUNDOS'] = int(os.getenv('SUGERENCIAS_REFRESCO_SEGUNDOS', 600))
+
+# Administradores (correos separados por comas): importación masiva del catálogo y exportación completa
+app.config['ADMINISTRADORES'] = {c.strip().lower() for c in os.getenv('ADMINISTRADORES', '').split(',') if c.strip()}
+
+# Caché en memoria del ranking de /top_degustaciones (una entrada por filtro estilo/país)
+app.config['TOP_CACHE_MAX_ENTRADAS'] = int(os.getenv('TOP_CACHE_MAX_ENTRADAS', 64))
+
 from flask.sessions import SecureCookieSessionInterface
 class CustomSessionInterface(SecureCookieSessionInterface):
     def get_cookie_secure(self, app):
@@ -49,6 +167,54 @@ class CustomSessionInterface(SecureCookieSessionInterface):
 app.session_interface = CustomSessionInterface()
 
 db = SQLAlchemy(app)
+
+# ————— PERFIL SQLITE —————
+def sqlite_pragmas(config=None):
+    """Pragmas del perfil de producción, en el orden en que deben aplicarse"""
+    config = config or app.config
+    return {
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',
+        'busy_timeout': config['SQLITE_BUSY_TIMEOUT_MS'],
+        'cache_size': -config['SQLITE_CACHE_KB'],  # negativo = KiB en lugar de páginas
+        'mmap_size': config['SQLITE_MMAP_MB'] * 1024 * 1024,
+        'temp_store': 'MEMORY',
+        'foreign_keys': 'ON',
+    }
+
+def aplicar_pragmas(conexion_dbapi, pragmas):
+    cursor = conexion_dbapi.cursor()
+    for nombre, valor in pragmas.items():
+        cursor.execute(f'PRAGMA {nombre}={valor}')
+    cursor.close()
+
+# Valor que devuelve SQLite al leer cada pragma (journal_mode en minúsculas, los demás numéricos)
+_PRAGMAS_LEIDOS = {'journal_mode': lambda v: str(v).lower(), 'synchronous': {'OFF': 0, 'NORMAL': 1, 'FULL': 2}.get,
+                   'temp_store': {'DEFAULT': 0, 'FILE': 1, 'MEMORY': 2}.get, 'foreign_keys': {'OFF': 0, 'ON': 1}.get}
+
+def pragmas_incorrectos():
+    """Compara los pragmas de una conexión del pool con el perfil; devuelve {nombre: (esperado, actual)}"""
+    if db.engine.dialect.name != 'sqlite' or not app.config['SQLITE_PERFIL_PRODUCCION']:
+        return {}
+    incorrectos = {}
+    with db.engine.connect() as conexion:
+        for nombre, valor in sqlite_pragmas().items():
+            actual = conexion.exec_driver_sql(f'PRAGMA {nombre}').scalar()
+            esperado = _PRAGMAS_LEIDOS.get(nombre, int)(valor)
+            # Las bases en memoria no admiten WAL y el mmap puede estar limitado por la compilación
+            if (nombre, actual) in (('journal_mode', 'memory'), ('mmap_size', 0)):
+                continue
+            if actual != esperado:
+                incorrectos[nombre] = (esperado, actual)
+    return incorrectos
+
+def _conexion_sqlite(conexion_dbapi, registro):
+    if app.config['SQLITE_PERFIL_PRODUCCION']:
+        aplicar_pragmas(conexion_dbapi, sqlite_pragmas())
+
+with app.app_context():
+    if db.engine.dialect.name == 'sqlite':
+        event.listen(db.engine, 'connect', _conexion_sqlite)
 mail = Mail(app)
 serializer = URLSafeTimedSerializer(app.config['SECRET_KEY'])
 
@@ -57,7 +223,7 @@ class Usuario(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     nombre_usuario = db.Column(db.String(80), unique=True, nullable=False)
     correo = db.Column(db.String(120), unique=True, nullable=False)
-    contraseña_hash = db.Column(db.String(128), nullable=False)
+    contraseña_hash = db.Column(db.String(255), nullable=False)
     fecha_nacimiento = db.Column(db.Date, nullable=False)
     fecha_registro = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc))
     verificado = db.Column(db.Boolean, default=False)
@@ -67,6 +233,10 @@ class Usuario(db.Model):
     genero = db.Column(db.String(20))
     presentacion = db.Column(db.Text)
     foto = db.Column(db.String(200))
+    # Cuenta marcada para borrar: se oculta en el acto y BorradorCuentas borra sus datos por fases
+    eliminado_en = db.Column(db.DateTime)
+    # Búsqueda exacta por correo sin distinguir mayúsculas
+    __table_args__ = (db.Index('ix_usuario_correo_minusculas', db.func.lower(correo)),)
 
 class Amistad(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -74,7 +244,16 @@ class Amistad(db.Model):
     amigo_id = db.Column(db.Integer, db.ForeignKey('usuario.id'), nullable=False)
     estado = db.Column(db.String(20), default='pendiente')
     fecha_solicitud = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc))
-    __table_args__ = (db.UniqueConstraint('usuario_id', 'amigo_id', name='_amistad_uc'),)
+    __table_args__ = (
+        db.UniqueConstraint('usuario_id', 'amigo_id', name='_amistad_uc'),
+        db.Index('ix_amistad_amigo_estado', 'amigo_id', 'estado'),
+    )
+
+class AmistadArista(db.Model):
+    """Arista dirigida de una amistad aceptada: dos filas por amistad (A→B y B→A)"""
+    usuario_id = db.Column(db.Integer, db.ForeignKey('usuario.id'), primary_key=True)
+    amigo_id = db.Column(db.Integer, db.ForeignKey('usuario.id'), primary_key=True)
+    fecha = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc))
 
 class Favorita(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -83,6 +262,7 @@ class Favorita(db.Model):
     fecha_agregada = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc))
     usuario = db.relationship('Usuario', backref=db.backref('favoritas', lazy=True, cascade="all, delete-orphan"))
     cerveza = db.relationship('Cerveza', backref='favoritos')
+    __table_args__ = (db.Index('ix_favorita_usuario_cerveza', 'usuario_id', 'cerveza_id'),)
 
 class Cerveza(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -92,6 +272,29 @@ class Cerveza(db.Model):
     porcentaje_alcohol = db.Column(db.Float, nullable=False)
     ibu = db.Column(db.Integer)  # International Bitterness Units
     color = db.Column(db.String(50))
+    # normalizar_texto(nombre): clave para detectar duplicados que solo cambian en mayúsculas o tildes
+    nombre_normalizado = db.Column(db.String(100))
+    __table_args__ = (db.Index('ix_cerveza_nombre_normalizado', 'nombre_normalizado', unique=True),)
+
+class CervezaStats(db.Model):
+    """Agregados de valoraciones por cerveza, mantenidos en cada escritura de Degustacion"""
+    cerveza_id = db.Column(db.Integer, db.ForeignKey('cerveza.id'), primary_key=True)
+    suma_puntuacion = db.Column(db.Float, nullable=False, default=0)
+    num_valoraciones = db.Column(db.Integer, nullable=False, default=0)
+    promedio = db.Column(db.Float)
+    primera_valoracion = db.Column(db.DateTime)
+    ultima_valoracion = db.Column(db.DateTime)
+    # Histograma por estrellas enteras (1-5)
+    estrellas_1 = db.Column(db.Integer, nullable=False, default=0)
+    estrellas_2 = db.Column(db.Integer, nullable=False, default=0)
+    estrellas_3 = db.Column(db.Integer, nullable=False, default=0)
+    estrellas_4 = db.Column(db.Integer, nullable=False, default=0)
+    estrellas_5 = db.Column(db.Integer, nullable=False, default=0)
+    __table_args__ = (db.Index('ix_cerveza_stats_ranking', 'promedio', 'num_valoraciones'),)
+
+    @property
+    def histograma(self):
+        return [self.estrellas_1, self.estrellas_2, self.estrellas_3, self.estrellas_4, self.estrellas_5]
 
 class Local(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -101,8 +304,14 @@ class Local(db.Model):
     pais = db.Column(db.String(50))
     latitud = db.Column(db.Float)
     longitud = db.Column(db.Float)
+    # Geohash de (latitud, longitud): las búsquedas geográficas son rangos de prefijo sobre su índice
+    geohash = db.Column(db.String(12))
     me_gusta_count = db.Column(db.Integer, default=0)
     fecha_creacion = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc))
+    __table_args__ = (
+        db.Index('ix_local_geohash', 'geohash'),
+        db.Index('ix_local_nombre_id', 'nombre', 'id'),
+    )
 
 class Degustacion(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -115,8 +324,16 @@ class Degustacion(db.Model):
     tamaño = db.Column(db.String(20))
     formato = db.Column(db.String(20))
     pais_consumicion = db.Column(db.String(50))
+    # Clave que genera el cliente al registrar sin conexión: reenviar un lote no duplica degustaciones
+    clave_idempotencia = db.Column(db.String(64))
     
     usuario = db.relationship('Usuario', backref=db.backref('degustaciones', lazy=True))
+    __table_args__ = (
+        db.Index('ix_degustacion_usuario_fecha', 'usuario_id', 'fecha'),
+        db.Index('ix_degustacion_usuario_clave', 'usuario_id', 'clave_idempotencia', unique=True),
+        db.Index('ix_degustacion_cerveza_puntuacion', 'cerveza_id', 'puntuacion'),
+        db.Index('ix_degustacion_cerveza_fecha', 'cerveza_id', 'fecha'),
+    )
     cerveza = db.relationship('Cerveza', backref=db.backref('degustaciones', lazy=True))
     local = db.relationship('Local', backref=db.backref('degustaciones', lazy=True))
 
@@ -133,6 +350,18 @@ class UsuarioGalardon(db.Model):
     fecha_obtenido = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc))
     __table_args__ = (db.UniqueConstraint('usuario_id', 'galardon_id', name='_usuario_galardon_uc'),)
 
+class ProgresoGalardon(db.Model):
+    """Contador por usuario de cada métrica de los galardones (degustaciones, estilos, amigos...)"""
+    usuario_id = db.Column(db.Integer, db.ForeignKey('usuario.id'), primary_key=True)
+    metrica = db.Column(db.String(30), primary_key=True)
+    valor = db.Column(db.Integer, nullable=False, default=0)
+
+class ProgresoDistinto(db.Model):
+    """Valores ya contados de las métricas de distintos (un estilo o un país por fila)"""
+    usuario_id = db.Column(db.Integer, db.ForeignKey('usuario.id'), primary_key=True)
+    metrica = db.Column(db.String(30), primary_key=True)
+    valor = db.Column(db.String(100), primary_key=True)
+
 class ComentarioDegustacion(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     degustacion_id = db.Column(db.Integer, db.ForeignKey('degustacion.id'), nullable=False)
@@ -142,6 +371,69 @@ class ComentarioDegustacion(db.Model):
     
     degustacion = db.relationship('Degustacion', backref=db.backref('comentarios', lazy=True, cascade="all, delete-orphan"))
     usuario = db.relationship('Usuario', backref=db.backref('comentarios_degustaciones', lazy=True))
+    __table_args__ = (
+        db.Index('ix_comentario_degustacion_fecha', 'degustacion_id', 'fecha'),
+        db.Index('ix_comentario_usuario', 'usuario_id'),
+    )
+
+class MigracionAplicada(db.Model):
+    """Registro de las migraciones de esquema ya aplicadas a esta base de datos"""
+    version = db.Column(db.Integer, primary_key=True)
+    descripcion = db.Column(db.String(200), nullable=False)
+    fecha_aplicada = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc))
+
+class UltimaActividad(db.Model):
+    """Última degustación de cada usuario, desnormalizada para los paneles de amigos"""
+    usuario_id = db.Column(db.Integer, db.ForeignKey('usuario.id'), primary_key=True)
+    degustacion_id = db.Column(db.Integer, db.ForeignKey('degustacion.id'), nullable=False)
+    cerveza_nombre = db.Column(db.String(100), nullable=False)
+    cerveza_estilo = db.Column(db.String(50), nullable=False)
+    puntuacion = db.Column(db.Float)
+    comentario = db.Column(db.Text)
+    fecha = db.Column(db.DateTime, nullable=False, index=True)
+
+class TimelineEntrada(db.Model):
+    """Bandeja de entrada del feed: una fila por degustación de amigo visible para un usuario"""
+    id = db.Column(db.Integer, primary_key=True)
+    usuario_id = db.Column(db.Integer, db.ForeignKey('usuario.id'), nullable=False)
+    degustacion_id = db.Column(db.Integer, db.ForeignKey('degustacion.id'), nullable=False)
+    autor_id = db.Column(db.Integer, db.ForeignKey('usuario.id'), nullable=False)
+    fecha = db.Column(db.DateTime, nullable=False)
+    __table_args__ = (
+        db.UniqueConstraint('usuario_id', 'degustacion_id', name='_timeline_uc'),
+        db.Index('ix_timeline_usuario_fecha', 'usuario_id', 'fecha', 'degustacion_id'),
+        db.Index('ix_timeline_autor', 'autor_id', 'usuario_id'),
+    )
+
+class CorreoPendiente(db.Model):
+    """Bandeja de salida: cada correo se guarda aquí y lo envía EnviadorCorreo"""
+    id = db.Column(db.Integer, primary_key=True)
+    destinatario = db.Column(db.String(120), nullable=False)
+    asunto = db.Column(db.String(200), nullable=False)
+    cuerpo = db.Column(db.Text, nullable=False)
+    estado = db.Column(db.String(20), nullable=False, default='pendiente')  # pendiente, enviando, enviado, fallido
+    intentos = db.Column(db.Integer, nullable=False, default=0)
+    # Cuándo puede (re)intentarse; mientras está 'enviando' marca el fin de la reserva del enviador
+    proximo_intento = db.Column(db.DateTime, nullable=False, default=lambda: datetime.now(timezone.utc))
+    ultimo_error = db.Column(db.String(500))
+    fecha_creacion = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc))
+    fecha_envio = db.Column(db.DateTime)
+    __table_args__ = (db.Index('ix_correo_estado_proximo', 'estado', 'proximo_intento'),)
+
+class BorradoCuenta(db.Model):
+    """Trabajo de borrado de una cuenta eliminada: fase en curso y filas borradas, para reanudarlo"""
+    id = db.Column(db.Integer, primary_key=True)
+    # Sin ForeignKey: la fila del usuario es lo último que se borra y el trabajo queda como registro
+    usuario_id = db.Column(db.Integer, nullable=False, unique=True)
+    estado = db.Column(db.String(20), nullable=False, default='pendiente')  # pendiente, borrando, terminado
+    fase = db.Column(db.String(30), nullable=False)
+    filas_borradas = db.Column(db.Integer, nullable=False, default=0)
+    # Mientras está 'borrando', fin de la reserva del proceso que lo ejecuta; si muere, otro lo retoma
+    reservado_hasta = db.Column(db.DateTime)
+    ultimo_error = db.Column(db.String(500))
+    fecha_creacion = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc))
+    fecha_fin = db.Column(db.DateTime)
+    __table_args__ = (db.Index('ix_borrado_estado_reserva', 'estado', 'reservado_hasta'),)
 
 # ————— DECORADOR PARA SESIÓN —————
 def requiere_sesion(f):
@@ -175,6 +467,14 @@ def requiere_sesion(f):
             flash("Debes iniciar sesión.", "error")
             return redirect(url_for('login'))
         
+        # Una cuenta marcada para borrar deja de valer en todas sus sesiones
+        usuario_id = session.get('user_id_temp') or session.get('user_id')
+        usuario = db.session.get(Usuario, usuario_id) if usuario_id else None
+        if usuario and usuario.eliminado_en:
+            session.clear()
+            flash("Esta cuenta ha sido eliminada.", "error")
+            return redirect(url_for('login'))
+        
         return f(*args, **kwargs)
     return decorated_function
 
@@ -184,9 +484,355 @@ def es_mayor_edad(fecha_nac):
     edad = hoy.year - fecha_nac.year - ((hoy.month, hoy.day) < (fecha_nac.month, fecha_nac.day))
     return edad >= 18
 
+def sin_zona(fecha):
+    """Quita la zona horaria (UTC) para comparar fechas recién creadas con las leídas de SQLite"""
+    return fecha.replace(tzinfo=None) if fecha and fecha.tzinfo else fecha
+
+def es_administrador(usuario_id):
+    """True si el correo del usuario está en ADMINISTRADORES"""
+    usuario = db.session.get(Usuario, usuario_id) if usuario_id else None
+    return bool(usuario and usuario.correo.lower() in app.config['ADMINISTRADORES'])
+
+def leer_puntuacion(valor):
+    """Puntuación recibida en una petición: vacío o 0 es "sin puntuar" (None). ValueError si no es un número."""
+    if valor in (None, ''):
+        return None
+    return float(valor) or None
+
+def usuario_visible(usuario_id):
+    """El usuario, si existe y no ha eliminado su cuenta (aunque aún se estén borrando sus datos)"""
+    usuario = db.session.get(Usuario, usuario_id) if usuario_id else None
+    return usuario if usuario and not usuario.eliminado_en else None
+
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
+def insert_dialecto(modelo):
+    """INSERT del motor en uso, con on_conflict_do_nothing()/on_conflict_do_update() (SQLite y PostgreSQL)"""
+    return (insert_postgresql if db.engine.dialect.name == 'postgresql' else insert_sqlite)(modelo)
+
+def codificar_cursor_clave(clave, fila_id):
+    """Cursor opaco (clave, id) para paginar por keyset; la clave es texto y puede contener '|'."""
+    crudo = f"{clave}|{fila_id}"
+    return base64.urlsafe_b64encode(crudo.encode()).decode().rstrip('=')
+
+def decodificar_cursor_clave(cursor):
+    """Devuelve (clave, id) a partir de un cursor o None si no es válido."""
+    try:
+        relleno = '=' * (-len(cursor) % 4)
+        crudo = base64.urlsafe_b64decode(cursor + relleno).decode()
+        clave, id_str = crudo.rsplit('|', 1)
+        return clave, int(id_str)
+    except (ValueError, UnicodeDecodeError):
+        return None
+
+def codificar_cursor(fecha, degustacion_id):
+    """Cursor opaco (fecha, id) para paginar feeds ordenados por fecha desc."""
+    return codificar_cursor_clave(fecha.isoformat(), degustacion_id)
+
+def decodificar_cursor(cursor):
+    """Devuelve (fecha, id) a partir de un cursor o None si no es válido."""
+    posicion = decodificar_cursor_clave(cursor)
+    if not posicion:
+        return None
+    try:
+        return datetime.fromisoformat(posicion[0]), posicion[1]
+    except ValueError:
+        return None
+
+def comentarios_recientes(degustaciones_ids, limite=COMENTARIOS_POR_ACTIVIDAD):
+    """Últimos `limite` comentarios de cada degustación en una sola consulta."""
+    if not degustaciones_ids:
+        return {}
+    orden = db.func.row_number().over(
+        partition_by=ComentarioDegustacion.degustacion_id,
+        order_by=(ComentarioDegustacion.fecha.desc(), ComentarioDegustacion.id.desc())
+    ).label('orden')
+    subconsulta = db.session.query(ComentarioDegustacion.id, orden).filter(
+        ComentarioDegustacion.degustacion_id.in_(degustaciones_ids)
+    ).subquery()
+    filas = db.session.query(ComentarioDegustacion, Usuario).join(
+        subconsulta, subconsulta.c.id == ComentarioDegustacion.id
+    ).join(
+        Usuario, ComentarioDegustacion.usuario_id == Usuario.id
+    ).filter(
+        subconsulta.c.orden <= limite,
+        Usuario.eliminado_en.is_(None)
+    ).order_by(ComentarioDegustacion.fecha.desc(), ComentarioDegustacion.id.desc()).all()
+
+    por_degustacion = {deg_id: [] for deg_id in degustaciones_ids}
+    for comentario, usuario_comentario in filas:
+        por_degustacion[comentario.degustacion_id].append((comentario, usuario_comentario))
+    return por_degustacion
+
+def amigos_ids_de(usuario_id):
+    """IDs de los amigos (amistad aceptada) de un usuario: un rango sobre la PK de AmistadArista"""
+    return [r[0] for r in db.session.query(AmistadArista.amigo_id).filter_by(usuario_id=usuario_id)]
+
+def son_amigos(usuario_a, usuario_b):
+    """True si existe la arista A→B, es decir, si la amistad está aceptada"""
+    return db.session.get(AmistadArista, (usuario_a, usuario_b)) is not None
+
+def amistad_entre(usuario_a, usuario_b):
+    """Solicitud de amistad entre dos usuarios en cualquier sentido (dos búsquedas por índice único)"""
+    return (Amistad.query.filter_by(usuario_id=usuario_a, amigo_id=usuario_b).first()
+            or Amistad.query.filter_by(usuario_id=usuario_b, amigo_id=usuario_a).first())
+
+def estados_amistad(usuario_id, otros_ids):
+    """Estado de amistad de `usuario_id` con cada uno de `otros_ids` en una sola consulta"""
+    if not otros_ids:
+        return {}
+    columnas = (Amistad.usuario_id, Amistad.amigo_id, Amistad.estado)
+    filas = db.session.execute(db.union_all(
+        db.select(*columnas).where(Amistad.usuario_id == usuario_id, Amistad.amigo_id.in_(otros_ids)),
+        db.select(*columnas).where(Amistad.amigo_id == usuario_id, Amistad.usuario_id.in_(otros_ids))
+    )).all()
+    estados = {}
+    for solicitante, destinatario, estado in filas:
+        otro = destinatario if solicitante == usuario_id else solicitante
+        if estado == 'aceptado':
+            estados[otro] = 'amigos'
+        elif estado == 'pendiente':
+            estados[otro] = 'solicitud_enviada' if solicitante == usuario_id else 'solicitud_recibida'
+        elif estado == 'rechazado':
+            estados[otro] = 'rechazado'
+    return estados
+
+def aristas_amistad_crear(usuario_a, usuario_b):
+    """Añade las dos aristas de una amistad aceptada (sin commit)"""
+    for origen, destino in ((usuario_a, usuario_b), (usuario_b, usuario_a)):
+        if not db.session.get(AmistadArista, (origen, destino)):
+            db.session.add(AmistadArista(usuario_id=origen, amigo_id=destino))
+
+def aristas_amistad_borrar(usuario_a, usuario_b):
+    """Quita las dos aristas de una amistad (sin commit)"""
+    for origen, destino in ((usuario_a, usuario_b), (usuario_b, usuario_a)):
+        AmistadArista.query.filter_by(usuario_id=origen, amigo_id=destino).delete()
+
+def aristas_amistad_backfill():
+    """Migración: regenera AmistadArista desde las amistades aceptadas (sin commit). Devuelve el nº de aristas."""
+    AmistadArista.query.delete()
+    aceptadas = Amistad.estado == 'aceptado'
+    origen = db.union(
+        db.select(Amistad.usuario_id, Amistad.amigo_id, Amistad.fecha_solicitud).where(aceptadas),
+        db.select(Amistad.amigo_id, Amistad.usuario_id, Amistad.fecha_solicitud).where(aceptadas)
+    )
+    db.session.execute(
+        db.insert(AmistadArista).from_select(['usuario_id', 'amigo_id', 'fecha'], origen)
+    )
+    return AmistadArista.query.count()
+
+# ————— HASH DE CONTRASEÑAS —————
+class ServicioHashOcupado(Exception):
+    """La cola de hashes está llena: mejor rechazar el login que acumular peticiones"""
+
+class ServicioHash:
+    """Calcula y verifica hashes de contraseña en un pool de procesos con cola acotada.
+
+    scrypt/pbkdf2 son caros a propósito; fuera del proceso web no bloquean a los hilos que
+    atienden el resto de peticiones. Como mucho `cola_max` hashes esperan o se calculan a la vez;
+    si no hay plaza en `espera` segundos se lanza ServicioHashOcupado.
+    """
+    def __init__(self, metodo, procesos, cola_max, espera):
+        self.metodo = metodo
+        # werkzeug completa los métodos parciales al escribir el hash ('scrypt' -> 'scrypt:32768:8:1'):
+        # se compara con ese prefijo y no con el texto de HASH_METODO
+        self.prefijo = generate_password_hash('x', metodo).split('$', 1)[0]
+        self.procesos = procesos
+        self.espera = espera
+        self._plazas = threading.BoundedSemaphore(cola_max)
+        self._pool = None
+        self._lock = threading.Lock()
+        self.metricas = Counter()
+
+    def _ejecutar(self, funcion, *args):
+        if not self._plazas.acquire(timeout=self.espera):
+            self.metricas['rechazados'] += 1
+            raise ServicioHashOcupado()
+        try:
+            if not self.procesos:
+                return funcion(*args)
+            with self._lock:
+                if self._pool is None:
+                    # spawn: hacer fork de un servidor con hilos puede heredar locks tomados
+                    self._pool = ProcessPoolExecutor(self.procesos, mp_context=multiprocessing.get_context('spawn'))
+                pool = self._pool
+            try:
+                return pool.submit(funcion, *args).result()
+            except BrokenProcessPool:
+                with self._lock:
+                    if self._pool is pool:
+                        self._pool = None
+                self.metricas['pool_reiniciado'] += 1
+                return funcion(*args)
+        finally:
+            self._plazas.release()
+
+    def generar(self, contraseña):
+        self.metricas['generados'] += 1
+        return self._ejecutar(generate_password_hash, contraseña, self.metodo)
+
+    def verificar(self, contraseña_hash, contraseña):
+        self.metricas['verificados'] += 1
+        return self._ejecutar(check_password_hash, contraseña_hash, contraseña)
+
+    def necesita_rehash(self, contraseña_hash):
+        """El hash se calculó con otro método o factor de trabajo ('método$sal$hash')"""
+        return contraseña_hash.split('$', 1)[0] != self.prefijo
+
+    def cerrar(self):
+        with self._lock:
+            if self._pool is not None:
+                self._pool.shutdown(wait=False, cancel_futures=True)
+                self._pool = None
+
+hash_contraseñas = ServicioHash(app.config['HASH_METODO'], app.config['HASH_PROCESOS'],
+                                app.config['HASH_COLA_MAX'], app.config['HASH_ESPERA_SEGUNDOS'])
+
+@app.errorhandler(ServicioHashOcupado)
+def servicio_hash_ocupado(error):
+    """503 con Retry-After; el formulario se vuelve a mostrar en la misma respuesta, sin redirect"""
+    mensaje = "Hay muchas peticiones en este momento. Inténtalo de nuevo en unos segundos."
+    cabeceras = {'Retry-After': str(max(1, math.ceil(app.config['HASH_ESPERA_SEGUNDOS'])))}
+    if request.path.startswith('/api/'):
+        return jsonify({"success": False, "message": mensaje}), 503, cabeceras
+    flash(mensaje, "error")
+    if request.endpoint == 'registro':
+        pagina = render_template('registro.html', RENDER=os.getenv('RENDER') is not None)
+    elif request.endpoint == 'restablecer_contrasena':
+        pagina = render_template('restablecer.html', token=request.view_args['token'])
+    else:
+        pagina = render_template('login.html')
+    return pagina, 503, cabeceras
+
+# ————— COLA DE CORREO SALIENTE —————
+class EnviadorCorreo:
+    """Envía en segundo plano los correos de CorreoPendiente, reutilizando una conexión SMTP por lote.
+
+    Cada correo se reserva con un UPDATE condicional antes de enviarlo, así que varios procesos
+    pueden compartir la cola sin duplicar envíos. Si un proceso muere con correos reservados,
+    vuelven a estar disponibles cuando vence la reserva. Los fallos se reintentan con espera
+    exponencial hasta CORREO_MAX_INTENTOS.
+    """
+    RESERVA_SEGUNDOS = 300
+    ESPERA_MAXIMA_SEGUNDOS = 3600
+
+    def __init__(self, app):
+        self.app = app
+        self._evento = threading.Event()
+        self._lock = threading.Lock()
+        self._hilo = None
+        self.metricas = Counter()
+
+    def despertar(self):
+        """Arranca el hilo si hace falta y le avisa de que hay trabajo"""
+        if not self.app.config['CORREO_HILO_ENVIO']:
+            return
+        with self._lock:
+            if self._hilo is None or not self._hilo.is_alive():
+                self._hilo = threading.Thread(target=self._bucle, name='enviador-correo', daemon=True)
+                self._hilo.start()
+        self._evento.set()
+
+    def _bucle(self):
+        while True:
+            self._evento.wait(timeout=self.app.config['CORREO_INTERVALO_SEGUNDOS'])
+            self._evento.clear()
+            with self.app.app_context():
+                try:
+                    while self.procesar():
+                        pass
+                except Exception as e:
+                    db.session.rollback()
+                    print(f"❌ Error en el enviador de correo: {e}")
+                finally:
+                    db.session.remove()
+
+    def _reservar(self, limite):
+        ahora = datetime.now(timezone.utc)
+        disponibles = (CorreoPendiente.estado.in_(('pendiente', 'enviando')), CorreoPendiente.proximo_intento <= ahora)
+        candidatos = [i for (i,) in db.session.query(CorreoPendiente.id).filter(*disponibles)
+                      .order_by(CorreoPendiente.proximo_intento).limit(limite)]
+        reservados = []
+        for correo_id in candidatos:
+            if CorreoPendiente.query.filter(CorreoPendiente.id == correo_id, *disponibles).update({
+                'estado': 'enviando',
+                'proximo_intento': ahora + timedelta(seconds=self.RESERVA_SEGUNDOS),
+            }, synchronize_session=False):
+                reservados.append(correo_id)
+        db.session.commit()
+        return [db.session.get(CorreoPendiente, i) for i in reservados]
+
+    def _fallo(self, correo, error):
+        correo.intentos += 1
+        correo.ultimo_error = str(error)[:500]
+        if correo.intentos >= self.app.config['CORREO_MAX_INTENTOS']:
+            correo.estado = 'fallido'
+            self.metricas['fallidos'] += 1
+        else:
+            espera = min(self.app.config['CORREO_REINTENTO_BASE_SEGUNDOS'] * 2 ** (correo.intentos - 1),
+                         self.ESPERA_MAXIMA_SEGUNDOS)
+            espera *= random.uniform(0.8, 1.2)  # que los reintentos de un mismo corte no coincidan
+            correo.estado = 'pendiente'
+            correo.proximo_intento = datetime.now(timezone.utc) + timedelta(seconds=espera)
+            self.metricas['reintentos'] += 1
+        db.session.commit()
+
+    def procesar(self, limite=None):
+        """Envía un lote de correos vencidos por una sola conexión SMTP. Devuelve el nº de correos tratados."""
+        correos = self._reservar(limite or self.app.config['CORREO_LOTE'])
+        if not correos:
+            return 0
+        restantes = list(correos)
+        try:
+            with mail.connect() as conexion:
+                self.metricas['conexiones'] += 1
+                while restantes:
+                    correo = restantes[0]
+                    inicio = time.perf_counter()
+                    try:
+                        conexion.send(Message(subject=correo.asunto, recipients=[correo.destinatario], body=correo.cuerpo))
+                    except (smtplib.SMTPResponseException, smtplib.SMTPRecipientsRefused) as e:
+                        # El servidor rechazó este correo pero la conexión sigue sirviendo
+                        restantes.pop(0)
+                        self._fallo(correo, e)
+                        continue
+                    restantes.pop(0)
+                    correo.estado = 'enviado'
+                    correo.intentos += 1
+                    correo.fecha_envio = datetime.now(timezone.utc)
+                    db.session.commit()
+                    self.metricas['enviados'] += 1
+                    self.metricas['segundos_envio'] += time.perf_counter() - inicio
+        except Exception as e:
+            # Conexión caída o servidor inaccesible: los que quedaban se reintentan más tarde
+            for correo in restantes:
+                self._fallo(correo, e)
+        return len(correos)
+
+    def estadisticas(self):
+        por_estado = dict(db.session.query(CorreoPendiente.estado, db.func.count(CorreoPendiente.id))
+                          .group_by(CorreoPendiente.estado).all())
+        enviados = self.metricas['enviados']
+        return {
+            "encolados": self.metricas['encolados'],
+            "enviados": enviados,
+            "reintentos": self.metricas['reintentos'],
+            "fallidos": self.metricas['fallidos'],
+            "conexiones_smtp": self.metricas['conexiones'],
+            "ms_medio_envio": round(1000 * self.metricas['segundos_envio'] / enviados, 2) if enviados else None,
+            "cola": {estado: por_estado.get(estado, 0) for estado in ('pendiente', 'enviando', 'enviado', 'fallido')},
+        }
+
+enviador_correo = EnviadorCorreo(app)
+
+def encolar_correo(destinatario, asunto, cuerpo):
+    """Guarda el correo en la bandeja de salida y avisa al enviador; la petición no espera al SMTP"""
+    db.session.add(CorreoPendiente(destinatario=destinatario, asunto=asunto, cuerpo=cuerpo))
+    db.session.commit()
+    enviador_correo.metricas['encolados'] += 1
+    enviador_correo.despertar()
+
 def enviar_correo_verificacion(correo, nombre_usuario):
     if os.getenv('RENDER'):
         print(f"[RENDER] Simulando verificación para {correo}")
@@ -194,16 +840,15 @@ def enviar_correo_verificacion(correo, nombre_usuario):
     try:
         token = serializer.dumps(correo, salt='verificacion-email')
         enlace = url_for('verificar_email', token=token, _external=True)
-        from flask_mail import Message
-        msg = Message(
-            subject="¡Verifica tu cuenta en BeerSp!",
-            recipients=[correo],
-            body=f"Hola {nombre_usuario},\n\nHaz clic aquí para verificar: {enlace}\n(Válido 1 hora)"
+        encolar_correo(
+            correo,
+            "¡Verifica tu cuenta en BeerSp!",
+            f"Hola {nombre_usuario},\n\nHaz clic aquí para verificar: {enlace}\n(Válido 1 hora)"
         )
-        mail.send(msg)
         return True
     except Exception as e:
-        print(f"Error al enviar correo: {e}")
+        db.session.rollback()
+        print(f"Error al encolar correo: {e}")
         return False
 
 def enviar_correo_restablecimiento(correo):
@@ -215,11 +860,10 @@ def enviar_correo_restablecimiento(correo):
         token = serializer.dumps(correo, salt='restablecer-contrasena')
         enlace = url_for('restablecer_contrasena', token=token, _external=True)
         
-        from flask_mail import Message
-        msg = Message(
-            subject="Restablece tu contraseña en BeerSp",
-            recipients=[correo],
-            body=f"""Hola,
+        encolar_correo(
+            correo,
+            "Restablece tu contraseña en BeerSp",
+            f"""Hola,
 
 Has solicitado restablecer tu contraseña en BeerSp.
 
@@ -234,10 +878,10 @@ Si no solicitaste este cambio, ignora este mensaje.
 El equipo BeerSp 🍻
 """
         )
-        mail.send(msg)
         return True
     except Exception as e:
-        print(f"Error al enviar correo de restablecimiento: {e}")
+        db.session.rollback()
+        print(f"Error al encolar correo de restablecimiento: {e}")
         return False
     
 def seed_cervezas():
@@ -266,8 +910,1591 @@ def seed_cervezas():
                 color=color
             ))
         db.session.commit()
+        cache_top.invalidar()
         print("✅ 12 cervezas españolas reales precargadas.")
 
+# ————— FOTOS DE PERFIL —————
+# Una foto procesada se guarda en Usuario.foto como '<huella>.<ext>' y sus variantes en disco como
+# '<huella>_<variante>.<ext>'; la huella es el sha256 del fichero subido, así que subir dos veces la
+# misma imagen reutiliza los ficheros. Cualquier otro nombre es una foto antigua sin variantes.
+_FOTO_PROCESADA = re.compile(r'^([0-9a-f]{20})\.(webp|jpg)$')
+
+class FotoInvalida(ValueError):
+    pass
+
+def foto_extension():
+    if app.config['FOTO_FORMATO'] == 'webp' and pil_features.check('webp'):
+        return 'webp'
+    return 'jpg'
+
+def _foto_codificar(imagen, extension):
+    """Codifica sin metadatos (no se copia el EXIF): WebP o JPEG progresivo optimizado"""
+    salida = BytesIO()
+    if extension == 'webp':
+        imagen.save(salida, 'WEBP', quality=app.config['FOTO_CALIDAD'], method=6)
+    else:
+        if imagen.mode != 'RGB':
+            fondo = Image.new('RGB', imagen.size, (255, 255, 255))
+            fondo.paste(imagen, mask=imagen.getchannel('A') if imagen.mode == 'RGBA' else None)
+            imagen = fondo
+        imagen.save(salida, 'JPEG', quality=app.config['FOTO_CALIDAD'], optimize=True, progressive=True)
+    return salida.getvalue()
+
+def procesar_foto(datos):
+    """Genera las variantes de una foto subida y devuelve el nombre que se guarda en Usuario.foto.
+
+    Lanza FotoInvalida si los datos no son una imagen que Pillow pueda abrir. Si las variantes ya
+    existen no se rehacen; quien guarda el nombre vuelve a llamarla tras el commit, por si otro
+    usuario las borró entre medias (ver foto_borrar).
+    """
+    extension = foto_extension()
+    huella = hashlib.sha256(datos).hexdigest()[:20]
+    nombre = f"{huella}.{extension}"
+    rutas = {v: os.path.join(static_fotos_dir, f"{huella}_{v}.{extension}") for v in FOTO_VARIANTES}
+    if all(os.path.exists(ruta) for ruta in rutas.values()):
+        return nombre  # misma imagen ya subida (por este u otro usuario)
+
+    try:
+        imagen = Image.open(BytesIO(datos))
+        if imagen.width * imagen.height > FOTO_MAX_PIXELES:
+            raise FotoInvalida("La imagen tiene demasiados píxeles.")
+        imagen.seek(0)  # GIF animado: primer fotograma
+        imagen = ImageOps.exif_transpose(imagen)  # aplica la orientación antes de descartar el EXIF
+        imagen = imagen.convert('RGBA' if 'A' in imagen.getbands() or 'transparency' in imagen.info else 'RGB')
+    except FotoInvalida:
+        raise
+    except Exception as e:
+        raise FotoInvalida("El archivo no es una imagen válida.") from e
+
+    for variante, (lado, cuadrada) in FOTO_VARIANTES.items():
+        if cuadrada:
+            copia = ImageOps.fit(imagen, (lado, lado), Image.Resampling.LANCZOS)
+        else:
+            copia = imagen.copy()
+            copia.thumbnail((lado, lado), Image.Resampling.LANCZOS)
+        temporal = f"{rutas[variante]}.{uuid.uuid4().hex[:8]}.tmp"
+        with open(temporal, 'wb') as f:
+            f.write(_foto_codificar(copia, extension))
+        os.replace(temporal, rutas[variante])
+    return nombre
+
+def foto_variante(foto, variante='avatar'):
+    """Nombre del fichero de `foto` a servir para `variante`; las fotos antiguas se sirven tal cual"""
+    if not foto:
+        return None
+    procesada = _FOTO_PROCESADA.match(foto)
+    if not procesada:
+        return foto
+    return f"{procesada.group(1)}_{variante}.{procesada.group(2)}"
+
+def foto_ficheros(foto):
+    """Ficheros en disco de una foto: sus variantes o, si es antigua, el propio fichero"""
+    if not foto:
+        return []
+    if _FOTO_PROCESADA.match(foto):
+        return [foto_variante(foto, variante) for variante in FOTO_VARIANTES]
+    return [foto] if foto.startswith('user_') else []
+
+def foto_borrar(foto):
+    """Borra los ficheros de una foto que ya no usa ningún usuario (las huellas se comparten).
+
+    Otro usuario puede estar guardando la misma foto sin haber hecho commit aún: los ficheros se
+    apartan con un rename, se vuelve a mirar si alguien la usa y, si es así, se devuelven a su sitio.
+    Un commit posterior a esa segunda consulta lo cubre quien guarda, que llama otra vez a procesar_foto.
+    """
+    if not foto or Usuario.query.filter_by(foto=foto).first():
+        return
+    apartados = []
+    for nombre in foto_ficheros(foto):
+        ruta = os.path.join(static_fotos_dir, nombre)
+        apartado = f"{ruta}.{uuid.uuid4().hex[:8]}.borrando"
+        try:
+            os.replace(ruta, apartado)
+        except FileNotFoundError:
+            continue
+        apartados.append((ruta, apartado))
+    en_uso = Usuario.query.filter_by(foto=foto).first() is not None
+    for ruta, apartado in apartados:
+        if en_uso:
+            os.replace(apartado, ruta)
+        else:
+            os.remove(apartado)
+
+@app.template_global()
+def foto_url(foto, variante='avatar'):
+    return url_for('servir_foto', nombre=foto_variante(foto, variante))
+
+@app.route('/fotos/<path:nombre>')
+def servir_foto(nombre):
+    """Sirve una foto con caché inmutable: al cambiar de foto cambia el nombre, nunca el contenido.
+
+    send_from_directory responde 304 a If-None-Match/If-Modified-Since y 206 a peticiones Range.
+    """
+    procesada = re.match(r'^([0-9a-f]{20})_(\w+)\.', nombre)
+    # ETag fuerte: la huella del contenido ya está en el nombre de las variantes
+    etag = f"{procesada.group(1)}-{procesada.group(2)}" if procesada else True
+    respuesta = send_from_directory(static_fotos_dir, nombre, etag=etag, max_age=FOTO_CACHE_SEGUNDOS)
+    respuesta.cache_control.public = True
+    respuesta.cache_control.immutable = True
+    return respuesta
+
+# ————— SERIALIZACIÓN JSON —————
+# Un único sitio donde los modelos se convierten en los diccionarios que devuelve la API.
+def fecha_json(fecha):
+    return fecha.strftime('%d/%m/%Y %H:%M') if fecha else None
+
+def cerveza_json(cerveza):
+    return {
+        "id": cerveza.id,
+        "nombre": cerveza.nombre,
+        "estilo": cerveza.estilo,
+        "pais_procedencia": cerveza.pais_procedencia,
+        "porcentaje_alcohol": cerveza.porcentaje_alcohol,
+        "ibu": cerveza.ibu,
+        "color": cerveza.color
+    }
+
+def local_json(local):
+    return {
+        "id": local.id,
+        "nombre": local.nombre,
+        "direccion": local.direccion,
+        "ciudad": local.ciudad,
+        "pais": local.pais,
+        "latitud": local.latitud,
+        "longitud": local.longitud
+    }
+
+def usuario_json(usuario, *campos, variante='avatar'):
+    """Datos públicos de un usuario; `campos` añade columnas opcionales como 'ubicacion'"""
+    datos = {
+        "id": usuario.id,
+        "nombre_usuario": usuario.nombre_usuario,
+        "foto": foto_variante(usuario.foto, variante)
+    }
+    for campo in campos:
+        datos[campo] = getattr(usuario, campo)
+    return datos
+
+def degustacion_json(degustacion, usuario, cerveza, local_nombre=None, comentarios=()):
+    """Degustación tal como aparece en el feed de amigos"""
+    return {
+        "id": degustacion.id,
+        "usuario": usuario_json(usuario),
+        "cerveza": {
+            "id": cerveza.id,
+            "nombre": cerveza.nombre,
+            "estilo": cerveza.estilo,
+            "pais": cerveza.pais_procedencia
+        },
+        "puntuacion": degustacion.puntuacion,
+        "comentario": degustacion.comentario,
+        "fecha": fecha_json(degustacion.fecha),
+        "local": local_nombre,
+        "comentarios": list(comentarios)
+    }
+
+class ProveedorJSON(DefaultJSONProvider):
+    """jsonify con orjson cuando está instalado (varias veces más rápido); si no, el de Flask"""
+    sort_keys = False
+
+    def dumps(self, obj, **kwargs):
+        # orjson solo produce la salida compacta, que es la que pide jsonify fuera de modo debug
+        if orjson is None or set(kwargs) - {'separators'}:
+            return super().dumps(obj, **kwargs)
+        # Las fechas pasan por default() para mantener el formato HTTP de Flask
+        return orjson.dumps(obj, default=self.default,
+                            option=orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME).decode()
+
+app.json = ProveedorJSON(app)
+
+@app.after_request
+def etag_json(respuesta):
+    """ETag automático en los GET que devuelven JSON: si el cliente ya tiene esa versión, 304 sin cuerpo"""
+    if (request.method == 'GET' and respuesta.status_code == 200 and respuesta.is_json
+            and not respuesta.is_streamed and 'ETag' not in respuesta.headers):
+        respuesta.add_etag()
+        # Datos por usuario: el navegador puede guardarlos pero debe revalidar cada vez
+        respuesta.cache_control.private = True
+        respuesta.cache_control.no_cache = True
+        respuesta.make_conditional(request)
+    return respuesta
+
+# ————— ESTADÍSTICAS DE CERVEZAS —————
+def estrellas_de(puntuacion):
+    """Cubeta del histograma (1-5) para una puntuación"""
+    return min(5, max(1, int(puntuacion)))
+
+def cerveza_stats_registrar(cerveza_id, puntuacion, fecha):
+    """Suma una valoración nueva a los agregados de la cerveza (sin commit)"""
+    if puntuacion is None:
+        return
+    estrellas = estrellas_de(puntuacion)
+    cubeta = getattr(CervezaStats, f'estrellas_{estrellas}')
+    # Upsert: la primera valoración de una cerveza crea la fila aunque lleguen dos a la vez
+    alta = insert_dialecto(CervezaStats).values(
+        cerveza_id=cerveza_id,
+        suma_puntuacion=puntuacion,
+        num_valoraciones=1,
+        promedio=puntuacion,
+        primera_valoracion=fecha,
+        ultima_valoracion=fecha,
+        **{f'estrellas_{n}': int(n == estrellas) for n in range(1, 6)}
+    )
+    db.session.execute(alta.on_conflict_do_update(index_elements=['cerveza_id'], set_={
+        'suma_puntuacion': CervezaStats.suma_puntuacion + puntuacion,
+        'num_valoraciones': CervezaStats.num_valoraciones + 1,
+        'promedio': (CervezaStats.suma_puntuacion + puntuacion) / (CervezaStats.num_valoraciones + 1),
+        # Las degustaciones del lote pueden llegar con fecha atrasada: mínimo y máximo, no "ahora"
+        'primera_valoracion': db.case(
+            (CervezaStats.primera_valoracion.is_(None) | (CervezaStats.primera_valoracion > fecha), fecha),
+            else_=CervezaStats.primera_valoracion
+        ),
+        'ultima_valoracion': db.case(
+            (CervezaStats.ultima_valoracion.is_(None) | (CervezaStats.ultima_valoracion < fecha), fecha),
+            else_=CervezaStats.ultima_valoracion
+        ),
+        cubeta.key: cubeta + 1
+    }))
+
+def cerveza_stats_recalcular(cerveza_ids=None):
+    """Recalcula desde Degustacion los agregados de las cervezas indicadas (o de todas). Sin commit."""
+    borrar = CervezaStats.query
+    if cerveza_ids is not None:
+        cerveza_ids = list(cerveza_ids)
+        if not cerveza_ids:
+            return
+        borrar = borrar.filter(CervezaStats.cerveza_id.in_(cerveza_ids))
+    borrar.delete(synchronize_session=False)
+
+    # Mismas cubetas que estrellas_de(), expresadas como rangos
+    rangos = [
+        Degustacion.puntuacion < 2,
+        (Degustacion.puntuacion >= 2) & (Degustacion.puntuacion < 3),
+        (Degustacion.puntuacion >= 3) & (Degustacion.puntuacion < 4),
+        (Degustacion.puntuacion >= 4) & (Degustacion.puntuacion < 5),
+        Degustacion.puntuacion >= 5,
+    ]
+    cubetas = [db.func.sum(db.case((rango, 1), else_=0)) for rango in rangos]
+    origen = db.select(
+        Degustacion.cerveza_id,
+        db.func.sum(Degustacion.puntuacion),
+        db.func.count(Degustacion.id),
+        db.func.avg(Degustacion.puntuacion),
+        db.func.min(Degustacion.fecha),
+        db.func.max(Degustacion.fecha),
+        *cubetas
+    ).where(Degustacion.puntuacion.isnot(None)).group_by(Degustacion.cerveza_id)
+    if cerveza_ids is not None:
+        origen = origen.where(Degustacion.cerveza_id.in_(cerveza_ids))
+    db.session.execute(
+        db.insert(CervezaStats).from_select(
+            ['cerveza_id', 'suma_puntuacion', 'num_valoraciones', 'promedio',
+             'primera_valoracion', 'ultima_valoracion',
+             'estrellas_1', 'estrellas_2', 'estrellas_3', 'estrellas_4', 'estrellas_5'], origen
+        )
+    )
+
+# ————— BÚSQUEDA DE TEXTO COMPLETO (FTS5) —————
+def _fts_ddl(tabla, columnas):
+    """Tabla FTS5 de contenido externo sobre `tabla` y los triggers que la sincronizan.
+
+    Los triggers la mantienen al día con cualquier INSERT/UPDATE/DELETE (api_cerveza_nueva,
+    seed_cervezas, registro, editar_perfil...). remove_diacritics hace que "aho" encuentre "Ahó!".
+    """
+    lista = ', '.join(columnas)
+    nuevos = ', '.join(f'new.{c}' for c in columnas)
+    viejos = ', '.join(f'old.{c}' for c in columnas)
+    return [
+        f"""CREATE VIRTUAL TABLE IF NOT EXISTS {tabla}_fts USING fts5(
+            {lista},
+            content='{tabla}', content_rowid='id',
+            tokenize='unicode61 remove_diacritics 2'
+        )""",
+        f"""CREATE TRIGGER IF NOT EXISTS {tabla}_fts_ai AFTER INSERT ON {tabla} BEGIN
+            INSERT INTO {tabla}_fts(rowid, {lista}) VALUES (new.id, {nuevos});
+        END""",
+        f"""CREATE TRIGGER IF NOT EXISTS {tabla}_fts_ad AFTER DELETE ON {tabla} BEGIN
+            INSERT INTO {tabla}_fts({tabla}_fts, rowid, {lista}) VALUES ('delete', old.id, {viejos});
+        END""",
+        f"""CREATE TRIGGER IF NOT EXISTS {tabla}_fts_au AFTER UPDATE ON {tabla} BEGIN
+            INSERT INTO {tabla}_fts({tabla}_fts, rowid, {lista}) VALUES ('delete', old.id, {viejos});
+            INSERT INTO {tabla}_fts(rowid, {lista}) VALUES (new.id, {nuevos});
+        END""",
+    ]
+
+FTS_TABLAS = {
+    'cerveza': ['nombre', 'estilo', 'pais_procedencia', 'color'],
+    'usuario': ['nombre_usuario'],
+    'local': ['nombre', 'ciudad'],
+}
+
+def fts_crear():
+    """Crea las tablas FTS5 y sus triggers. Devuelve False si el motor no es SQLite o no tiene FTS5."""
+    if not app.config['BUSQUEDA_FTS'] or db.engine.dialect.name != 'sqlite':
+        return False
+    try:
+        for tabla, columnas in FTS_TABLAS.items():
+            # Sin triggers (tabla nueva o tabla base recreada) el índice puede estar desfasado
+            desfasado = not db.session.execute(db.text(
+                "SELECT 1 FROM sqlite_master WHERE type = 'trigger' AND name = :nombre"
+            ), {'nombre': f'{tabla}_fts_ai'}).first()
+            for sentencia in _fts_ddl(tabla, columnas):
+                db.session.execute(db.text(sentencia))
+            if desfasado:
+                fts_reconstruir(tabla)
+        db.session.commit()
+        return True
+    except Exception as e:
+        db.session.rollback()
+        print(f"⚠️ FTS5 no disponible, se usará LIKE: {e}")
+        return False
+
+def fts_reconstruir(tabla):
+    """Regenera el índice FTS5 de `tabla` desde la tabla base (sin commit)"""
+    db.session.execute(db.text(f"INSERT INTO {tabla}_fts({tabla}_fts) VALUES ('rebuild')"))
+
+def consulta_fts(q):
+    """Convierte el texto del buscador en una consulta MATCH de prefijos: 'estrella gal' -> "estrella"* "gal"*"""
+    terminos = re.findall(r'\w+', q)
+    return ' '.join(f'"{t}"*' for t in terminos)
+
+def buscar_cervezas_fts(q, limite=10):
+    """Búsqueda FTS5 ordenada por bm25 ponderado por popularidad (nº de valoraciones)"""
+    consulta = consulta_fts(q)
+    if not consulta:
+        return []
+    # bm25 es negativo (más negativo = más relevante); la popularidad lo amplifica hasta x2
+    sentencia = db.text("""
+        SELECT cerveza.* FROM cerveza_fts
+        JOIN cerveza ON cerveza.id = cerveza_fts.rowid
+        LEFT JOIN cerveza_stats ON cerveza_stats.cerveza_id = cerveza.id
+        WHERE cerveza_fts MATCH :consulta
+        ORDER BY bm25(cerveza_fts, 10.0, 4.0, 1.0, 1.0)
+                 * (1.0 + MIN(COALESCE(cerveza_stats.num_valoraciones, 0), 100) / 100.0)
+        LIMIT :limite
+    """)
+    return db.session.query(Cerveza).from_statement(sentencia).params(
+        consulta=consulta, limite=limite
+    ).all()
+
+def buscar_usuarios_fts(q, excluir_id, limite=10):
+    """Búsqueda de usuarios por prefijo de palabra en nombre_usuario"""
+    consulta = consulta_fts(q)
+    if not consulta:
+        return []
+    sentencia = db.text("""
+        SELECT usuario.* FROM usuario_fts
+        JOIN usuario ON usuario.id = usuario_fts.rowid
+        WHERE usuario_fts MATCH :consulta AND usuario.id != :excluir_id AND usuario.eliminado_en IS NULL
+        ORDER BY bm25(usuario_fts)
+        LIMIT :limite
+    """)
+    return db.session.query(Usuario).from_statement(sentencia).params(
+        consulta=consulta, excluir_id=excluir_id, limite=limite
+    ).all()
+
+def buscar_cervezas_like(q, limite=10):
+    """Búsqueda portable para motores sin FTS5 (ILIKE en PostgreSQL, lower() LIKE en el resto)"""
+    # autoescape: un '%' o '_' en la consulta se busca literalmente en vez de actuar de comodín
+    return Cerveza.query.outerjoin(
+        CervezaStats, CervezaStats.cerveza_id == Cerveza.id
+    ).filter(
+        Cerveza.nombre.icontains(q, autoescape=True) |
+        Cerveza.estilo.icontains(q, autoescape=True) |
+        Cerveza.pais_procedencia.icontains(q, autoescape=True) |
+        Cerveza.color.icontains(q, autoescape=True)
+    ).order_by(
+        db.func.coalesce(CervezaStats.num_valoraciones, 0).desc(), Cerveza.nombre
+    ).limit(limite).all()
+
+# ————— LOCALES: BÚSQUEDA Y GEOHASH —————
+_GEOHASH_BASE32 = '0123456789bcdefghjkmnpqrstuvwxyz'
+GEOHASH_PRECISION = 9  # celdas de ~5 m; sus prefijos son las celdas mayores que las contienen
+GEOHASH_MAX_CELDAS = 32  # prefijos como mucho por consulta geográfica (uno por rango del índice)
+RADIO_TIERRA_KM = 6371.0
+
+def geohash_codificar(latitud, longitud, precision=GEOHASH_PRECISION):
+    """Geohash de un punto: los puntos cercanos comparten prefijo y quedan contiguos en el índice"""
+    rangos = {'lat': [-90.0, 90.0], 'lon': [-180.0, 180.0]}
+    caracteres, bits, n, eje = [], 0, 0, 'lon'
+    while len(caracteres) < precision:
+        rango = rangos[eje]
+        valor = longitud if eje == 'lon' else latitud
+        medio = (rango[0] + rango[1]) / 2
+        bits <<= 1
+        if valor >= medio:
+            bits |= 1
+            rango[0] = medio
+        else:
+            rango[1] = medio
+        eje = 'lat' if eje == 'lon' else 'lon'
+        n += 1
+        if n == 5:
+            caracteres.append(_GEOHASH_BASE32[bits])
+            bits = n = 0
+    return ''.join(caracteres)
+
+def _geohash_celda(precision):
+    """(alto, ancho) en grados de una celda de geohash de `precision` caracteres"""
+    bits = 5 * precision
+    return 180.0 / 2 ** (bits // 2), 360.0 / 2 ** ((bits + 1) // 2)
+
+def geohash_celdas(sur, oeste, norte, este, max_celdas=GEOHASH_MAX_CELDAS):
+    """Prefijos de geohash que cubren la caja, con la precisión más fina que no pase de `max_celdas`.
+
+    Si oeste > este la caja cruza el antimeridiano y se cubre en dos mitades.
+    """
+    if oeste > este:
+        return (geohash_celdas(sur, oeste, norte, 180.0, max_celdas)
+                | geohash_celdas(sur, -180.0, norte, este, max_celdas))
+    for precision in range(GEOHASH_PRECISION, 0, -1):
+        alto, ancho = _geohash_celda(precision)
+        filas = range(int((sur + 90) // alto), min(int((norte + 90) // alto), round(180 / alto) - 1) + 1)
+        columnas = range(int((oeste + 180) // ancho), min(int((este + 180) // ancho), round(360 / ancho) - 1) + 1)
+        if len(filas) * len(columnas) <= max_celdas:
+            break
+    # El centro de cada celda de la rejilla da su geohash
+    return {
+        geohash_codificar(-90 + (f + 0.5) * alto, -180 + (c + 0.5) * ancho, precision)
+        for f in filas for c in columnas
+    }
+
+def caja_radio(latitud, longitud, radio_km):
+    """Caja (sur, oeste, norte, este) que contiene el círculo de `radio_km` alrededor del punto"""
+    delta_lat = math.degrees(radio_km / RADIO_TIERRA_KM)
+    sur, norte = max(latitud - delta_lat, -90.0), min(latitud + delta_lat, 90.0)
+    coseno = math.cos(math.radians(max(abs(sur), abs(norte))))
+    if sur == -90.0 or norte == 90.0 or delta_lat / max(coseno, 1e-12) >= 180:
+        return sur, -180.0, norte, 180.0  # el círculo toca un polo: todas las longitudes
+    delta_lon = delta_lat / coseno
+    oeste = (longitud - delta_lon + 540) % 360 - 180
+    este = (longitud + delta_lon + 540) % 360 - 180
+    return sur, oeste, norte, este
+
+def distancia_km(lat1, lon1, lat2, lon2):
+    """Distancia de círculo máximo (haversine) en km"""
+    fi1, fi2 = math.radians(lat1), math.radians(lat2)
+    a = (math.sin((fi2 - fi1) / 2) ** 2
+         + math.cos(fi1) * math.cos(fi2) * math.sin(math.radians(lon2 - lon1) / 2) ** 2)
+    return 2 * RADIO_TIERRA_KM * math.asin(min(1.0, math.sqrt(a)))
+
+def filtro_caja_locales(sur, oeste, norte, este):
+    """Locales dentro de la caja: rangos de prefijo sobre ix_local_geohash y después el corte exacto"""
+    celdas = geohash_celdas(sur, oeste, norte, este)
+    # '~' es mayor que cualquier carácter base32: [p, p~) son los geohashes que empiezan por p
+    prefijos = db.or_(*[db.and_(Local.geohash >= p, Local.geohash < p + '~') for p in sorted(celdas)])
+    if oeste <= este:
+        longitud = Local.longitud.between(oeste, este)
+    else:
+        longitud = db.or_(Local.longitud >= oeste, Local.longitud <= este)
+    return db.and_(prefijos, Local.latitud.between(sur, norte), longitud)
+
+def filtro_busqueda_locales(q):
+    """Locales cuyo nombre o ciudad contiene las palabras de `q` (FTS5 con LIKE de reserva)"""
+    if app.config['BUSQUEDA_FTS']:
+        consulta = consulta_fts(q)
+        if not consulta:
+            return db.false()
+        ids = db.select(db.literal_column('rowid')).select_from(db.text('local_fts')).where(
+            db.text('local_fts MATCH :consulta').bindparams(consulta=consulta)
+        )
+        return Local.id.in_(ids)
+    return Local.nombre.icontains(q, autoescape=True) | Local.ciudad.icontains(q, autoescape=True)
+
+def _local_geohash(mapper, conexion, local):
+    """Mantiene el geohash al día en cualquier alta o edición de un local con coordenadas"""
+    if local.latitud is None or local.longitud is None:
+        local.geohash = None
+    else:
+        local.geohash = geohash_codificar(local.latitud, local.longitud)
+
+event.listen(Local, 'before_insert', _local_geohash)
+event.listen(Local, 'before_update', _local_geohash)
+
+def locales_geohash_backfill():
+    """Calcula el geohash de los locales con coordenadas que aún no lo tienen (sin commit)"""
+    pendientes = Local.query.filter(
+        Local.geohash.is_(None), Local.latitud.isnot(None), Local.longitud.isnot(None)
+    )
+    for local in pendientes:
+        local.geohash = geohash_codificar(local.latitud, local.longitud)
+
+# ————— AUTOCOMPLETADO EN MEMORIA —————
+def normalizar_texto(texto):
+    """Minúsculas, sin tildes y solo letras/dígitos separados por un espacio"""
+    texto = texto.lower()
+    if not texto.isascii():
+        texto = ''.join(c for c in unicodedata.normalize('NFKD', texto) if not unicodedata.combining(c))
+    return ' '.join(re.findall(r'\w+', texto))
+
+def distancia_prefijo(consulta, texto, maximo=None):
+    """Distancia de edición entre `consulta` y el prefijo de `texto` que mejor encaja.
+
+    Con `maximo` deja de calcular en cuanto la distancia lo supera y devuelve `maximo + 1`.
+    """
+    anterior = list(range(len(texto) + 1))
+    for i, cq in enumerate(consulta, 1):
+        actual = [i]
+        for j, ct in enumerate(texto, 1):
+            actual.append(min(anterior[j] + 1, actual[j - 1] + 1, anterior[j - 1] + (cq != ct)))
+        if maximo is not None and min(actual) > maximo:
+            return maximo + 1
+        anterior = actual
+    # El resto de `texto` después del prefijo no cuenta
+    return min(anterior)
+
+class _FotoAutocompletado:
+    """Estado del índice de autocompletado: se publica entero con una sola asignación.
+
+    Solo crece por el final: `añadir` escribe la posición nueva en las listas y en los trigramas y la
+    publica la última en `orden`, así que quien lea una foto nunca ve una posición a medias.
+    """
+    def __init__(self, ids, nombres, normalizados, trigramas, orden):
+        self.ids, self.nombres, self.normalizados = ids, nombres, normalizados
+        self.trigramas, self.orden = trigramas, orden
+
+class IndiceAutocompletado:
+    """Índice en memoria sobre los nombres de cerveza para autocompletar con tolerancia a erratas.
+
+    Dos estructuras: las posiciones ordenadas por nombre normalizado (prefijo exacto por bisección)
+    y un índice de trigramas para las erratas. Las posiciones se guardan en `array('I')`, así que
+    cada ocurrencia cuesta 4 bytes en lugar de un objeto int de Python.
+
+    Las consultas leen `self._foto` una vez y no toman el cerrojo; `construir` cambia la foto entera
+    y `añadir` la amplía, ambos bajo el mismo cerrojo para no perder altas.
+    """
+    MAX_CANDIDATOS = 12
+    # Trigramas presentes en más de esta fracción del catálogo (y en más de MIN_TRIGRAMA_COMUN
+    # nombres) no discriminan: se ignoran siempre que la consulta tenga otros más selectivos
+    FRACCION_TRIGRAMA_COMUN = 0.02
+    MIN_TRIGRAMA_COMUN = 1000
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.construir([])
+
+    @staticmethod
+    def trigramas(texto_normalizado, prefijo=False):
+        """Trigramas por palabra con relleno inicial; en modo prefijo la última palabra no se cierra"""
+        palabras = texto_normalizado.split()
+        resultado = set()
+        for n, palabra in enumerate(palabras):
+            abierta = prefijo and n == len(palabras) - 1
+            relleno = f"  {palabra}" + ('' if abierta else ' ')
+            resultado.update(relleno[i:i + 3] for i in range(len(relleno) - 2))
+        return resultado
+
+    def __len__(self):
+        return len(self._foto.ids)
+
+    def construir(self, filas):
+        """Reconstruye el índice a partir de pares (id, nombre)"""
+        ids, nombres, normalizados = array('I'), [], []
+        trigramas = defaultdict(lambda: array('I'))
+        for cerveza_id, nombre in filas:
+            posicion = len(ids)
+            normalizado = normalizar_texto(nombre)
+            ids.append(cerveza_id)
+            nombres.append(nombre)
+            normalizados.append(normalizado)
+            for trigrama in self.trigramas(normalizado):
+                trigramas[trigrama].append(posicion)
+        orden = array('I', sorted(range(len(ids)), key=normalizados.__getitem__))
+        # Se construye fuera del cerrojo y se publica de una vez: las consultas no esperan
+        with self._lock:
+            self._foto = _FotoAutocompletado(ids, nombres, normalizados, trigramas, orden)
+
+    def añadir(self, cerveza_id, nombre):
+        normalizado = normalizar_texto(nombre)
+        with self._lock:
+            foto = self._foto
+            posicion = len(foto.ids)
+            foto.ids.append(cerveza_id)
+            foto.nombres.append(nombre)
+            foto.normalizados.append(normalizado)
+            for trigrama in self.trigramas(normalizado):
+                foto.trigramas[trigrama].append(posicion)
+            bisect.insort(foto.orden, posicion, key=foto.normalizados.__getitem__)
+
+    @staticmethod
+    def _por_prefijo(foto, normalizada, limite):
+        """Posiciones cuyo nombre normalizado empieza exactamente por la consulta"""
+        inicio = bisect.bisect_left(foto.orden, normalizada, key=foto.normalizados.__getitem__)
+        resultado = []
+        for posicion in foto.orden[inicio:inicio + limite]:
+            if not foto.normalizados[posicion].startswith(normalizada):
+                break
+            resultado.append(posicion)
+        return resultado
+
+    @staticmethod
+    def _distancia(foto, normalizada, posicion, tolerancia):
+        """Distancia al prefijo del nombre completo o de cualquiera de sus palabras"""
+        nombre = foto.normalizados[posicion]
+        ventana = len(normalizada) + tolerancia
+        mejor = distancia_prefijo(normalizada, nombre[:ventana], tolerancia)
+        inicio = nombre.find(' ')
+        while mejor and inicio != -1:
+            mejor = min(mejor, distancia_prefijo(normalizada, nombre[inicio + 1:inicio + 1 + ventana], tolerancia))
+            inicio = nombre.find(' ', inicio + 1)
+        return mejor
+
+    def sugerir(self, consulta, limite=8):
+        """Devuelve hasta `limite` pares (id, nombre): primero prefijos exactos, luego por distancia"""
+        normalizada = normalizar_texto(consulta)
+        if not normalizada:
+            return []
+        foto = self._foto
+        # Fase 1: prefijo exacto por bisección; si llena el cupo no hace falta más
+        exactos = self._por_prefijo(foto, normalizada, limite)
+        if len(exactos) < limite:
+            # Fase 2: candidatos por trigramas compartidos, descartando los demasiado comunes
+            ocurrencias = sorted(
+                (foto.trigramas.get(t, ()) for t in self.trigramas(normalizada, prefijo=True)), key=len
+            )
+            maximo = max(self.MIN_TRIGRAMA_COMUN, int(len(foto.ids) * self.FRACCION_TRIGRAMA_COMUN))
+            selectivas = [o for o in ocurrencias if len(o) <= maximo] or ocurrencias[:3]
+            coincidencias = Counter(chain.from_iterable(selectivas))
+            # Fase 3: distancia de edición solo sobre los mejores candidatos
+            tolerancia = max(1, len(normalizada) // 4)
+            vistos = set(exactos)
+            puntuados = []
+            for posicion, comunes in coincidencias.most_common(self.MAX_CANDIDATOS):
+                if posicion in vistos:
+                    continue
+                distancia = self._distancia(foto, normalizada, posicion, tolerancia)
+                if distancia <= tolerancia:
+                    puntuados.append((distancia, -comunes, len(foto.nombres[posicion]), posicion))
+            puntuados.sort()
+            exactos += [p for _, _, _, p in puntuados[:limite - len(exactos)]]
+        return [(foto.ids[p], foto.nombres[p]) for p in exactos]
+
+autocompletado = IndiceAutocompletado()
+
+# ————— MUESTREO ALEATORIO DE CERVEZAS —————
+class MuestreoCervezas:
+    """Reserva en memoria de IDs de cerveza para sacar muestras aleatorias sin ORDER BY random().
+
+    Con pesos, cada cerveza tiene probabilidad proporcional a 1 + nº de valoraciones; las muestras
+    cuestan O(k log n) y la base de datos solo recibe una búsqueda por PK de k filas.
+    Las altas no tocan la reserva: la marcan caducada y refrescar() la reconstruye en otro hilo.
+    """
+    def __init__(self):
+        self._ids = array('I')
+        self._acumulados = []
+        self._construido = None
+        self._lock = threading.Lock()
+        self._reconstruyendo = threading.Lock()
+        self.generacion = 0
+
+    def construir(self, filas, generacion=None):
+        """Reconstruye la reserva a partir de pares (id, nº de valoraciones)"""
+        ids, acumulados, total = array('I'), [], 0
+        for cerveza_id, num_valoraciones in filas:
+            ids.append(cerveza_id)
+            total += 1 + (num_valoraciones or 0)
+            acumulados.append(total)
+        with self._lock:
+            self._ids, self._acumulados = ids, acumulados
+            # Si el catálogo cambió mientras se leían las filas, la reserva sirve pero sigue caducada
+            if generacion is None or generacion == self.generacion:
+                self._construido = time.monotonic()
+
+    def invalidar(self):
+        """El catálogo cambió: la próxima muestra que mire caducado() pedirá reconstruir"""
+        with self._lock:
+            self.generacion += 1
+            self._construido = None
+
+    def caducado(self, segundos):
+        return self._construido is None or time.monotonic() - self._construido > segundos
+
+    def refrescar(self, cargar):
+        """Reconstruye con las filas de `cargar()` en un hilo aparte, salvo que ya haya uno en marcha.
+
+        Mientras tanto las muestras salen de la reserva anterior. Devuelve si arrancó el hilo.
+        """
+        if not self._reconstruyendo.acquire(blocking=False):
+            return False
+        generacion = self.generacion
+
+        def reconstruir():
+            try:
+                self.construir(cargar(), generacion)
+            finally:
+                self._reconstruyendo.release()
+
+        threading.Thread(target=reconstruir, name='muestreo-cervezas', daemon=True).start()
+        return True
+
+    def muestra(self, k, ponderada=True):
+        """Hasta `k` IDs distintos al azar"""
+        with self._lock:
+            ids, acumulados = self._ids, self._acumulados
+        k = min(k, len(ids))
+        if not ponderada:
+            return [ids[i] for i in random.sample(range(len(ids)), k)]
+        elegidos = {}
+        while len(elegidos) < k:
+            for cerveza_id in random.choices(ids, cum_weights=acumulados, k=k - len(elegidos)):
+                elegidos[cerveza_id] = None
+        return list(elegidos)
+
+muestreo_cervezas = MuestreoCervezas()
+
+def muestreo_cervezas_filas():
+    """Pares (id, nº de valoraciones) de todo el catálogo"""
+    return db.session.query(Cerveza.id, CervezaStats.num_valoraciones).outerjoin(
+        CervezaStats, CervezaStats.cerveza_id == Cerveza.id
+    ).all()
+
+def muestreo_cervezas_construir():
+    """Carga la reserva de IDs con la popularidad actual de cada cerveza"""
+    muestreo_cervezas.construir(muestreo_cervezas_filas())
+
+def muestreo_cervezas_refrescar():
+    """Como muestreo_cervezas_construir, pero en segundo plano: la petición que lo pide no espera"""
+    def cargar():
+        with app.app_context():
+            return muestreo_cervezas_filas()
+    muestreo_cervezas.refrescar(cargar)
+
+# ————— CACHÉ DEL RANKING —————
+class CacheLRU:
+    """Caché LRU en memoria, segura entre hilos y con contadores de aciertos/fallos.
+
+    Es local a cada proceso: cada worker mantiene su propia copia y la invalida con sus escrituras.
+    Cada invalidación sube `generacion`: quien calcula un valor la lee antes de empezar y se la pasa
+    a guardar(), que lo descarta si entre medias hubo una escritura (el valor ya nació viejo).
+    """
+    def __init__(self, max_entradas):
+        self.max_entradas = max_entradas
+        self._entradas = OrderedDict()
+        self._lock = threading.Lock()
+        self.aciertos = 0
+        self.fallos = 0
+        self.expulsiones = 0
+        self.invalidaciones = 0
+        self.descartes = 0
+        self.generacion = 0
+
+    def obtener(self, clave):
+        with self._lock:
+            if clave in self._entradas:
+                self._entradas.move_to_end(clave)
+                self.aciertos += 1
+                return self._entradas[clave]
+            self.fallos += 1
+            return None
+
+    def guardar(self, clave, valor, generacion=None):
+        with self._lock:
+            if generacion is not None and generacion != self.generacion:
+                self.descartes += 1
+                return
+            self._entradas[clave] = valor
+            self._entradas.move_to_end(clave)
+            while len(self._entradas) > self.max_entradas:
+                self._entradas.popitem(last=False)
+                self.expulsiones += 1
+
+    def invalidar(self):
+        with self._lock:
+            self._entradas.clear()
+            self.invalidaciones += 1
+            self.generacion += 1
+
+    def estadisticas(self):
+        with self._lock:
+            return {
+                "entradas": len(self._entradas),
+                "max_entradas": self.max_entradas,
+                "aciertos": self.aciertos,
+                "fallos": self.fallos,
+                "expulsiones": self.expulsiones,
+                "invalidaciones": self.invalidaciones,
+                "descartes": self.descartes
+            }
+
+cache_top = CacheLRU(app.config['TOP_CACHE_MAX_ENTRADAS'])
+
+def calcular_top_degustaciones(estilo, pais):
+    """Ranking top 50 y listas de filtros para un par (estilo, país)"""
+    # Consulta base: cervezas con al menos una degustación puntuada (agregados precalculados)
+    query = db.session.query(
+        Cerveza,
+        CervezaStats.promedio,
+        CervezaStats.num_valoraciones,
+        CervezaStats.ultima_valoracion
+    ).join(CervezaStats, CervezaStats.cerveza_id == Cerveza.id)
+    
+    query = query.filter(CervezaStats.num_valoraciones > 0)
+    
+    # Aplicar filtros
+    if estilo:
+        query = query.filter(Cerveza.estilo == estilo)
+    if pais:
+        query = query.filter(Cerveza.pais_procedencia == pais)
+    
+    # Ordenar por el promedio ya calculado
+    query = query.order_by(CervezaStats.promedio.desc(), CervezaStats.num_valoraciones.desc())
+    
+    # Limitar a top 50
+    top_cervezas = query.limit(50).all()
+    
+    # Obtener lista de estilos únicos para el filtro
+    estilos = db.session.query(Cerveza.estilo).distinct().order_by(Cerveza.estilo).all()
+    estilos = [e[0] for e in estilos]
+    
+    # Obtener lista de países únicos para el filtro
+    paises = db.session.query(Cerveza.pais_procedencia).distinct().order_by(Cerveza.pais_procedencia).all()
+    paises = [p[0] for p in paises]
+    
+    # Preparar datos para template
+    cervezas_data = []
+    for cerveza, promedio, num_val, ultima_fecha in top_cervezas:
+        fecha_str = ultima_fecha.strftime('%d/%m/%Y') if ultima_fecha else 'N/A'
+        
+        cervezas_data.append({
+            'id': cerveza.id,
+            'nombre': cerveza.nombre,
+            'estilo': cerveza.estilo,
+            'pais': cerveza.pais_procedencia,
+            'alcohol': cerveza.porcentaje_alcohol,
+            'ibu': cerveza.ibu,
+            'color': cerveza.color,
+            'puntuacion_promedio': round(promedio, 2) if promedio else 0,
+            'num_valoraciones': num_val,
+            'ultima_valoracion': fecha_str
+        })
+    
+    return cervezas_data, estilos, paises
+
+# ————— IMPORTACIÓN MASIVA DE CERVEZAS —————
+IMPORTACION_LOTE = 1000  # filas por executemany
+IMPORTACION_LOTES_POR_TRANSACCION = 10  # commit cada 10.000 filas: el bloqueo de escritura dura poco
+IMPORTACION_MAX_ERRORES = 100  # errores detallados que guarda el informe (el contador sigue)
+
+_LONGITUD_CERVEZA = {c.name: c.type.length for c in Cerveza.__table__.c if isinstance(c.type, db.String)}
+
+def nombre_normalizado(nombre):
+    """Clave de duplicados: 'ESTRELLA  galicia' y 'Estrella Galicia' son la misma cerveza"""
+    return normalizar_texto(nombre) or nombre.strip().lower()
+
+def validar_cerveza(datos):
+    """Valores de una cerveza nueva a partir de un dict. Devuelve (valores, None) o (None, error)."""
+    def texto(campo):
+        valor = datos.get(campo)
+        return '' if valor is None else str(valor).strip()
+
+    nombre, estilo, pais_procedencia, color = texto('nombre'), texto('estilo'), texto('pais_procedencia'), texto('color')
+    porcentaje_alcohol, ibu = texto('porcentaje_alcohol').replace(',', '.'), texto('ibu')
+    if not nombre:
+        return None, "El nombre es obligatorio"
+    if not estilo:
+        return None, "El estilo es obligatorio"
+    if not pais_procedencia:
+        return None, "El país es obligatorio"
+    if not porcentaje_alcohol:
+        return None, "El porcentaje de alcohol es obligatorio"
+    try:
+        porcentaje_alcohol = float(porcentaje_alcohol)
+    except ValueError:
+        return None, "El porcentaje de alcohol no es un número"
+    if not 0 <= porcentaje_alcohol <= 100:
+        return None, "El porcentaje de alcohol debe estar entre 0 y 100"
+    for campo, valor in (('nombre', nombre), ('estilo', estilo), ('pais_procedencia', pais_procedencia), ('color', color)):
+        if len(valor) > _LONGITUD_CERVEZA[campo]:
+            return None, f"El campo {campo} es demasiado largo"
+    return {
+        'nombre': nombre,
+        'nombre_normalizado': nombre_normalizado(nombre),
+        'estilo': estilo,
+        'pais_procedencia': pais_procedencia,
+        'porcentaje_alcohol': porcentaje_alcohol,
+        'ibu': int(ibu) if ibu.isdigit() else None,
+        'color': color or None
+    }, None
+
+def leer_filas_importacion(flujo, formato):
+    """Itera los dicts de un flujo binario CSV (con cabecera) o NDJSON sin cargarlo entero en memoria.
+
+    Una línea NDJSON que no es un objeto JSON se entrega como None para que cuente como error.
+    """
+    texto = TextIOWrapper(flujo, encoding='utf-8-sig', newline='')
+    if formato == 'csv':
+        yield from csv.DictReader(texto)
+        return
+    cargar = orjson.loads if orjson else json.loads
+    for linea in texto:
+        if not linea.strip():
+            continue
+        try:
+            fila = cargar(linea)
+        except ValueError:
+            fila = None
+        yield fila if isinstance(fila, dict) else None
+
+class ImportacionCervezas:
+    """Importa cervezas desde un iterable de dicts con inserts executemany en transacciones acotadas.
+
+    Cada fila se valida con validar_cerveza() (las reglas de /api/cerveza/nueva) y se descarta si su
+    nombre normalizado apareció antes en el mismo fichero o ya existe en el catálogo: de eso se encarga
+    el índice único con ON CONFLICT DO NOTHING, también frente a altas que lleguen a la vez. ejecutar() es un
+    generador que entrega el informe tras cada commit, para mostrar el progreso.
+    """
+
+    def __init__(self, lote=IMPORTACION_LOTE, lotes_por_transaccion=IMPORTACION_LOTES_POR_TRANSACCION):
+        self.lote = lote
+        self.lotes_por_transaccion = lotes_por_transaccion
+        self.informe = {'leidas': 0, 'insertadas': 0, 'duplicadas': 0, 'erroneas': 0, 'errores': []}
+        self._vistos = set()
+        self._sin_confirmar = 0
+        self._fts_suspendido = False
+
+    def _error(self, fila, mensaje):
+        self.informe['erroneas'] += 1
+        if len(self.informe['errores']) < IMPORTACION_MAX_ERRORES:
+            self.informe['errores'].append({'fila': fila, 'error': mensaje})
+
+    def _insertar(self, valores):
+        """Un insert por lote que salta las filas cuyo nombre ya está en el catálogo (sin commit)"""
+        sentencia = insert_dialecto(Cerveza.__table__).on_conflict_do_nothing().returning(Cerveza.id)
+        insertadas = len(db.session.execute(sentencia, valores).all())
+        self.informe['duplicadas'] += len(valores) - insertadas
+        self._sin_confirmar += insertadas
+
+    def _confirmar(self):
+        db.session.commit()
+        self.informe['insertadas'] += self._sin_confirmar
+        self._sin_confirmar = 0
+
+    def _suspender_fts(self):
+        """Importaciones grandes: sin el trigger de alta de cerveza_fts y con una reconstrucción al final.
+
+        El trigger por fila triplica el coste de cada insert. Si el proceso muere antes de restaurarlo,
+        fts_crear() ve el trigger ausente al arrancar y reconstruye el índice.
+        """
+        if app.config['BUSQUEDA_FTS'] and not self._fts_suspendido:
+            db.session.execute(db.text('DROP TRIGGER IF EXISTS cerveza_fts_ai'))
+            self._fts_suspendido = True
+
+    def _restaurar_fts(self):
+        for sentencia in _fts_ddl('cerveza', FTS_TABLAS['cerveza']):
+            db.session.execute(db.text(sentencia))
+        fts_reconstruir('cerveza')
+        db.session.commit()
+        self._fts_suspendido = False
+
+    def ejecutar(self, filas):
+        pendientes, lotes = [], 0
+        try:
+            for numero, fila in enumerate(filas, start=1):
+                self.informe['leidas'] += 1
+                valores, error = validar_cerveza(fila) if fila is not None else (None, "La fila no es un objeto JSON")
+                if error:
+                    self._error(numero, error)
+                    continue
+                if valores['nombre_normalizado'] in self._vistos:
+                    self.informe['duplicadas'] += 1
+                    continue
+                self._vistos.add(valores['nombre_normalizado'])
+                pendientes.append(valores)
+                if len(pendientes) >= self.lote:
+                    self._insertar(pendientes)
+                    pendientes, lotes = [], lotes + 1
+                    if lotes % self.lotes_por_transaccion == 0:
+                        self._confirmar()
+                        # Pasada la primera transacción compensa reconstruir el índice FTS al final
+                        self._suspender_fts()
+                        yield self.informe
+            if pendientes:
+                self._insertar(pendientes)
+            self._confirmar()
+        except BaseException:
+            # También si quien consume el generador lo abandona a medias (GeneratorExit)
+            db.session.rollback()
+            raise
+        finally:
+            if self._fts_suspendido:
+                self._restaurar_fts()
+            # Lo ya confirmado queda en el catálogo: las estructuras en memoria se ponen al día igual
+            if self.informe['insertadas']:
+                cache_top.invalidar()
+                autocompletado.construir(db.session.query(Cerveza.id, Cerveza.nombre))
+                muestreo_cervezas_construir()
+        yield self.informe
+
+def _cerveza_nombre_normalizado(mapper, conexion, cerveza):
+    """Mantiene la clave de duplicados al día en las altas y ediciones por el ORM"""
+    cerveza.nombre_normalizado = nombre_normalizado(cerveza.nombre)
+
+event.listen(Cerveza, 'before_insert', _cerveza_nombre_normalizado)
+event.listen(Cerveza, 'before_update', _cerveza_nombre_normalizado)
+
+def cervezas_nombre_normalizado_backfill():
+    """Calcula la clave de duplicados de las cervezas que aún no la tienen (sin commit)"""
+    pendientes = db.session.query(Cerveza.id, Cerveza.nombre).filter(Cerveza.nombre_normalizado.is_(None)).all()
+    if pendientes:
+        db.session.execute(db.update(Cerveza), [
+            {'id': cerveza_id, 'nombre_normalizado': nombre_normalizado(nombre)} for cerveza_id, nombre in pendientes
+        ])
+
+# ————— EXPORTACIÓN DE DEGUSTACIONES —————
+EXPORTACION_LOTE = 1000  # filas por fetch del cursor (yield_per) y por consulta de comentarios
+EXPORTACION_TIPOS = {'csv': 'text/csv', 'ndjson': 'application/x-ndjson'}
+EXPORTACION_CAMPOS = ['id', 'fecha', 'cerveza', 'estilo', 'pais_procedencia', 'porcentaje_alcohol',
+                      'puntuacion', 'comentario', 'tamaño', 'formato', 'pais_consumicion',
+                      'local', 'local_ciudad', 'comentarios']
+
+_CSV_FORMULA = ('=', '+', '-', '@', '\t', '\r')
+
+def celda_csv(valor):
+    """Texto que una hoja de cálculo tomaría por fórmula ('=', '+', '-', '@'...) se exporta como texto con '"""
+    return "'" + valor if isinstance(valor, str) and valor.startswith(_CSV_FORMULA) else valor
+
+class _EcoCSV:
+    """Destino de csv.writer que no guarda nada: writerow() devuelve la línea ya formateada"""
+    def write(self, texto):
+        return texto
+
+def exportar_degustaciones(formato, usuario_id=None):
+    """Generador de trozos CSV o NDJSON con las degustaciones de un usuario (o de todos, sin usuario_id).
+
+    Las filas llegan del cursor en lotes de EXPORTACION_LOTE (yield_per) como tuplas, sin pasar por el
+    mapa de identidad, y los comentarios de cada lote se piden con una consulta IN: la memoria no
+    depende del tamaño del historial.
+    """
+    consulta = db.select(
+        Degustacion.id, Degustacion.fecha, Cerveza.nombre, Cerveza.estilo, Cerveza.pais_procedencia,
+        Cerveza.porcentaje_alcohol, Degustacion.puntuacion, Degustacion.comentario, Degustacion.tamaño,
+        Degustacion.formato, Degustacion.pais_consumicion, Local.nombre, Local.ciudad,
+        Degustacion.usuario_id, Usuario.nombre_usuario
+    ).join(
+        Cerveza, Degustacion.cerveza_id == Cerveza.id
+    ).outerjoin(
+        Local, Degustacion.local_id == Local.id
+    ).join(
+        Usuario, Degustacion.usuario_id == Usuario.id
+    ).where(
+        Usuario.eliminado_en.is_(None)
+    )
+    if usuario_id is None:
+        consulta = consulta.order_by(Degustacion.id)
+        campos = ['usuario_id', 'usuario'] + EXPORTACION_CAMPOS
+    else:
+        consulta = consulta.where(Degustacion.usuario_id == usuario_id).order_by(Degustacion.fecha, Degustacion.id)
+        campos = EXPORTACION_CAMPOS
+
+    escritor = csv.writer(_EcoCSV())
+    volcar = (lambda fila: orjson.dumps(fila).decode()) if orjson else (lambda fila: json.dumps(fila, ensure_ascii=False))
+    if formato == 'csv':
+        yield escritor.writerow(campos)
+
+    filas = db.session.execute(consulta.execution_options(yield_per=EXPORTACION_LOTE))
+    for lote in filas.partitions():
+        comentarios = defaultdict(list)
+        for degustacion_id, autor, texto, fecha in db.session.query(
+            ComentarioDegustacion.degustacion_id, Usuario.nombre_usuario, ComentarioDegustacion.texto, ComentarioDegustacion.fecha
+        ).join(
+            Usuario, ComentarioDegustacion.usuario_id == Usuario.id
+        ).filter(
+            ComentarioDegustacion.degustacion_id.in_([fila[0] for fila in lote]),
+            Usuario.eliminado_en.is_(None)
+        ).order_by(ComentarioDegustacion.fecha, ComentarioDegustacion.id):
+            comentarios[degustacion_id].append({'usuario': autor, 'texto': texto, 'fecha': fecha.isoformat()})
+
+        trozo = []
+        for fila in lote:
+            registro = dict(zip(EXPORTACION_CAMPOS, fila[:13]), usuario_id=fila[13], usuario=fila[14])
+            registro['fecha'] = registro['fecha'].isoformat() if registro['fecha'] else None
+            registro['comentarios'] = comentarios.get(registro['id'], [])
+            if formato == 'csv':
+                registro['comentarios'] = '\n'.join(f"{c['usuario']}: {c['texto']}" for c in registro['comentarios'])
+                # Comentarios y nombres de cervezas y locales los escriben otros usuarios
+                trozo.append(escritor.writerow([celda_csv(registro[c]) for c in campos]))
+            else:
+                trozo.append(volcar({c: registro[c] for c in campos}) + '\n')
+        yield ''.join(trozo)
+
+def respuesta_exportacion(formato, nombre, usuario_id=None):
+    """Respuesta en streaming con la exportación como fichero adjunto"""
+    return app.response_class(
+        stream_with_context(exportar_degustaciones(formato, usuario_id)),
+        mimetype=EXPORTACION_TIPOS[formato],
+        headers={'Content-Disposition': f'attachment; filename={nombre}.{formato}'}
+    )
+
+# ————— ÚLTIMA ACTIVIDAD POR USUARIO —————
+def ultima_actividad_registrar(degustacion, cerveza):
+    """Actualiza la última actividad del autor con una degustación nueva (sin commit)"""
+    actual = db.session.get(UltimaActividad, degustacion.usuario_id)
+    if actual is None:
+        actual = UltimaActividad(usuario_id=degustacion.usuario_id)
+        db.session.add(actual)
+    elif actual.fecha and sin_zona(degustacion.fecha) < sin_zona(actual.fecha):
+        return
+    actual.degustacion_id = degustacion.id
+    actual.cerveza_nombre = cerveza.nombre
+    actual.cerveza_estilo = cerveza.estilo
+    actual.puntuacion = degustacion.puntuacion
+    actual.comentario = degustacion.comentario
+    actual.fecha = degustacion.fecha
+
+def ultima_actividad_backfill():
+    """Migración: regenera UltimaActividad para todos los usuarios (sin commit). Devuelve el nº de filas."""
+    UltimaActividad.query.delete()
+    orden = db.func.row_number().over(
+        partition_by=Degustacion.usuario_id,
+        order_by=(Degustacion.fecha.desc(), Degustacion.id.desc())
+    ).label('orden')
+    ultimas = db.select(Degustacion.id, orden).subquery()
+    origen = db.select(
+        Degustacion.usuario_id, Degustacion.id, Cerveza.nombre, Cerveza.estilo,
+        Degustacion.puntuacion, Degustacion.comentario, Degustacion.fecha
+    ).join(
+        ultimas, ultimas.c.id == Degustacion.id
+    ).join(
+        Cerveza, Degustacion.cerveza_id == Cerveza.id
+    ).where(ultimas.c.orden == 1)
+    db.session.execute(
+        db.insert(UltimaActividad).from_select(
+            ['usuario_id', 'degustacion_id', 'cerveza_nombre', 'cerveza_estilo',
+             'puntuacion', 'comentario', 'fecha'], origen
+        )
+    )
+    return UltimaActividad.query.count()
+
+# ————— TIMELINE DE AMIGOS (FAN-OUT EN ESCRITURA) —————
+def timeline_publicar(degustacion, amigos_ids=None):
+    """Copia una degustación recién creada a la bandeja de cada amigo del autor.
+
+    Se llama antes del commit para que la degustación y su fan-out vayan en la misma transacción.
+    Con varias degustaciones del mismo autor se le pueden pasar sus `amigos_ids` ya consultados.
+    """
+    if not app.config['TIMELINE_ENABLED']:
+        return
+    if amigos_ids is None:
+        amigos_ids = amigos_ids_de(degustacion.usuario_id)
+    for amigo_id in amigos_ids:
+        db.session.add(TimelineEntrada(
+            usuario_id=amigo_id,
+            degustacion_id=degustacion.id,
+            autor_id=degustacion.usuario_id,
+            fecha=degustacion.fecha
+        ))
+
+def _timeline_copiar_historial(destinatario_id, autor_id, limite=None):
+    """INSERT ... SELECT de las degustaciones de `autor_id` en la bandeja de `destinatario_id`"""
+    origen = db.select(
+        db.literal(destinatario_id), Degustacion.id, Degustacion.usuario_id, Degustacion.fecha
+    ).where(Degustacion.usuario_id == autor_id).order_by(Degustacion.fecha.desc())
+    if limite:
+        origen = origen.limit(limite)
+    db.session.execute(
+        db.insert(TimelineEntrada).from_select(
+            ['usuario_id', 'degustacion_id', 'autor_id', 'fecha'], origen
+        )
+    )
+
+def timeline_rellenar(usuario_a, usuario_b):
+    """Rellena las bandejas de dos usuarios que acaban de hacerse amigos"""
+    if not app.config['TIMELINE_ENABLED']:
+        return
+    timeline_recortar(usuario_a, usuario_b)
+    limite = app.config['TIMELINE_BACKFILL']
+    _timeline_copiar_historial(usuario_a, usuario_b, limite)
+    _timeline_copiar_historial(usuario_b, usuario_a, limite)
+
+def timeline_recortar(usuario_a, usuario_b):
+    """Quita de cada bandeja las entradas del otro usuario cuando dejan de ser amigos"""
+    if not app.config['TIMELINE_ENABLED']:
+        return
+    TimelineEntrada.query.filter(
+        ((TimelineEntrada.usuario_id == usuario_a) & (TimelineEntrada.autor_id == usuario_b)) |
+        ((TimelineEntrada.usuario_id == usuario_b) & (TimelineEntrada.autor_id == usuario_a))
+    ).delete(synchronize_session=False)
+
+def timeline_reconstruir():
+    """Regenera todas las bandejas a partir de Amistad y Degustacion. Devuelve el nº de entradas.
+
+    Deja lo mismo que timeline_rellenar más el fan-out: de cada amigo, sus TIMELINE_BACKFILL
+    degustaciones más recientes de antes de la amistad (la fecha de la arista) y todas las posteriores.
+    """
+    TimelineEntrada.query.delete()
+    columnas = ['usuario_id', 'degustacion_id', 'autor_id', 'fecha']
+    limite = app.config['TIMELINE_BACKFILL']
+    amigos = Degustacion.usuario_id == AmistadArista.amigo_id
+    origen = db.select(
+        AmistadArista.usuario_id, Degustacion.id, Degustacion.usuario_id, Degustacion.fecha
+    ).join(AmistadArista, amigos)
+    if limite:
+        anteriores = Degustacion.fecha <= AmistadArista.fecha
+        orden = db.func.row_number().over(
+            partition_by=(AmistadArista.usuario_id, AmistadArista.amigo_id),
+            order_by=Degustacion.fecha.desc()
+        ).label('orden')
+        historial = origen.add_columns(orden).where(anteriores).subquery()
+        db.session.execute(db.insert(TimelineEntrada).from_select(
+            columnas, db.select(*list(historial.c)[:4]).where(historial.c.orden <= limite)
+        ))
+        origen = origen.where(db.not_(anteriores))
+    db.session.execute(db.insert(TimelineEntrada).from_select(columnas, origen))
+    db.session.commit()
+    return TimelineEntrada.query.count()
+
+# ————— GALARDONES —————
+# Cada galardón cuenta una métrica por usuario y sube de nivel al cruzar cada umbral.
+# Los contadores se actualizan con cada evento (degustación, comentario, amistad aceptada),
+# así que conceder un nivel nunca recorre el historial del usuario.
+GALARDONES = {
+    'Catador': ('degustaciones', (1, 10, 50, 100, 500), 'Degustaciones registradas'),
+    'Explorador de estilos': ('estilos', (3, 10, 25, 50), 'Estilos de cerveza distintos probados'),
+    'Trotamundos': ('paises', (2, 5, 10, 20), 'Países de procedencia distintos probados'),
+    'Buena compañía': ('amigos', (1, 5, 20, 50), 'Amigos en BeerSp'),
+    'Conversador': ('comentarios', (1, 10, 50, 200), 'Comentarios en degustaciones'),
+}
+GALARDONES_POR_PAGINA = 10
+
+def galardones_sembrar():
+    """Crea en la tabla Galardon los galardones definidos en GALARDONES que aún no existan (sin commit)"""
+    existentes = {nombre for (nombre,) in db.session.query(Galardon.nombre)}
+    for nombre, (_, _, descripcion) in GALARDONES.items():
+        if nombre not in existentes:
+            db.session.add(Galardon(nombre=nombre, descripcion=descripcion))
+
+def galardon_nivel(nombre, valor):
+    """Nivel alcanzado con `valor` (0 si aún no llega al primer umbral) y umbral del siguiente nivel"""
+    umbrales = GALARDONES[nombre][1]
+    nivel = bisect.bisect_right(umbrales, valor)
+    return nivel, umbrales[nivel] if nivel < len(umbrales) else None
+
+def galardones_conceder(usuario_id, metrica, valor):
+    """Concede o sube de nivel los galardones de `metrica` para `valor`. Devuelve los nuevos (sin commit)."""
+    nuevos = []
+    for nombre, (metrica_galardon, _, _) in GALARDONES.items():
+        if metrica_galardon != metrica:
+            continue
+        nivel, _ = galardon_nivel(nombre, valor)
+        if not nivel:
+            continue
+        galardon_id = db.session.query(Galardon.id).filter_by(nombre=nombre).scalar()
+        if galardon_id is None:
+            galardon = Galardon(nombre=nombre, descripcion=GALARDONES[nombre][2])
+            db.session.add(galardon)
+            db.session.flush()
+            galardon_id = galardon.id
+        # Upsert: dos eventos simultáneos del mismo usuario no chocan con la restricción única.
+        # Los niveles ganados no se pierden aunque el contador baje (p. ej. al quitar un amigo).
+        alta = insert_dialecto(UsuarioGalardon).values(
+            usuario_id=usuario_id, galardon_id=galardon_id, nivel=nivel, fecha_obtenido=datetime.now(timezone.utc)
+        )
+        subido = db.session.execute(alta.on_conflict_do_update(
+            index_elements=['usuario_id', 'galardon_id'],
+            set_={'nivel': alta.excluded.nivel, 'fecha_obtenido': alta.excluded.fecha_obtenido},
+            where=UsuarioGalardon.nivel < alta.excluded.nivel
+        ).returning(UsuarioGalardon.id)).first()
+        if subido:
+            nuevos.append({'nombre': nombre, 'nivel': nivel})
+    return nuevos
+
+def galardones_progresar(usuario_id, metrica, delta=1, distinto=None):
+    """Suma `delta` al contador de `metrica` y concede los niveles alcanzados (sin commit).
+
+    Con `distinto` (un estilo, un país) solo suma si el usuario no lo había contado ya.
+    """
+    # Upserts: los primeros eventos de un usuario pueden llegar a la vez (dos pestañas, un amigo que acepta)
+    if distinto is not None:
+        nuevo = db.session.execute(insert_dialecto(ProgresoDistinto).values(
+            usuario_id=usuario_id, metrica=metrica, valor=distinto
+        ).on_conflict_do_nothing()).rowcount
+        if not nuevo:
+            return []
+    alta = insert_dialecto(ProgresoGalardon).values(usuario_id=usuario_id, metrica=metrica, valor=max(delta, 0))
+    valor = db.session.execute(alta.on_conflict_do_update(
+        index_elements=['usuario_id', 'metrica'],
+        set_={'valor': ProgresoGalardon.valor + delta}
+    ).returning(ProgresoGalardon.valor)).scalar()
+    return galardones_conceder(usuario_id, metrica, valor) if delta > 0 else []
+
+def galardones_degustacion(degustacion, cerveza):
+    """Progreso de galardones por una degustación nueva (sin commit)"""
+    usuario_id = degustacion.usuario_id
+    nuevos = galardones_progresar(usuario_id, 'degustaciones')
+    if cerveza.estilo:
+        nuevos += galardones_progresar(usuario_id, 'estilos', distinto=cerveza.estilo)
+    if cerveza.pais_procedencia:
+        nuevos += galardones_progresar(usuario_id, 'paises', distinto=cerveza.pais_procedencia)
+    return nuevos
+
+def galardones_backfill(lote=500, desde_id=0, commit_por_lote=True):
+    """Recalcula los contadores desde el historial, por lotes de usuarios con commit por lote.
+
+    Cada lote borra y reescribe sus contadores, así que repetirlo o reanudarlo con `desde_id`
+    es seguro. Con `commit_por_lote=False` (la migración) todo queda en la transacción en curso.
+    Devuelve el nº de usuarios procesados.
+    """
+    procesados = 0
+    while True:
+        ids = [i for (i,) in db.session.query(Usuario.id).filter(Usuario.id > desde_id)
+               .order_by(Usuario.id).limit(lote)]
+        if not ids:
+            return procesados
+        ProgresoGalardon.query.filter(ProgresoGalardon.usuario_id.in_(ids)).delete(synchronize_session=False)
+        ProgresoDistinto.query.filter(ProgresoDistinto.usuario_id.in_(ids)).delete(synchronize_session=False)
+
+        # Valores distintos de estilo y país por usuario, con una consulta por métrica
+        for metrica, columna in (('estilos', Cerveza.estilo), ('paises', Cerveza.pais_procedencia)):
+            db.session.execute(db.insert(ProgresoDistinto).from_select(
+                ['usuario_id', 'metrica', 'valor'],
+                db.select(Degustacion.usuario_id, db.literal(metrica), columna).distinct().join(
+                    Cerveza, Degustacion.cerveza_id == Cerveza.id
+                ).where(Degustacion.usuario_id.in_(ids), columna.isnot(None))
+            ))
+        conteos = [
+            db.select(Degustacion.usuario_id, db.literal('degustaciones'), db.func.count())
+              .where(Degustacion.usuario_id.in_(ids)).group_by(Degustacion.usuario_id),
+            db.select(ProgresoDistinto.usuario_id, ProgresoDistinto.metrica, db.func.count())
+              .where(ProgresoDistinto.usuario_id.in_(ids))
+              .group_by(ProgresoDistinto.usuario_id, ProgresoDistinto.metrica),
+            db.select(AmistadArista.usuario_id, db.literal('amigos'), db.func.count())
+              .where(AmistadArista.usuario_id.in_(ids)).group_by(AmistadArista.usuario_id),
+            db.select(ComentarioDegustacion.usuario_id, db.literal('comentarios'), db.func.count())
+              .where(ComentarioDegustacion.usuario_id.in_(ids)).group_by(ComentarioDegustacion.usuario_id),
+        ]
+        for usuario_id, metrica, valor in db.session.execute(db.union_all(*conteos)):
+            db.session.add(ProgresoGalardon(usuario_id=usuario_id, metrica=metrica, valor=valor))
+            galardones_conceder(usuario_id, metrica, valor)
+        if commit_por_lote:
+            db.session.commit()
+        procesados += len(ids)
+        desde_id = ids[-1]
+
+# ————— BORRADO DE CUENTAS EN SEGUNDO PLANO —————
+class BorradorCuentas:
+    """Borra en segundo plano los datos de las cuentas eliminadas, por fases y en lotes pequeños.
+
+    eliminar_cuenta solo marca la cuenta (Usuario.eliminado_en), que desde ese momento no aparece en
+    búsquedas, amigos, feeds ni comentarios, y encola un BorradoCuenta. Cada lote borra como mucho
+    BORRADO_LOTE filas y guarda la fase y el total borrado en el mismo commit: el bloqueo de escritura
+    dura poco y, si el proceso muere, el trabajo se retoma en su fase cuando vence la reserva (borrar
+    lo que quede de una fase es idempotente). Las fases van de fuera hacia dentro: primero lo que
+    podría añadir filas nuevas (amistades), al final la propia fila del usuario.
+    """
+    RESERVA_SEGUNDOS = 300
+    FASES = ('amistades', 'timeline', 'comentarios', 'actividad', 'degustaciones', 'galardones', 'foto', 'cuenta')
+
+    def __init__(self, app):
+        self.app = app
+        self._evento = threading.Event()
+        self._lock = threading.Lock()
+        self._hilo = None
+        self.metricas = Counter()
+
+    def despertar(self):
+        """Arranca el hilo si hace falta y le avisa de que hay trabajo"""
+        if not self.app.config['BORRADO_HILO']:
+            return
+        with self._lock:
+            if self._hilo is None or not self._hilo.is_alive():
+                self._hilo = threading.Thread(target=self._bucle, name='borrador-cuentas', daemon=True)
+                self._hilo.start()
+        self._evento.set()
+
+    def _bucle(self):
+        while True:
+            self._evento.wait(timeout=self.app.config['BORRADO_INTERVALO_SEGUNDOS'])
+            self._evento.clear()
+            with self.app.app_context():
+                try:
+                    while self.procesar():
+                        pass
+                except Exception as e:
+                    db.session.rollback()
+                    print(f"❌ Error en el borrador de cuentas: {e}")
+                finally:
+                    db.session.remove()
+
+    def _reservar(self):
+        """Reserva con un UPDATE condicional el trabajo más antiguo que nadie esté ejecutando"""
+        ahora = datetime.now(timezone.utc)
+        disponibles = (BorradoCuenta.estado.in_(('pendiente', 'borrando')),
+                       db.or_(BorradoCuenta.reservado_hasta.is_(None), BorradoCuenta.reservado_hasta <= ahora))
+        candidatos = [i for (i,) in db.session.query(BorradoCuenta.id).filter(*disponibles)
+                      .order_by(BorradoCuenta.id).limit(10)]
+        for borrado_id in candidatos:
+            if BorradoCuenta.query.filter(BorradoCuenta.id == borrado_id, *disponibles).update({
+                'estado': 'borrando',
+                'reservado_hasta': ahora + timedelta(seconds=self.RESERVA_SEGUNDOS),
+            }, synchronize_session=False):
+                db.session.commit()
+                return db.session.get(BorradoCuenta, borrado_id)
+        db.session.commit()
+        return None
+
+    @staticmethod
+    def _ids(columna, filtro, lote):
+        return [i for (i,) in db.session.query(columna).filter(filtro).limit(lote)]
+
+    @staticmethod
+    def _borrar(modelo, ids):
+        return modelo.query.filter(modelo.id.in_(ids)).delete(synchronize_session=False) if ids else 0
+
+    # Cada fase borra un lote (sin commit) y devuelve cuántas filas borró; 0 significa fase terminada
+
+    def _fase_amistades(self, usuario_id, lote):
+        amigos = [i for (i,) in db.session.query(AmistadArista.amigo_id).filter_by(usuario_id=usuario_id).limit(lote)]
+        if amigos:
+            # Cada amigo pierde uno en el contador de su galardón
+            ProgresoGalardon.query.filter(
+                ProgresoGalardon.metrica == 'amigos', ProgresoGalardon.usuario_id.in_(amigos)
+            ).update({ProgresoGalardon.valor: ProgresoGalardon.valor - 1}, synchronize_session=False)
+            return sum(consulta.delete(synchronize_session=False) for consulta in (
+                AmistadArista.query.filter(AmistadArista.usuario_id == usuario_id, AmistadArista.amigo_id.in_(amigos)),
+                AmistadArista.query.filter(AmistadArista.usuario_id.in_(amigos), AmistadArista.amigo_id == usuario_id),
+                Amistad.query.filter(Amistad.usuario_id == usuario_id, Amistad.amigo_id.in_(amigos)),
+                Amistad.query.filter(Amistad.usuario_id.in_(amigos), Amistad.amigo_id == usuario_id),
+            ))
+        # Solicitudes pendientes o rechazadas, en cualquier sentido
+        return self._borrar(Amistad, self._ids(Amistad.id, Amistad.usuario_id == usuario_id, lote)
+                            or self._ids(Amistad.id, Amistad.amigo_id == usuario_id, lote))
+
+    def _fase_timeline(self, usuario_id, lote):
+        return self._borrar(TimelineEntrada, self._ids(TimelineEntrada.id, TimelineEntrada.usuario_id == usuario_id, lote)
+                            or self._ids(TimelineEntrada.id, TimelineEntrada.autor_id == usuario_id, lote))
+
+    def _fase_comentarios(self, usuario_id, lote):
+        # Primero los de cualquiera en mis degustaciones (con foreign_keys=ON bloquearían su borrado)
+        mis_degustaciones = db.session.query(Degustacion.id).filter_by(usuario_id=usuario_id)
+        filas = db.session.query(ComentarioDegustacion.id, ComentarioDegustacion.usuario_id).filter(
+            ComentarioDegustacion.degustacion_id.in_(mis_degustaciones)).limit(lote).all()
+        if not filas:
+            return self._borrar(ComentarioDegustacion, self._ids(ComentarioDegustacion.id, ComentarioDegustacion.usuario_id == usuario_id, lote))
+        # Como en las amistades: cada autor pierde en su contador los comentarios que se le borran
+        por_autor = Counter(autor_id for _, autor_id in filas if autor_id != usuario_id)
+        autores_por_cantidad = defaultdict(list)
+        for autor_id, cantidad in por_autor.items():
+            autores_por_cantidad[cantidad].append(autor_id)
+        for cantidad, autores in autores_por_cantidad.items():
+            ProgresoGalardon.query.filter(
+                ProgresoGalardon.metrica == 'comentarios', ProgresoGalardon.usuario_id.in_(autores)
+            ).update({ProgresoGalardon.valor: ProgresoGalardon.valor - cantidad}, synchronize_session=False)
+        return self._borrar(ComentarioDegustacion, [comentario_id for comentario_id, _ in filas])
+
+    def _fase_actividad(self, usuario_id, lote):
+        # La última actividad apunta a una degustación: tiene que irse antes que ellas
+        borradas = UltimaActividad.query.filter_by(usuario_id=usuario_id).delete(synchronize_session=False)
+        return borradas + self._borrar(Favorita, self._ids(Favorita.id, Favorita.usuario_id == usuario_id, lote))
+
+    def _fase_degustaciones(self, usuario_id, lote):
+        filas = db.session.query(Degustacion.id, Degustacion.cerveza_id).filter_by(usuario_id=usuario_id).limit(lote).all()
+        borradas = self._borrar(Degustacion, [degustacion_id for degustacion_id, _ in filas])
+        # Los agregados de las cervezas afectadas se corrigen en el mismo commit que el lote
+        cerveza_stats_recalcular({cerveza_id for _, cerveza_id in filas})
+        return borradas
+
+    def _fase_galardones(self, usuario_id, lote):
+        borradas = self._borrar(UsuarioGalardon, self._ids(UsuarioGalardon.id, UsuarioGalardon.usuario_id == usuario_id, lote))
+        if borradas:
+            return borradas
+        distintos = db.session.query(ProgresoDistinto.metrica, ProgresoDistinto.valor).filter_by(usuario_id=usuario_id).limit(lote).all()
+        if distintos:
+            return ProgresoDistinto.query.filter(
+                ProgresoDistinto.usuario_id == usuario_id,
+                db.tuple_(ProgresoDistinto.metrica, ProgresoDistinto.valor).in_([tuple(fila) for fila in distintos])
+            ).delete(synchronize_session=False)
+        return ProgresoGalardon.query.filter_by(usuario_id=usuario_id).delete(synchronize_session=False)
+
+    def _fase_foto(self, usuario_id, lote):
+        usuario = db.session.get(Usuario, usuario_id)
+        if not usuario or not usuario.foto:
+            return 0
+        # Los ficheros se borran antes del commit: si el proceso muere aquí, se repite sin efecto
+        foto, usuario.foto = usuario.foto, None
+        db.session.flush()
+        foto_borrar(foto)
+        return 1
+
+    def _fase_cuenta(self, usuario_id, lote):
+        return Usuario.query.filter_by(id=usuario_id).delete(synchronize_session=False)
+
+    def procesar(self, lote=None):
+        """Ejecuta hasta el final un trabajo reservado, con un commit por lote. Devuelve el trabajo o None."""
+        borrado = self._reservar()
+        if not borrado:
+            return None
+        lote = lote or self.app.config['BORRADO_LOTE']
+        try:
+            while borrado.estado != 'terminado':
+                borradas = getattr(self, f'_fase_{borrado.fase}')(borrado.usuario_id, lote)
+                borrado.filas_borradas += borradas
+                if not borradas:
+                    posicion = self.FASES.index(borrado.fase) + 1
+                    if posicion < len(self.FASES):
+                        borrado.fase = self.FASES[posicion]
+                    else:
+                        borrado.estado = 'terminado'
+                        borrado.fecha_fin = datetime.now(timezone.utc)
+                borrado.reservado_hasta = (None if borrado.estado == 'terminado'
+                                           else datetime.now(timezone.utc) + timedelta(seconds=self.RESERVA_SEGUNDOS))
+                db.session.commit()
+                self.metricas['lotes'] += 1
+                self.metricas['filas'] += borradas
+        except Exception as e:
+            # Se reintenta más tarde repasando todas las fases, por si el fallo dejó filas atrás
+            db.session.rollback()
+            borrado.estado = 'pendiente'
+            borrado.fase = self.FASES[0]
+            borrado.ultimo_error = str(e)[:500]
+            borrado.reservado_hasta = datetime.now(timezone.utc) + timedelta(seconds=self.app.config['BORRADO_INTERVALO_SEGUNDOS'])
+            db.session.commit()
+            self.metricas['errores'] += 1
+            print(f"❌ Error borrando la cuenta {borrado.usuario_id}: {e}")
+            return borrado
+        self.metricas['terminados'] += 1
+        cache_top.invalidar()
+        print(f"🗑️ Cuenta {borrado.usuario_id} borrada: {borrado.filas_borradas} filas")
+        return borrado
+
+    def estadisticas(self):
+        por_estado = dict(db.session.query(BorradoCuenta.estado, db.func.count(BorradoCuenta.id))
+                          .group_by(BorradoCuenta.estado).all())
+        en_curso = BorradoCuenta.query.filter(BorradoCuenta.estado != 'terminado').order_by(BorradoCuenta.id).limit(50)
+        return {
+            "encolados": self.metricas['encolados'],
+            "terminados": self.metricas['terminados'],
+            "lotes": self.metricas['lotes'],
+            "filas_borradas": self.metricas['filas'],
+            "errores": self.metricas['errores'],
+            "trabajos": {estado: por_estado.get(estado, 0) for estado in ('pendiente', 'borrando', 'terminado')},
+            "en_curso": [{
+                "usuario_id": b.usuario_id,
+                "estado": b.estado,
+                "fase": b.fase,
+                "fases_completadas": self.FASES.index(b.fase),
+                "filas_borradas": b.filas_borradas,
+                "ultimo_error": b.ultimo_error,
+            } for b in en_curso],
+        }
+
+borrador_cuentas = BorradorCuentas(app)
+
+def encolar_borrado_cuenta(usuario):
+    """Marca la cuenta como eliminada (deja de verse al momento) y encola el borrado de sus datos.
+
+    El nombre de usuario y el correo se liberan ya para que puedan volver a registrarse: se sustituyen
+    por una lápida con espacio inicial, que registro() nunca produce porque recorta los campos.
+    """
+    usuario.eliminado_en = datetime.now(timezone.utc)
+    usuario.nombre_usuario = f" eliminado-{usuario.id}"
+    usuario.correo = f" eliminado-{usuario.id}@invalid"
+    if not BorradoCuenta.query.filter_by(usuario_id=usuario.id).first():
+        db.session.add(BorradoCuenta(usuario_id=usuario.id, fase=BorradorCuentas.FASES[0]))
+    db.session.commit()
+    borrador_cuentas.metricas['encolados'] += 1
+    borrador_cuentas.despertar()
+
 # ————— RUTAS PÚBLICAS (NO USAN DECORADOR) —————
 
 @app.route('/')
@@ -308,7 +2535,7 @@ def registro():
         nuevo_usuario = Usuario(
             nombre_usuario=nombre_usuario,
             correo=correo,
-            contraseña_hash=generate_password_hash(contraseña),
+            contraseña_hash=hash_contraseñas.generar(contraseña),
             fecha_nacimiento=fecha_nac,
             verificado=False
         )
@@ -360,13 +2587,17 @@ def login():
         contraseña = request.form['contraseña']
         usuario = Usuario.query.filter_by(nombre_usuario=nombre_usuario).first()
 
-        if not usuario:
+        if not usuario or usuario.eliminado_en:
             flash("Usuario no encontrado.", "error")
         elif not usuario.verificado:
             flash("Por favor, verifica tu cuenta antes de iniciar sesión.", "error")
-        elif not check_password_hash(usuario.contraseña_hash, contraseña):
+        elif not hash_contraseñas.verificar(usuario.contraseña_hash, contraseña):
             flash("Contraseña incorrecta.", "error")
         else:
+            # Hashes de antes de cambiar HASH_METODO: se actualizan ahora que tenemos la contraseña
+            if hash_contraseñas.necesita_rehash(usuario.contraseña_hash):
+                usuario.contraseña_hash = hash_contraseñas.generar(contraseña)
+                db.session.commit()
             session['user_id'] = usuario.id
             flash(f"¡Bienvenido, {usuario.nombre_usuario}!", "success")
             return redirect(url_for('inicio'))
@@ -379,7 +2610,7 @@ def olvide_contrasena():
         correo = request.form['correo'].strip()
         usuario = Usuario.query.filter_by(correo=correo).first()
         
-        if usuario:
+        if usuario and not usuario.eliminado_en:
             if enviar_correo_restablecimiento(correo):
                 flash("Se ha enviado un enlace de restablecimiento a tu correo.", "success")
             else:
@@ -400,7 +2631,7 @@ def restablecer_contrasena(token):
         return redirect(url_for('olvide_contrasena'))
 
     usuario = Usuario.query.filter_by(correo=correo).first()
-    if not usuario:
+    if not usuario or usuario.eliminado_en:
         flash("Usuario no encontrado.", "error")
         return redirect(url_for('olvide_contrasena'))
 
@@ -416,7 +2647,7 @@ def restablecer_contrasena(token):
             flash("La contraseña debe tener al menos 6 caracteres.", "error")
             return render_template('restablecer.html', token=token)
         
-        usuario.contraseña_hash = generate_password_hash(contraseña_nueva)
+        usuario.contraseña_hash = hash_contraseñas.generar(contraseña_nueva)
         db.session.commit()
         
         flash("Tu contraseña ha sido actualizada correctamente. Ya puedes iniciar sesión.", "success")
@@ -451,23 +2682,19 @@ def inicio():
     
     solicitudes_amistad = Amistad.query.filter_by(amigo_id=usuario_id, estado='pendiente').count()
 
-    amigos_ids_1 = db.session.query(Amistad.amigo_id).filter_by(usuario_id=usuario_id, estado='aceptado')
-    amigos_ids_2 = db.session.query(Amistad.usuario_id).filter_by(amigo_id=usuario_id, estado='aceptado')
-    amigos_ids = {r[0] for r in amigos_ids_1.union(amigos_ids_2)}
+    amigos_ids = amigos_ids_de(usuario_id)
 
+    # Los 5 amigos con actividad más reciente, en una sola consulta
     amigos_activos = []
-    for amigo_id in list(amigos_ids)[:5]:
-        amigo = db.session.get(Usuario, amigo_id)
-        ultima_deg = Degustacion.query.filter_by(usuario_id=amigo_id).order_by(Degustacion.fecha.desc()).first()
-        if ultima_deg and amigo:
-            cerveza = db.session.get(Cerveza, ultima_deg.cerveza_id)
-            if cerveza:
-                amigos_activos.append({
-                    'id': amigo.id,
-                    'nombre_usuario': amigo.nombre_usuario,
-                    'foto': amigo.foto,
-                    'ultima_cerveza': cerveza.nombre
-                })
+    if amigos_ids:
+        recientes = db.session.query(Usuario, UltimaActividad).join(
+            UltimaActividad, UltimaActividad.usuario_id == Usuario.id
+        ).filter(
+            Usuario.id.in_(amigos_ids),
+            Usuario.eliminado_en.is_(None)
+        ).order_by(UltimaActividad.fecha.desc()).limit(5).all()
+        for amigo, actividad in recientes:
+            amigos_activos.append(dict(usuario_json(amigo), ultima_cerveza=actividad.cerveza_nombre))
 
     degustaciones_altas = Degustacion.query.filter(
         Degustacion.usuario_id == usuario_id,
@@ -516,42 +2743,45 @@ def inicio():
 def buscar_cervezas():
     q = request.args.get('q', '').strip()
     if not q:
-        cervezas = Cerveza.query.order_by(db.func.random()).limit(8).all()
+        # Muestra desde la reserva en memoria; los pesos de popularidad se refrescan de vez en cuando
+        if muestreo_cervezas.caducado(app.config['SUGERENCIAS_REFRESCO_SEGUNDOS']):
+            muestreo_cervezas_refrescar()
+        ids = muestreo_cervezas.muestra(8, ponderada=app.config['SUGERENCIAS_POR_POPULARIDAD'])
+        por_id = {c.id: c for c in Cerveza.query.filter(Cerveza.id.in_(ids))}
+        cervezas = [por_id[i] for i in ids if i in por_id]
         return jsonify({
             "cervezas": [
-                {
-                    "id": c.id,
-                    "nombre": c.nombre,
-                    "estilo": c.estilo,
-                    "pais_procedencia": c.pais_procedencia,
-                    "porcentaje_alcohol": c.porcentaje_alcohol,
-                    "ibu": c.ibu,
-                    "color": c.color
-                } for c in cervezas
+                cerveza_json(c) for c in cervezas
             ],
             "query": ""
         })
     else:
-        cervezas = Cerveza.query.filter(
-            (Cerveza.nombre.ilike(f"%{q}%")) |
-            (Cerveza.estilo.ilike(f"%{q}%"))
-        ).limit(10).all()
+        if app.config['BUSQUEDA_FTS']:
+            cervezas = buscar_cervezas_fts(q)
+        else:
+            cervezas = buscar_cervezas_like(q)
         
         return jsonify({
             "cervezas": [
-                {
-                    "id": c.id,
-                    "nombre": c.nombre,
-                    "estilo": c.estilo,
-                    "pais_procedencia": c.pais_procedencia,
-                    "porcentaje_alcohol": c.porcentaje_alcohol,
-                    "ibu": c.ibu,
-                    "color": c.color
-                } for c in cervezas
+                cerveza_json(c) for c in cervezas
             ],
             "query": q
         })
     
+@app.route('/api/cervezas/sugerir')
+@requiere_sesion
+def sugerir_cervezas():
+    """Autocompletado de nombres de cerveza servido desde memoria, sin tocar la base de datos"""
+    q = request.args.get('q', '').strip()
+    try:
+        limite = min(int(request.args.get('limite', 8)), 20)
+    except ValueError:
+        limite = 8
+    return jsonify({
+        "sugerencias": [{"id": cerveza_id, "nombre": nombre} for cerveza_id, nombre in autocompletado.sugerir(q, limite)],
+        "query": q
+    })
+
 @app.route('/cervezas_por_ids')
 @requiere_sesion
 def cervezas_por_ids():
@@ -563,15 +2793,7 @@ def cervezas_por_ids():
         cervezas = Cerveza.query.filter(Cerveza.id.in_(ids)).all()
         return jsonify({
             "cervezas": [
-                {
-                    "id": c.id,
-                    "nombre": c.nombre,
-                    "estilo": c.estilo,
-                    "pais_procedencia": c.pais_procedencia,
-                    "porcentaje_alcohol": c.porcentaje_alcohol,
-                    "ibu": c.ibu,
-                    "color": c.color
-                } for c in cervezas
+                cerveza_json(c) for c in cervezas
             ]
         })
     except Exception as e:
@@ -621,18 +2843,10 @@ def mis_favoritas():
     if not favoritas_ids:
         return jsonify({"cervezas": []})
 
-    cervezas = Cerveza.query.filter(Cerveza.id.in_(favoritas_ids)).all()
+    cervezas = Cerveza.query.filter(Cerveza.id.in_(favoritas_ids)).order_by(Cerveza.id).all()
     return jsonify({
         "cervezas": [
-            {
-                "id": c.id,
-                "nombre": c.nombre,
-                "estilo": c.estilo,
-                "pais_procedencia": c.pais_procedencia,
-                "porcentaje_alcohol": c.porcentaje_alcohol,
-                "ibu": c.ibu,
-                "color": c.color
-            } for c in cervezas
+            cerveza_json(c) for c in cervezas
         ]
     })
 
@@ -641,17 +2855,68 @@ def mis_favoritas():
 @app.route('/api/locales')
 @requiere_sesion
 def api_locales():
-    locales = Local.query.order_by(Local.nombre).all()
+    """Locales paginados con cursor. Filtros combinables: q (nombre o ciudad), bbox=sur,oeste,norte,este
+    y lat/lon/radio_km. Con radio se ordenan por distancia; si no, por nombre."""
+    try:
+        limite = int(request.args.get('limite', LOCALES_POR_PAGINA))
+        bbox = request.args.get('bbox')
+        caja = tuple(float(v) for v in bbox.split(',')) if bbox else None
+        centro = None
+        if 'lat' in request.args or 'lon' in request.args:
+            centro = (float(request.args['lat']), float(request.args['lon']),
+                      float(request.args.get('radio_km', LOCALES_RADIO_KM)))
+    except (KeyError, ValueError):
+        return jsonify({"success": False, "message": "Parámetros inválidos"}), 400
+    limite = max(1, min(limite, LOCALES_MAX_POR_PAGINA))
+    if caja and (len(caja) != 4 or not (-90 <= caja[0] <= caja[2] <= 90)
+                 or not all(-180 <= v <= 180 for v in caja[1::2])):
+        return jsonify({"success": False, "message": "bbox debe ser sur,oeste,norte,este"}), 400
+    if centro and not (-90 <= centro[0] <= 90 and -180 <= centro[1] <= 180 and 0 < centro[2] <= LOCALES_RADIO_MAX_KM):
+        return jsonify({"success": False, "message": "Coordenadas o radio inválidos"}), 400
+    
+    cursor = request.args.get('cursor')
+    posicion = None
+    if cursor:
+        posicion = decodificar_cursor_clave(cursor)
+        if not posicion:
+            return jsonify({"success": False, "message": "Cursor inválido"}), 400
+    
+    query = Local.query
+    q = request.args.get('q', '').strip()
+    if q:
+        query = query.filter(filtro_busqueda_locales(q))
+    if caja:
+        query = query.filter(filtro_caja_locales(*caja))
+    
+    if centro:
+        # Candidatos de la caja que envuelve el círculo (acotados por el índice); se ordenan en memoria
+        latitud, longitud, radio_km = centro
+        query = query.filter(filtro_caja_locales(*caja_radio(latitud, longitud, radio_km)))
+        cercanos = sorted(
+            (d, l.id, l) for l in query
+            if (d := distancia_km(latitud, longitud, l.latitud, l.longitud)) <= radio_km
+        )
+        if posicion:
+            try:
+                desde = (float(posicion[0]), posicion[1])
+            except ValueError:
+                return jsonify({"success": False, "message": "Cursor inválido"}), 400
+            cercanos = [c for c in cercanos if c[:2] > desde]
+        pagina = cercanos[:limite + 1]
+        locales = [dict(local_json(l), distancia_km=round(d, 3)) for d, _, l in pagina[:limite]]
+        claves = [(repr(d), i) for d, i, _ in pagina]
+    else:
+        if posicion:
+            query = query.filter(db.tuple_(Local.nombre, Local.id) > posicion)
+        pagina = query.order_by(Local.nombre, Local.id).limit(limite + 1).all()
+        locales = [local_json(l) for l in pagina[:limite]]
+        claves = [(l.nombre, l.id) for l in pagina]
+    
+    has_more = len(pagina) > limite
     return jsonify({
-        "locales": [
-            {
-                "id": l.id,
-                "nombre": l.nombre,
-                "direccion": l.direccion,
-                "ciudad": l.ciudad,
-                "pais": l.pais
-            } for l in locales
-        ]
+        "locales": locales,
+        "has_more": has_more,
+        "next_cursor": codificar_cursor_clave(*claves[limite - 1]) if has_more else None
     })
 
 @app.route('/api/local/nuevo', methods=['POST'])
@@ -675,11 +2940,25 @@ def api_local_nuevo():
         if not nombre:
             return jsonify({"success": False, "message": "El nombre es obligatorio"}), 400
         
+        # Coordenadas opcionales (p. ej. la geolocalización del navegador); el geohash se calcula al guardar
+        latitud, longitud = data.get('latitud'), data.get('longitud')
+        if (latitud is None) != (longitud is None):
+            return jsonify({"success": False, "message": "Indica latitud y longitud a la vez"}), 400
+        if latitud is not None:
+            try:
+                latitud, longitud = float(latitud), float(longitud)
+            except (TypeError, ValueError):
+                return jsonify({"success": False, "message": "Coordenadas inválidas"}), 400
+            if not (-90 <= latitud <= 90 and -180 <= longitud <= 180):
+                return jsonify({"success": False, "message": "Coordenadas fuera de rango"}), 400
+        
         nuevo_local = Local(
             nombre=nombre,
             direccion=direccion or None,
             ciudad=ciudad or None,
-            pais=pais or "España"
+            pais=pais or "España",
+            latitud=latitud,
+            longitud=longitud
         )
         
         db.session.add(nuevo_local)
@@ -709,37 +2988,28 @@ def api_cerveza_nueva():
         if not data:
             return jsonify({"success": False, "message": "Datos no válidos"}), 400
             
-        nombre = data.get('nombre', '').strip()
-        estilo = data.get('estilo', '').strip()
-        pais_procedencia = data.get('pais_procedencia', '').strip()
-        porcentaje_alcohol = data.get('porcentaje_alcohol')
-        ibu = data.get('ibu')
-        color = data.get('color', '').strip()
-        
-        if not nombre:
-            return jsonify({"success": False, "message": "El nombre es obligatorio"}), 400
-        if not estilo:
-            return jsonify({"success": False, "message": "El estilo es obligatorio"}), 400
-        if not pais_procedencia:
-            return jsonify({"success": False, "message": "El país es obligatorio"}), 400
-        if not porcentaje_alcohol:
-            return jsonify({"success": False, "message": "El porcentaje de alcohol es obligatorio"}), 400
+        # Mismas reglas que la importación masiva
+        valores, error = validar_cerveza(data)
+        if error:
+            return jsonify({"success": False, "message": error}), 400
+        nombre = valores['nombre']
         
-        cerveza_existente = Cerveza.query.filter_by(nombre=nombre).first()
+        cerveza_existente = Cerveza.query.filter_by(nombre_normalizado=valores['nombre_normalizado']).first()
         if cerveza_existente:
             return jsonify({"success": False, "message": "Ya existe una cerveza con ese nombre"}), 400
         
-        nueva_cerveza = Cerveza(
-            nombre=nombre,
-            estilo=estilo,
-            pais_procedencia=pais_procedencia,
-            porcentaje_alcohol=float(porcentaje_alcohol),
-            ibu=int(ibu) if ibu and ibu.isdigit() else None,
-            color=color or None
-        )
+        nueva_cerveza = Cerveza(**valores)
         
         db.session.add(nueva_cerveza)
-        db.session.commit()
+        try:
+            db.session.commit()
+        except IntegrityError:
+            # Otra alta o una importación con el mismo nombre normalizado se adelantó
+            db.session.rollback()
+            return jsonify({"success": False, "message": "Ya existe una cerveza con ese nombre"}), 400
+        cache_top.invalidar()
+        autocompletado.añadir(nueva_cerveza.id, nueva_cerveza.nombre)
+        muestreo_cervezas.invalidar()
         
         return jsonify({
             "success": True,
@@ -752,6 +3022,36 @@ def api_cerveza_nueva():
         print(f"Error creando cerveza: {e}")
         return jsonify({"success": False, "message": "Error interno del servidor"}), 500
     
+@app.route('/api/cervezas/importar', methods=['POST'])
+@requiere_sesion
+def api_cervezas_importar():
+    """Importación masiva (solo administradores). El cuerpo es el fichero CSV o NDJSON en crudo o un
+    multipart con `archivo`; la respuesta es NDJSON: una línea de progreso por commit y el informe final."""
+    user_id = session.get('user_id_temp') or session.get('user_id')
+    
+    if not es_administrador(user_id):
+        return jsonify({"success": False, "message": "No autorizado"}), 403
+    
+    archivo = request.files.get('archivo')
+    flujo = archivo.stream if archivo else request.stream
+    formato = request.args.get('formato') or (
+        'csv' if (archivo and archivo.filename.lower().endswith('.csv')) or request.mimetype == 'text/csv' else 'ndjson'
+    )
+    if formato not in ('csv', 'ndjson'):
+        return jsonify({"success": False, "message": "Formato no soportado (csv o ndjson)"}), 400
+    
+    def progreso():
+        importacion = ImportacionCervezas()
+        try:
+            for informe in importacion.ejecutar(leer_filas_importacion(flujo, formato)):
+                yield json.dumps(dict(informe, errores=len(informe['errores']))) + '\n'
+        except (csv.Error, UnicodeDecodeError) as e:
+            yield json.dumps({"success": False, "message": f"Fichero ilegible: {e}", "informe": importacion.informe}) + '\n'
+            return
+        yield json.dumps({"success": True, "informe": importacion.informe}) + '\n'
+    
+    return app.response_class(stream_with_context(progreso()), mimetype='application/x-ndjson')
+
 @app.route('/api/degustacion/nueva', methods=['POST'])
 @requiere_sesion
 def api_degustacion_nueva():
@@ -798,7 +3098,7 @@ def api_degustacion_nueva():
         usuario_id=user_id,
         cerveza_id=cerveza_id,
         local_id=local_id,
-        puntuacion=float(puntuacion) if puntuacion else None,
+        puntuacion=leer_puntuacion(puntuacion),
         comentario=comentario or None,
         tamaño=tamaño or None,
         formato=formato or None,
@@ -806,16 +3106,150 @@ def api_degustacion_nueva():
     )
     
     db.session.add(nueva_degustacion)
+    db.session.flush()
+    ultima_actividad_registrar(nueva_degustacion, cerveza)
+    cerveza_stats_registrar(cerveza.id, nueva_degustacion.puntuacion, nueva_degustacion.fecha)
+    timeline_publicar(nueva_degustacion)
+    galardones_nuevos = galardones_degustacion(nueva_degustacion, cerveza)
     db.session.commit()
+    if nueva_degustacion.puntuacion is not None:
+        cache_top.invalidar()
     
     return jsonify({
         "success": True,
         "degustacion_id": nueva_degustacion.id,
         "message": "¡Degustación registrada exitosamente!",
-        "pais_usado": pais_final or "No especificado"
+        "pais_usado": pais_final or "No especificado",
+        "galardones_nuevos": galardones_nuevos
     })
     
     
+@app.route('/api/degustaciones/lote', methods=['POST'])
+@requiere_sesion
+def api_degustaciones_lote():
+    """Sincroniza varias degustaciones registradas sin conexión en una sola transacción.
+
+    Cada elemento lleva una `clave` de idempotencia generada por el cliente: reenviar el lote tras
+    un corte devuelve las degustaciones ya creadas en vez de duplicarlas. La respuesta trae un
+    resultado por elemento, en el mismo orden: creada, existente o error.
+    """
+    user_id = session.get('user_id_temp') or session.get('user_id')
+    
+    if not user_id:
+        return jsonify({"success": False, "message": "No autorizado"}), 401
+    
+    data = request.get_json(silent=True) or {}
+    elementos = data.get('degustaciones')
+    if not isinstance(elementos, list) or not elementos:
+        return jsonify({"success": False, "message": "Falta la lista de degustaciones"}), 400
+    if len(elementos) > DEGUSTACIONES_LOTE_MAX:
+        return jsonify({"success": False, "message": f"Máximo {DEGUSTACIONES_LOTE_MAX} degustaciones por lote"}), 400
+    
+    resultados = [None] * len(elementos)
+    validos = []  # (posición, clave, datos)
+    vistas = set()
+    for posicion, elemento in enumerate(elementos):
+        clave = str(elemento.get('clave') or '').strip() if isinstance(elemento, dict) else ''
+        if not clave or len(clave) > 64:
+            resultados[posicion] = {"clave": clave or None, "estado": "error", "message": "Clave de idempotencia inválida"}
+            continue
+        if clave in vistas:
+            resultados[posicion] = {"clave": clave, "estado": "error", "message": "Clave repetida en el lote"}
+            continue
+        vistas.add(clave)
+        try:
+            elemento = dict(elemento, cerveza_id=int(elemento['cerveza_id']),
+                            local_id=int(elemento['local_id']) if elemento.get('local_id') else None)
+        except (KeyError, TypeError, ValueError):
+            resultados[posicion] = {"clave": clave, "estado": "error", "message": "Cerveza o local no válidos"}
+            continue
+        validos.append((posicion, clave, elemento))
+    
+    ahora = datetime.now(timezone.utc)
+    for intento in range(2):
+        # Lo ya sincronizado en un envío anterior (una consulta por el índice único usuario + clave)
+        existentes = dict(db.session.query(Degustacion.clave_idempotencia, Degustacion.id).filter(
+            Degustacion.usuario_id == user_id,
+            Degustacion.clave_idempotencia.in_([clave for _, clave, _ in validos])
+        ))
+        cerveza_ids = {e['cerveza_id'] for _, clave, e in validos if clave not in existentes}
+        local_ids = {e['local_id'] for _, clave, e in validos if clave not in existentes and e['local_id']}
+        cervezas = {c.id: c for c in Cerveza.query.filter(Cerveza.id.in_(cerveza_ids))} if cerveza_ids else {}
+        locales = {l.id: l for l in Local.query.filter(Local.id.in_(local_ids))} if local_ids else {}
+        
+        nuevas = []  # (posición, degustación, cerveza)
+        for posicion, clave, elemento in validos:
+            if clave in existentes:
+                resultados[posicion] = {"clave": clave, "estado": "existente", "degustacion_id": existentes[clave]}
+                continue
+            error = None
+            cerveza = cervezas.get(elemento['cerveza_id'])
+            local = locales.get(elemento['local_id'])
+            puntuacion, fecha = elemento.get('puntuacion'), elemento.get('fecha')
+            try:
+                puntuacion = leer_puntuacion(puntuacion)
+                fecha = datetime.fromisoformat(fecha) if fecha else ahora
+            except (TypeError, ValueError):
+                error = "Puntuación o fecha inválidas"
+            if error is None:
+                fecha = fecha.replace(tzinfo=timezone.utc) if fecha.tzinfo is None else fecha.astimezone(timezone.utc)
+                if cerveza is None:
+                    error = "Cerveza no encontrada"
+                elif elemento['local_id'] and local is None:
+                    error = "Local no encontrado"
+                elif puntuacion is not None and not 0 <= puntuacion <= 5:
+                    error = "La puntuación debe estar entre 0 y 5"
+                elif fecha > ahora + timedelta(minutes=5):
+                    error = "La fecha no puede estar en el futuro"
+            if error:
+                resultados[posicion] = {"clave": clave, "estado": "error", "message": error}
+                continue
+            
+            # Misma prioridad de país que /api/degustacion/nueva: el del local y si no el indicado
+            nuevas.append((posicion, Degustacion(
+                usuario_id=user_id,
+                cerveza_id=cerveza.id,
+                local_id=local.id if local else None,
+                puntuacion=puntuacion,
+                comentario=(elemento.get('comentario') or '').strip() or None,
+                tamaño=elemento.get('tamaño') or None,
+                formato=elemento.get('formato') or None,
+                pais_consumicion=(local.pais if local else None) or elemento.get('pais_consumicion') or None,
+                fecha=fecha,
+                clave_idempotencia=clave
+            ), cerveza))
+        
+        try:
+            db.session.add_all([degustacion for _, degustacion, _ in nuevas])
+            db.session.flush()
+            amigos_ids = amigos_ids_de(user_id) if app.config['TIMELINE_ENABLED'] else None
+            galardones_nuevos, puntuadas = [], False
+            for posicion, degustacion, cerveza in nuevas:
+                ultima_actividad_registrar(degustacion, cerveza)
+                cerveza_stats_registrar(cerveza.id, degustacion.puntuacion, degustacion.fecha)
+                timeline_publicar(degustacion, amigos_ids)
+                galardones_nuevos += galardones_degustacion(degustacion, cerveza)
+                puntuadas = puntuadas or degustacion.puntuacion is not None
+                # Antes del commit: después cada atributo leído recargaría la fila
+                resultados[posicion] = {"clave": degustacion.clave_idempotencia, "estado": "creada", "degustacion_id": degustacion.id}
+            db.session.commit()
+            break
+        except IntegrityError:
+            # Otro envío del mismo lote ganó la carrera: se repite y sus claves salen como existentes
+            db.session.rollback()
+            if intento:
+                raise
+    
+    if puntuadas:
+        cache_top.invalidar()
+    
+    return jsonify({
+        "success": True,
+        "creadas": len(nuevas),
+        "resultados": resultados,
+        "galardones_nuevos": galardones_nuevos
+    })
+    
 @app.route('/api/local/<int:id>/info')
 @requiere_sesion
 def api_local_info(id):
@@ -826,13 +3260,7 @@ def api_local_info(id):
     
     return jsonify({
         "success": True,
-        "local": {
-            "id": local.id,
-            "nombre": local.nombre,
-            "direccion": local.direccion,
-            "ciudad": local.ciudad,
-            "pais": local.pais
-        }
+        "local": local_json(local)
     })
 
 @app.route('/mis_degustaciones')
@@ -850,35 +3278,53 @@ def mis_degustaciones():
         flash("Usuario no encontrado.", "error")
         return redirect(url_for('login'))
     
-    # Obtener degustaciones con comentarios y usuarios
-    degustaciones = Degustacion.query.filter_by(
-        usuario_id=user_id
-    ).order_by(Degustacion.fecha.desc()).all()
+    # Cursor opaco (fecha, id) de la última degustación de la página anterior
+    before = request.args.get('before')
+    posicion = decodificar_cursor(before) if before else None
     
-    # Para cada degustación, cargar los comentarios con información del usuario
-    degustaciones_con_comentarios = []
-    for deg in degustaciones:
-        # Obtener comentarios con información del usuario
+    # Degustaciones de la página con cerveza y local cargados en la misma consulta
+    query = Degustacion.query.options(
+        joinedload(Degustacion.cerveza),
+        joinedload(Degustacion.local)
+    ).filter(Degustacion.usuario_id == user_id)
+    
+    if posicion:
+        fecha_cursor, id_cursor = posicion
+        query = query.filter(
+            (Degustacion.fecha < fecha_cursor) |
+            ((Degustacion.fecha == fecha_cursor) & (Degustacion.id < id_cursor))
+        )
+    
+    degustaciones = query.order_by(
+        Degustacion.fecha.desc(), Degustacion.id.desc()
+    ).limit(DEGUSTACIONES_POR_PAGINA + 1).all()
+    
+    siguiente_cursor = None
+    if len(degustaciones) > DEGUSTACIONES_POR_PAGINA:
+        degustaciones = degustaciones[:DEGUSTACIONES_POR_PAGINA]
+        siguiente_cursor = codificar_cursor(degustaciones[-1].fecha, degustaciones[-1].id)
+    
+    # Comentarios de toda la página con información del usuario en una sola consulta
+    comentarios_por_deg = {deg.id: [] for deg in degustaciones}
+    if comentarios_por_deg:
         comentarios_db = db.session.query(ComentarioDegustacion, Usuario).join(
             Usuario, ComentarioDegustacion.usuario_id == Usuario.id
         ).filter(
-            ComentarioDegustacion.degustacion_id == deg.id
+            ComentarioDegustacion.degustacion_id.in_(list(comentarios_por_deg)),
+            Usuario.eliminado_en.is_(None)
         ).order_by(ComentarioDegustacion.fecha.desc()).all()
         
         # Convertir a formato más fácil para el template
-        comentarios_formateados = []
         for comentario, usuario_comentario in comentarios_db:
-            comentarios_formateados.append({
+            comentarios_por_deg[comentario.degustacion_id].append({
                 'id': comentario.id,
                 'texto': comentario.texto,
                 'fecha': comentario.fecha,
-                'usuario': {
-                    'id': usuario_comentario.id,
-                    'nombre_usuario': usuario_comentario.nombre_usuario,
-                    'foto': usuario_comentario.foto
-                }
+                'usuario': usuario_json(usuario_comentario)
             })
-        
+    
+    degustaciones_con_comentarios = []
+    for deg in degustaciones:
         # Crear una copa de la degustación con los comentarios
         degustacion_dict = {
             'id': deg.id,
@@ -890,14 +3336,47 @@ def mis_degustaciones():
             'formato': deg.formato,
             'local': deg.local,
             'pais_consumicion': deg.pais_consumicion,
-            'comentarios': comentarios_formateados
+            'comentarios': comentarios_por_deg[deg.id]
         }
         degustaciones_con_comentarios.append(degustacion_dict)
     
     return render_template('mis_degustaciones.html', 
                          usuario=usuario,
                          user_id=user_id,
-                         degustaciones=degustaciones_con_comentarios)
+                         degustaciones=degustaciones_con_comentarios,
+                         pagina_anterior=before is not None,
+                         siguiente_cursor=siguiente_cursor)
+
+@app.route('/mis_degustaciones/exportar')
+@requiere_sesion
+def exportar_mis_degustaciones():
+    """Descarga de todo mi historial de degustaciones (CSV o NDJSON) generada en streaming"""
+    user_id = session.get('user_id_temp') or session.get('user_id')
+    
+    if not user_id:
+        flash("No autorizado.", "error")
+        return redirect(url_for('login'))
+    
+    formato = request.args.get('formato', 'csv')
+    if formato not in EXPORTACION_TIPOS:
+        return jsonify({"success": False, "message": "Formato no soportado (csv o ndjson)"}), 400
+    
+    return respuesta_exportacion(formato, 'mis_degustaciones', user_id)
+
+@app.route('/api/admin/degustaciones/exportar')
+@requiere_sesion
+def exportar_degustaciones_admin():
+    """Exportación de la tabla de degustaciones completa (solo administradores)"""
+    user_id = session.get('user_id_temp') or session.get('user_id')
+    
+    if not es_administrador(user_id):
+        return jsonify({"success": False, "message": "No autorizado"}), 403
+    
+    formato = request.args.get('formato', 'csv')
+    if formato not in EXPORTACION_TIPOS:
+        return jsonify({"success": False, "message": "Formato no soportado (csv o ndjson)"}), 400
+    
+    return respuesta_exportacion(formato, 'degustaciones')
 
 # --- RUTAS DE PERFILES ---
 
@@ -927,20 +3406,16 @@ def perfil_usuario_info(id):
     if not user_id:
         return jsonify({"success": False, "message": "No autorizado"}), 401
     
-    usuario = db.session.get(Usuario, id)
+    usuario = usuario_visible(id)
     if not usuario:
         return jsonify({"success": False, "message": "Usuario no encontrado"}), 404
     
     return jsonify({
         "success": True,
-        "usuario": {
-            "id": usuario.id,
-            "nombre_usuario": usuario.nombre_usuario,
-            "foto": usuario.foto,
-            "ubicacion": usuario.ubicacion,
-            "presentacion": usuario.presentacion,
-            "fecha_registro": usuario.fecha_registro.strftime('%d/%m/%Y') if usuario.fecha_registro else 'N/A'
-        }
+        "usuario": dict(
+            usuario_json(usuario, 'ubicacion', 'presentacion', variante='tarjeta'),
+            fecha_registro=usuario.fecha_registro.strftime('%d/%m/%Y') if usuario.fecha_registro else 'N/A'
+        )
     })
 
 @app.route('/perfil/editar', methods=['GET', 'POST'])
@@ -971,6 +3446,7 @@ def editar_perfil():
         usuario.ubicacion = request.form.get('ubicacion') or None
         usuario.genero = request.form.get('genero') or None
         usuario.presentacion = request.form.get('presentacion') or None
+        foto_anterior = datos_foto = None
 
         if 'foto' in request.files:
             file = request.files['foto']
@@ -986,20 +3462,28 @@ def editar_perfil():
                     flash("La imagen es demasiado grande (máx. 2 MB).", "error")
                     return render_template('editar_perfil.html', usuario=usuario, user_id=user_id)
 
-                ext = file.filename.rsplit('.', 1)[1].lower()
-                filename = f"user_{usuario.id}_{uuid.uuid4().hex[:8]}.{ext}"
-                filepath = os.path.join(static_fotos_dir, filename)
-                file.save(filepath)
-
-                if usuario.foto and usuario.foto.startswith('user_'):
-                    old_path = os.path.join(static_fotos_dir, usuario.foto)
-                    if os.path.exists(old_path):
-                        os.remove(old_path)
+                if Image is not None:
+                    datos_foto = file.read()
+                    try:
+                        filename = procesar_foto(datos_foto)
+                    except FotoInvalida as e:
+                        flash(str(e), "error")
+                        return render_template('editar_perfil.html', usuario=usuario, user_id=user_id)
+                else:
+                    ext = file.filename.rsplit('.', 1)[1].lower()
+                    filename = f"user_{usuario.id}_{uuid.uuid4().hex[:8]}.{ext}"
+                    file.save(os.path.join(static_fotos_dir, filename))
 
-                usuario.foto = filename
+                foto_anterior, usuario.foto = usuario.foto, filename
 
         try:
             db.session.commit()
+            # Con las variantes reutilizadas, otro usuario pudo borrarlas antes de este commit
+            if datos_foto is not None:
+                procesar_foto(datos_foto)
+            # Los ficheros de la foto anterior se borran solo cuando el cambio ya está guardado
+            if foto_anterior and foto_anterior != usuario.foto:
+                foto_borrar(foto_anterior)
             flash("Perfil actualizado correctamente.", "success")
             return redirect(url_for('mi_perfil', user_id=user_id))
         except Exception as e:
@@ -1026,24 +3510,11 @@ def eliminar_cuenta():
     if request.method == 'POST':
         confirmacion = request.form.get('confirmar')
         if confirmacion == 'si':
-            # Eliminar todas las relaciones
-            Favorita.query.filter_by(usuario_id=user_id).delete()
-            Degustacion.query.filter_by(usuario_id=user_id).delete()
-            Amistad.query.filter((Amistad.usuario_id == user_id) | (Amistad.amigo_id == user_id)).delete()
-            UsuarioGalardon.query.filter_by(usuario_id=user_id).delete()
-            ComentarioDegustacion.query.filter_by(usuario_id=user_id).delete()
-            
-            # Eliminar foto si existe
-            if usuario.foto and usuario.foto.startswith('user_'):
-                old_path = os.path.join(static_fotos_dir, usuario.foto)
-                if os.path.exists(old_path):
-                    os.remove(old_path)
-            
-            db.session.delete(usuario)
-            db.session.commit()
+            # La cuenta desaparece ya; sus datos los borra borrador_cuentas en segundo plano
+            encolar_borrado_cuenta(usuario)
             session.pop('user_id', None)
             session.pop('user_id_temp', None)
-            flash("Tu cuenta ha sido eliminada permanentemente.", "success")
+            flash("Tu cuenta ha sido eliminada. Tus datos se borrarán en unos minutos.", "success")
             return redirect(url_for('registro'))
         else:
             flash("Debes confirmar la eliminación de tu cuenta.", "error")
@@ -1065,55 +3536,14 @@ def top_degustaciones():
     estilo = request.args.get('estilo', '')
     pais = request.args.get('pais', '')
     
-    # Consulta base: cervezas con al menos una degustación puntuada
-    query = db.session.query(
-        Cerveza,
-        db.func.avg(Degustacion.puntuacion).label('puntuacion_promedio'),
-        db.func.count(Degustacion.id).label('num_valoraciones'),
-        db.func.max(Degustacion.fecha).label('ultima_valoracion')
-    ).join(Degustacion, Degustacion.cerveza_id == Cerveza.id)
-    
-    # Filtrar solo degustaciones con puntuación
-    query = query.filter(Degustacion.puntuacion.isnot(None))
-    
-    # Aplicar filtros
-    if estilo:
-        query = query.filter(Cerveza.estilo == estilo)
-    if pais:
-        query = query.filter(Cerveza.pais_procedencia == pais)
-    
-    # Agrupar por cerveza y ordenar
-    query = query.group_by(Cerveza.id)
-    query = query.order_by(db.desc('puntuacion_promedio'), db.desc('num_valoraciones'))
-    
-    # Limitar a top 50
-    top_cervezas = query.limit(50).all()
-    
-    # Obtener lista de estilos únicos para el filtro
-    estilos = db.session.query(Cerveza.estilo).distinct().order_by(Cerveza.estilo).all()
-    estilos = [e[0] for e in estilos]
-    
-    # Obtener lista de países únicos para el filtro
-    paises = db.session.query(Cerveza.pais_procedencia).distinct().order_by(Cerveza.pais_procedencia).all()
-    paises = [p[0] for p in paises]
-    
-    # Preparar datos para template
-    cervezas_data = []
-    for cerveza, promedio, num_val, ultima_fecha in top_cervezas:
-        fecha_str = ultima_fecha.strftime('%d/%m/%Y') if ultima_fecha else 'N/A'
-        
-        cervezas_data.append({
-            'id': cerveza.id,
-            'nombre': cerveza.nombre,
-            'estilo': cerveza.estilo,
-            'pais': cerveza.pais_procedencia,
-            'alcohol': cerveza.porcentaje_alcohol,
-            'ibu': cerveza.ibu,
-            'color': cerveza.color,
-            'puntuacion_promedio': round(promedio, 2) if promedio else 0,
-            'num_valoraciones': num_val,
-            'ultima_valoracion': fecha_str
-        })
+    # El ranking solo cambia con degustaciones puntuadas o cervezas nuevas
+    clave = (estilo, pais)
+    resultado = cache_top.obtener(clave)
+    if resultado is None:
+        generacion = cache_top.generacion
+        resultado = calcular_top_degustaciones(estilo, pais)
+        cache_top.guardar(clave, resultado, generacion)
+    cervezas_data, estilos, paises = resultado
     
     return render_template(
         'top_degustaciones.html',
@@ -1126,6 +3556,29 @@ def top_degustaciones():
         user_id=user_id
     )
 
+@app.route('/api/top_degustaciones/cache')
+@requiere_sesion
+def top_degustaciones_cache():
+    """Contadores de la caché del ranking"""
+    return jsonify(cache_top.estadisticas())
+
+@app.route('/api/correo/metricas')
+@requiere_sesion
+def correo_metricas():
+    """Contadores de entrega de la cola de correo de este proceso y tamaño de la cola por estado"""
+    return jsonify(enviador_correo.estadisticas())
+
+@app.route('/api/admin/borrados')
+@requiere_sesion
+def borrados_metricas():
+    """Progreso de los borrados de cuentas en curso (solo administradores)"""
+    user_id = session.get('user_id_temp') or session.get('user_id')
+    
+    if not es_administrador(user_id):
+        return jsonify({"success": False, "message": "No autorizado"}), 403
+    
+    return jsonify(borrador_cuentas.estadisticas())
+
 @app.route('/api/cerveza/<int:id>/detalle')
 @requiere_sesion
 def cerveza_detalle(id):
@@ -1133,16 +3586,14 @@ def cerveza_detalle(id):
     if not cerveza:
         return jsonify({"success": False, "message": "Cerveza no encontrada"}), 404
     
-    stats = db.session.query(
-        db.func.avg(Degustacion.puntuacion).label('promedio'),
-        db.func.count(Degustacion.id).label('total'),
-        db.func.min(Degustacion.fecha).label('primera')
+    stats = db.session.get(CervezaStats, id)
+    
+    ultima_deg = Degustacion.query.join(
+        Usuario, Degustacion.usuario_id == Usuario.id
     ).filter(
         Degustacion.cerveza_id == id,
-        Degustacion.puntuacion.isnot(None)
-    ).first()
-    
-    ultima_deg = Degustacion.query.filter_by(cerveza_id=id).order_by(Degustacion.fecha.desc()).first()
+        Usuario.eliminado_en.is_(None)
+    ).order_by(Degustacion.fecha.desc()).first()
     
     data = {
         'id': cerveza.id,
@@ -1152,14 +3603,71 @@ def cerveza_detalle(id):
         'alcohol': cerveza.porcentaje_alcohol,
         'ibu': cerveza.ibu,
         'color': cerveza.color,
-        'puntuacion_promedio': float(stats.promedio) if stats.promedio else None,
-        'total_valoraciones': stats.total if stats.total else 0,
-        'primera_degustacion': stats.primera.strftime('%d/%m/%Y') if stats.primera else None,
+        'puntuacion_promedio': float(stats.promedio) if stats and stats.promedio else None,
+        'total_valoraciones': stats.num_valoraciones if stats else 0,
+        'primera_degustacion': stats.primera_valoracion.strftime('%d/%m/%Y') if stats and stats.primera_valoracion else None,
+        'histograma': stats.histograma if stats else [0, 0, 0, 0, 0],
         'comentario_reciente': ultima_deg.comentario if ultima_deg and ultima_deg.comentario else None
     }
     
     return jsonify({"success": True, "cerveza": data})
 
+# --- GALARDONES ---
+
+@app.route('/galardones')
+@requiere_sesion
+def galardones():
+    """Todos los galardones con mi nivel y el progreso hacia el siguiente, paginados por nombre"""
+    user_id = session.get('user_id_temp') or session.get('user_id')
+    
+    if not user_id:
+        flash("Debes iniciar sesión para ver esta página.", "error")
+        return redirect(url_for('login'))
+    
+    # Cursor opaco (nombre, id) del último galardón de la página anterior
+    despues = request.args.get('despues')
+    posicion = decodificar_cursor_clave(despues) if despues else None
+    
+    query = Galardon.query.filter(Galardon.nombre.in_(GALARDONES))
+    if posicion:
+        query = query.filter(db.tuple_(Galardon.nombre, Galardon.id) > posicion)
+    pagina = query.order_by(Galardon.nombre, Galardon.id).limit(GALARDONES_POR_PAGINA + 1).all()
+    
+    siguiente_cursor = None
+    if len(pagina) > GALARDONES_POR_PAGINA:
+        pagina = pagina[:GALARDONES_POR_PAGINA]
+        siguiente_cursor = codificar_cursor_clave(pagina[-1].nombre, pagina[-1].id)
+    
+    # Mis niveles y contadores: una consulta cada uno
+    niveles = dict(db.session.query(UsuarioGalardon.galardon_id, UsuarioGalardon.nivel).filter(
+        UsuarioGalardon.usuario_id == user_id,
+        UsuarioGalardon.galardon_id.in_([g.id for g in pagina])
+    ))
+    contadores = dict(db.session.query(ProgresoGalardon.metrica, ProgresoGalardon.valor).filter_by(usuario_id=user_id))
+    
+    lista = []
+    for galardon in pagina:
+        metrica, umbrales, _ = GALARDONES[galardon.nombre]
+        valor = contadores.get(metrica, 0)
+        _, siguiente = galardon_nivel(galardon.nombre, valor)
+        lista.append({
+            'nombre': galardon.nombre,
+            'descripcion': galardon.descripcion,
+            'nivel': niveles.get(galardon.id, 0),
+            'nivel_max': len(umbrales),
+            'valor': valor,
+            'siguiente': siguiente,
+            'porcentaje': min(100, int(100 * valor / siguiente)) if siguiente else 100
+        })
+    
+    return render_template(
+        'galardones.html',
+        user_id=user_id,
+        galardones=lista,
+        siguiente_cursor=siguiente_cursor,
+        pagina_anterior=bool(posicion)
+    )
+
 # --- SISTEMA DE AMISTADES ---
 
 @app.route('/buscar_usuarios')
@@ -1176,38 +3684,28 @@ def buscar_usuarios():
     
     usuario_actual_id = user_id
     
-    usuarios = Usuario.query.filter(
-        Usuario.id != usuario_actual_id,
-        (Usuario.nombre_usuario.ilike(f"%{q}%")) |
-        (Usuario.correo.ilike(f"%{q}%"))
-    ).limit(10).all()
+    if '@' in q:
+        # Un correo completo es una búsqueda exacta, sin distinguir mayúsculas, sobre lower(correo)
+        usuarios = Usuario.query.filter(
+            db.func.lower(Usuario.correo) == q.lower(),
+            Usuario.id != usuario_actual_id,
+            Usuario.eliminado_en.is_(None)
+        ).limit(10).all()
+    elif app.config['BUSQUEDA_FTS']:
+        usuarios = buscar_usuarios_fts(q, usuario_actual_id)
+    else:
+        usuarios = Usuario.query.filter(
+            Usuario.id != usuario_actual_id,
+            Usuario.eliminado_en.is_(None),
+            Usuario.nombre_usuario.istartswith(q, autoescape=True)
+        ).order_by(Usuario.nombre_usuario).limit(10).all()
+    
+    # Estado de amistad de todos los resultados en una sola consulta
+    estados = estados_amistad(usuario_actual_id, [u.id for u in usuarios])
     
     usuarios_data = []
     for usuario in usuarios:
-        amistad = Amistad.query.filter(
-            ((Amistad.usuario_id == usuario_actual_id) & (Amistad.amigo_id == usuario.id)) |
-            ((Amistad.usuario_id == usuario.id) & (Amistad.amigo_id == usuario_actual_id))
-        ).first()
-        
-        estado = None
-        if amistad:
-            if amistad.estado == 'aceptado':
-                estado = 'amigos'
-            elif amistad.estado == 'pendiente':
-                if amistad.usuario_id == usuario_actual_id:
-                    estado = 'solicitud_enviada'
-                else:
-                    estado = 'solicitud_recibida'
-            elif amistad.estado == 'rechazado':
-                estado = 'rechazado'
-        
-        usuarios_data.append({
-            'id': usuario.id,
-            'nombre_usuario': usuario.nombre_usuario,
-            'foto': usuario.foto,
-            'ubicacion': usuario.ubicacion,
-            'estado_amistad': estado
-        })
+        usuarios_data.append(dict(usuario_json(usuario, 'ubicacion'), estado_amistad=estados.get(usuario.id)))
     
     return jsonify({"usuarios": usuarios_data})
 
@@ -1233,10 +3731,13 @@ def enviar_solicitud_amistad():
     if usuario_id == amigo_id:
         return jsonify({"success": False, "message": "No puedes enviarte solicitud a ti mismo"}), 400
     
-    amistad_existente = Amistad.query.filter(
-        ((Amistad.usuario_id == usuario_id) & (Amistad.amigo_id == amigo_id)) |
-        ((Amistad.usuario_id == amigo_id) & (Amistad.amigo_id == usuario_id))
-    ).first()
+    if not usuario_visible(amigo_id):
+        return jsonify({"success": False, "message": "Usuario no encontrado"}), 404
+    
+    if son_amigos(usuario_id, amigo_id):
+        return jsonify({"success": False, "message": "Ya sois amigos"}), 400
+    
+    amistad_existente = amistad_entre(usuario_id, amigo_id)
     
     if amistad_existente:
         if amistad_existente.estado == 'pendiente':
@@ -1276,7 +3777,8 @@ def solicitudes_amistad():
             Usuario, Amistad.usuario_id == Usuario.id
         ).filter(
             Amistad.amigo_id == user_id,
-            Amistad.estado == 'pendiente'
+            Amistad.estado == 'pendiente',
+            Usuario.eliminado_en.is_(None)
         ).all()
         
         # Solicitudes enviadas (tú enviaste)
@@ -1284,20 +3786,16 @@ def solicitudes_amistad():
             Usuario, Amistad.amigo_id == Usuario.id
         ).filter(
             Amistad.usuario_id == user_id,
-            Amistad.estado == 'pendiente'
+            Amistad.estado == 'pendiente',
+            Usuario.eliminado_en.is_(None)
         ).all()
         
         recibidas_data = []
         for amistad, usuario in solicitudes_recibidas:
             recibidas_data.append({
                 'id': amistad.id,
-                'usuario': {
-                    'id': usuario.id,
-                    'nombre_usuario': usuario.nombre_usuario,
-                    'foto': usuario.foto,
-                    'ubicacion': usuario.ubicacion
-                },
-                'fecha_solicitud': amistad.fecha_solicitud.strftime('%d/%m/%Y %H:%M'),
+                'usuario': usuario_json(usuario, 'ubicacion'),
+                'fecha_solicitud': fecha_json(amistad.fecha_solicitud),
                 'tipo': 'recibida'
             })
         
@@ -1305,13 +3803,8 @@ def solicitudes_amistad():
         for amistad, usuario in solicitudes_enviadas:
             enviadas_data.append({
                 'id': amistad.id,
-                'usuario': {
-                    'id': usuario.id,
-                    'nombre_usuario': usuario.nombre_usuario,
-                    'foto': usuario.foto,
-                    'ubicacion': usuario.ubicacion
-                },
-                'fecha_solicitud': amistad.fecha_solicitud.strftime('%d/%m/%Y %H:%M'),
+                'usuario': usuario_json(usuario, 'ubicacion'),
+                'fecha_solicitud': fecha_json(amistad.fecha_solicitud),
                 'tipo': 'enviada'
             })
         
@@ -1348,24 +3841,42 @@ def gestionar_solicitud():
     if accion == 'aceptar' or accion == 'rechazar':
         if amistad.amigo_id != user_id:
             return jsonify({"success": False, "message": "No autorizado"}), 403
+        if accion == 'aceptar' and not usuario_visible(amistad.usuario_id):
+            return jsonify({"success": False, "message": "Solicitud no encontrada"}), 404
     elif accion == 'cancelar':
         if amistad.usuario_id != user_id:
             return jsonify({"success": False, "message": "No autorizado"}), 403
     
+    galardones_nuevos = []
     if accion == 'aceptar':
+        if amistad.estado != 'aceptado':
+            galardones_progresar(amistad.usuario_id, 'amigos')
+            galardones_nuevos = galardones_progresar(amistad.amigo_id, 'amigos')
         amistad.estado = 'aceptado'
+        aristas_amistad_crear(amistad.usuario_id, amistad.amigo_id)
+        timeline_rellenar(amistad.usuario_id, amistad.amigo_id)
         mensaje = "Solicitud aceptada"
     elif accion == 'rechazar':
+        if amistad.estado == 'aceptado':
+            timeline_recortar(amistad.usuario_id, amistad.amigo_id)
+            galardones_progresar(amistad.usuario_id, 'amigos', -1)
+            galardones_progresar(amistad.amigo_id, 'amigos', -1)
+        aristas_amistad_borrar(amistad.usuario_id, amistad.amigo_id)
         db.session.delete(amistad)
         db.session.commit()
         mensaje = "Solicitud rechazada"
     elif accion == 'cancelar':
+        if amistad.estado == 'aceptado':
+            timeline_recortar(amistad.usuario_id, amistad.amigo_id)
+            galardones_progresar(amistad.usuario_id, 'amigos', -1)
+            galardones_progresar(amistad.amigo_id, 'amigos', -1)
+        aristas_amistad_borrar(amistad.usuario_id, amistad.amigo_id)
         db.session.delete(amistad)
         db.session.commit()
         return jsonify({"success": True, "message": "Solicitud cancelada"})
     
     db.session.commit()
-    return jsonify({"success": True, "message": mensaje})
+    return jsonify({"success": True, "message": mensaje, "galardones_nuevos": galardones_nuevos})
 
 @app.route('/mis_amigos')
 @requiere_sesion
@@ -1379,15 +3890,7 @@ def mis_amigos():
     
     try:
         # Obtener IDs de amigos (aceptados)
-        amigos_ids_query = db.session.query(Amistad.amigo_id).filter_by(
-            usuario_id=user_id, estado='aceptado'
-        ).union(
-            db.session.query(Amistad.usuario_id).filter_by(
-                amigo_id=user_id, estado='aceptado'
-            )
-        ).all()
-        
-        amigos_ids = [r[0] for r in amigos_ids_query]
+        amigos_ids = amigos_ids_de(user_id)
         
         if not amigos_ids:
             print("ℹ️ No se encontraron amigos")
@@ -1395,36 +3898,24 @@ def mis_amigos():
         
         print(f"📊 IDs de amigos encontrados: {amigos_ids}")
         
-        # Obtener información de los amigos
-        amigos = Usuario.query.filter(Usuario.id.in_(amigos_ids)).all()
+        # Obtener información de los amigos junto con su última actividad
+        amigos = db.session.query(Usuario, UltimaActividad).outerjoin(
+            UltimaActividad, UltimaActividad.usuario_id == Usuario.id
+        ).filter(Usuario.id.in_(amigos_ids), Usuario.eliminado_en.is_(None)).all()
         
         amigos_data = []
-        for amigo in amigos:
-            # Obtener última degustación
-            ultima_deg = Degustacion.query.filter_by(
-                usuario_id=amigo.id
-            ).order_by(Degustacion.fecha.desc()).first()
-            
+        for amigo, ultima in amigos:
             actividad = None
-            if ultima_deg:
-                cerveza = Cerveza.query.get(ultima_deg.cerveza_id)
-                if cerveza:
-                    actividad = {
-                        'cerveza_nombre': cerveza.nombre,
-                        'cerveza_estilo': cerveza.estilo,
-                        'puntuacion': ultima_deg.puntuacion,
-                        'fecha': ultima_deg.fecha.strftime('%d/%m/%Y %H:%M'),
-                        'comentario': ultima_deg.comentario
-                    }
+            if ultima:
+                actividad = {
+                    'cerveza_nombre': ultima.cerveza_nombre,
+                    'cerveza_estilo': ultima.cerveza_estilo,
+                    'puntuacion': ultima.puntuacion,
+                    'fecha': fecha_json(ultima.fecha),
+                    'comentario': ultima.comentario
+                }
             
-            amigos_data.append({
-                'id': amigo.id,
-                'nombre_usuario': amigo.nombre_usuario,
-                'foto': amigo.foto,
-                'ubicacion': amigo.ubicacion,
-                'presentacion': amigo.presentacion,
-                'actividad_reciente': actividad
-            })
+            amigos_data.append(dict(usuario_json(amigo, 'ubicacion', 'presentacion'), actividad_reciente=actividad))
         
         print(f"✅ {len(amigos_data)} amigos cargados exitosamente")
         
@@ -1444,89 +3935,109 @@ def actividades_amigos():
     
     print(f"📝 Cargando actividades para usuario ID: {user_id}")
     
+    # Tamaño de página y cursor opaco (fecha, id) de la última actividad vista
+    try:
+        limite = int(request.args.get('limite', ACTIVIDADES_POR_PAGINA))
+    except ValueError:
+        return jsonify({"success": False, "message": "Límite inválido"}), 400
+    limite = max(1, min(limite, ACTIVIDADES_MAX_POR_PAGINA))
+    
+    cursor = request.args.get('cursor')
+    posicion = None
+    if cursor:
+        posicion = decodificar_cursor(cursor)
+        if not posicion:
+            return jsonify({"success": False, "message": "Cursor inválido"}), 400
+    
     try:
-        # Obtener IDs de amigos
-        amigos_ids_query = db.session.query(Amistad.amigo_id).filter_by(
-            usuario_id=user_id, estado='aceptado'
-        ).union(
-            db.session.query(Amistad.usuario_id).filter_by(
-                amigo_id=user_id, estado='aceptado'
+        if app.config['TIMELINE_ENABLED']:
+            # Timeline materializado: un rango sobre la bandeja del usuario
+            query = db.session.query(
+                Degustacion, Usuario, Cerveza, Local.nombre
+            ).select_from(TimelineEntrada).join(
+                Degustacion, TimelineEntrada.degustacion_id == Degustacion.id
+            ).filter(
+                TimelineEntrada.usuario_id == user_id
             )
-        ).all()
-        
-        amigos_ids = [r[0] for r in amigos_ids_query]
-        
-        if not amigos_ids:
-            print("ℹ️ No se encontraron amigos para actividades")
-            return jsonify({"actividades": [], "total": 0, "mostrando": 0})
-        
-        print(f"📊 IDs de amigos para actividades: {amigos_ids}")
+            columna_fecha, columna_id = TimelineEntrada.fecha, TimelineEntrada.degustacion_id
+        else:
+            # Obtener IDs de amigos
+            amigos_ids = amigos_ids_de(user_id)
+            
+            if not amigos_ids:
+                print("ℹ️ No se encontraron amigos para actividades")
+                return jsonify({"actividades": [], "has_more": False, "next_cursor": None, "mostrando": 0})
+            
+            print(f"📊 IDs de amigos para actividades: {amigos_ids}")
+            
+            query = db.session.query(
+                Degustacion, Usuario, Cerveza, Local.nombre
+            ).filter(
+                Degustacion.usuario_id.in_(amigos_ids)
+            )
+            columna_fecha, columna_id = Degustacion.fecha, Degustacion.id
         
-        # Obtener TODAS las actividades de amigos
-        actividades = db.session.query(
-            Degustacion, Usuario, Cerveza
-        ).join(
+        # Obtener una página de actividades (una fila extra para saber si hay más)
+        query = query.join(
             Usuario, Degustacion.usuario_id == Usuario.id
+        ).filter(
+            Usuario.eliminado_en.is_(None)
         ).join(
             Cerveza, Degustacion.cerveza_id == Cerveza.id
-        ).filter(
-            Degustacion.usuario_id.in_(amigos_ids)
-        ).order_by(
-            Degustacion.fecha.desc()
-        ).all()
+        ).outerjoin(
+            Local, Degustacion.local_id == Local.id
+        )
+        
+        if posicion:
+            fecha_cursor, id_cursor = posicion
+            query = query.filter(
+                (columna_fecha < fecha_cursor) |
+                ((columna_fecha == fecha_cursor) & (columna_id < id_cursor))
+            )
+        
+        actividades = query.order_by(
+            columna_fecha.desc(), columna_id.desc()
+        ).limit(limite + 1).all()
+        
+        has_more = len(actividades) > limite
+        actividades = actividades[:limite]
+        
+        # Comentarios recientes de toda la página en una sola consulta
+        comentarios_por_deg = comentarios_recientes([deg.id for deg, _, _, _ in actividades])
         
         actividades_data = []
-        for deg, usuario, cerveza in actividades:
-            # Obtener comentarios recientes
-            comentarios_db = db.session.query(ComentarioDegustacion, Usuario).join(
-                Usuario, ComentarioDegustacion.usuario_id == Usuario.id
-            ).filter(
-                ComentarioDegustacion.degustacion_id == deg.id
-            ).order_by(ComentarioDegustacion.fecha.desc()).limit(3).all()
-            
+        for deg, usuario, cerveza, local_nombre in actividades:
             comentarios = []
-            for comentario, usuario_comentario in comentarios_db:
+            for comentario, usuario_comentario in comentarios_por_deg.get(deg.id, []):
                 comentarios.append({
                     'id': comentario.id,
                     'usuario_id': comentario.usuario_id,
                     'usuario_nombre': usuario_comentario.nombre_usuario,
                     'texto': comentario.texto,
-                    'fecha': comentario.fecha.strftime('%d/%m/%Y %H:%M')
+                    'fecha': fecha_json(comentario.fecha)
                 })
             
-            actividades_data.append({
-                'id': deg.id,
-                'usuario': {
-                    'id': usuario.id,
-                    'nombre_usuario': usuario.nombre_usuario,
-                    'foto': usuario.foto
-                },
-                'cerveza': {
-                    'id': cerveza.id,
-                    'nombre': cerveza.nombre,
-                    'estilo': cerveza.estilo,
-                    'pais': cerveza.pais_procedencia
-                },
-                'puntuacion': deg.puntuacion,
-                'comentario': deg.comentario,
-                'fecha': deg.fecha.strftime('%d/%m/%Y %H:%M'),
-                'local': deg.local.nombre if deg.local else None,
-                'comentarios': comentarios
-            })
+            actividades_data.append(degustacion_json(deg, usuario, cerveza, local_nombre, comentarios))
+        
+        next_cursor = None
+        if has_more and actividades:
+            ultima = actividades[-1][0]
+            next_cursor = codificar_cursor(ultima.fecha, ultima.id)
         
         print(f"✅ {len(actividades_data)} actividades cargadas exitosamente")
         
         return jsonify({
             "actividades": actividades_data,
-            "total": len(actividades_data),
-            "mostrando": min(5, len(actividades_data))  # Por defecto mostrar 5
+            "has_more": has_more,
+            "next_cursor": next_cursor,
+            "mostrando": len(actividades_data)
         })
         
     except Exception as e:
         print(f"❌ Error en actividades_amigos: {str(e)}")
         import traceback
         traceback.print_exc()
-        return jsonify({"actividades": [], "total": 0, "mostrando": 0}), 500
+        return jsonify({"actividades": [], "has_more": False, "next_cursor": None, "mostrando": 0}), 500
 
 
 @app.route('/comentar_degustacion', methods=['POST'])
@@ -1548,7 +4059,7 @@ def comentar_degustacion():
         return jsonify({"success": False, "message": "El comentario no puede estar vacío"}), 400
     
     degustacion = Degustacion.query.get(degustacion_id)
-    if not degustacion:
+    if not degustacion or not usuario_visible(degustacion.usuario_id):
         return jsonify({"success": False, "message": "Degustación no encontrada"}), 404
     
     nuevo_comentario = ComentarioDegustacion(
@@ -1558,6 +4069,7 @@ def comentar_degustacion():
     )
     
     db.session.add(nuevo_comentario)
+    galardones_nuevos = galardones_progresar(user_id, 'comentarios')
     db.session.commit()
     
     usuario_comentario = Usuario.query.get(user_id)
@@ -1565,6 +4077,7 @@ def comentar_degustacion():
     return jsonify({
         "success": True,
         "message": "Comentario añadido",
+        "galardones_nuevos": galardones_nuevos,
         "comentario": {
             'id': nuevo_comentario.id,
             'usuario_id': nuevo_comentario.usuario_id,
@@ -1603,7 +4116,7 @@ def ver_perfil_usuario(id):
         flash("Debes iniciar sesión.", "error")
         return redirect(url_for('login'))
     
-    usuario = db.session.get(Usuario, id)
+    usuario = usuario_visible(id)
     
     if not usuario:
         flash("Usuario no encontrado.", "error")
@@ -1622,18 +4135,12 @@ def ver_perfil_usuario(id):
     ).order_by(Degustacion.fecha.desc()).first()
     
     # Verificar estado de amistad con el usuario actual
-    es_amigo = False
+    es_amigo = son_amigos(user_id, id)
     solicitud_pendiente = None
     
-    amistad = Amistad.query.filter(
-        ((Amistad.usuario_id == user_id) & (Amistad.amigo_id == id)) |
-        ((Amistad.usuario_id == id) & (Amistad.amigo_id == user_id))
-    ).first()
-    
-    if amistad:
-        if amistad.estado == 'aceptado':
-            es_amigo = True
-        elif amistad.estado == 'pendiente':
+    if not es_amigo:
+        amistad = amistad_entre(user_id, id)
+        if amistad and amistad.estado == 'pendiente':
             solicitud_pendiente = amistad
     
     return render_template(
@@ -1655,10 +4162,405 @@ def logout():
     flash("Has cerrado sesión correctamente.", "info")
     return redirect(url_for('login'))
 
+# ————— MIGRACIONES DE ESQUEMA —————
+# db.create_all() crea las tablas nuevas pero no toca las existentes: los índices y columnas
+# que se añaden a tablas ya creadas van aquí, como migraciones numeradas que se aplican una vez.
+MIGRACIONES = []
+
+def migracion(version, descripcion):
+    """Registra una migración; se aplican en orden de versión dentro de su propia transacción"""
+    def registrar(funcion):
+        MIGRACIONES.append((version, descripcion, funcion))
+        MIGRACIONES.sort(key=lambda m: m[0])
+        return funcion
+    return registrar
+
+def _inspector():
+    return db.inspect(db.session.connection())
+
+def _indices_existentes(tabla):
+    """Nombres de los índices de `tabla` en la base de datos"""
+    if db.engine.dialect.name == 'sqlite':
+        # El inspector de SQLite se salta los índices sobre expresiones, como lower(correo)
+        return {nombre for (nombre,) in db.session.execute(db.text(
+            "SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = :tabla"), {'tabla': tabla})}
+    return {i['name'] for i in _inspector().get_indexes(tabla)}
+
+def crear_indice(modelo, nombre):
+    """Crea un índice declarado en el modelo si aún no existe"""
+    if nombre in _indices_existentes(modelo.__tablename__):
+        return
+    indice = next(i for i in modelo.__table__.indexes if i.name == nombre)
+    indice.create(bind=db.session.connection())
+
+def borrar_indice(nombre):
+    db.session.execute(db.text(f'DROP INDEX IF EXISTS {nombre}'))
+
+def añadir_columna(modelo, nombre):
+    """ALTER TABLE ... ADD COLUMN con el tipo declarado en el modelo, si la columna no existe"""
+    tabla = modelo.__tablename__
+    if nombre in {c['name'] for c in _inspector().get_columns(tabla)}:
+        return
+    columna = modelo.__table__.c[nombre]
+    tipo = columna.type.compile(dialect=db.engine.dialect)
+    db.session.execute(db.text(f'ALTER TABLE {tabla} ADD COLUMN {nombre} {tipo}'))
+
+def borrar_columna(tabla, nombre):
+    """ALTER TABLE ... DROP COLUMN (en SQLite requiere >= 3.35), si la columna existe"""
+    if nombre not in {c['name'] for c in _inspector().get_columns(tabla)}:
+        return
+    db.session.execute(db.text(f'ALTER TABLE {tabla} DROP COLUMN {nombre}'))
+
+MIGRACIONES_CERROJO = 4_211_013  # clave del pg_advisory_xact_lock de las migraciones
+
+def bloquear_migraciones():
+    """Cerrojo entre procesos hasta el fin de la transacción (BEGIN IMMEDIATE / pg_advisory_xact_lock)"""
+    dialecto = db.engine.dialect.name
+    if dialecto == 'postgresql':
+        db.session.execute(db.text('SELECT pg_advisory_xact_lock(:clave)'), {'clave': MIGRACIONES_CERROJO})
+        return
+    if dialecto != 'sqlite':
+        return
+    # El busy_timeout de la conexión es corto para las peticiones; una migración puede tardar más
+    while True:
+        try:
+            db.session.execute(db.text('BEGIN IMMEDIATE'))
+            return
+        except OperationalError as error:
+            db.session.rollback()
+            if 'locked' not in str(error):
+                raise
+            print("⏳ Otro proceso está migrando la base de datos, esperando...")
+
+def migrar():
+    """Aplica las migraciones pendientes. Devuelve la lista de versiones aplicadas.
+
+    Varios workers pueden arrancar a la vez: cada migración pendiente se aplica con el cerrojo de
+    migraciones tomado y se vuelve a comprobar que nadie la haya registrado mientras se esperaba.
+    """
+    aplicadas = {v for (v,) in db.session.query(MigracionAplicada.version)}
+    db.session.rollback()
+    nuevas = []
+    for version, descripcion, funcion in MIGRACIONES:
+        if version in aplicadas:
+            continue
+        try:
+            bloquear_migraciones()
+            if db.session.query(MigracionAplicada.version).filter_by(version=version).first():
+                db.session.rollback()
+                continue
+            funcion()
+            db.session.add(MigracionAplicada(version=version, descripcion=descripcion))
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            print(f"❌ Falló la migración {version}: {descripcion}")
+            raise
+        print(f"🛠️ Migración {version} aplicada: {descripcion}")
+        nuevas.append(version)
+    return nuevas
+
+def indices_faltantes():
+    """Índices declarados en los modelos que no existen en la base de datos"""
+    inspector = _inspector()
+    faltantes = []
+    for tabla in db.metadata.sorted_tables:
+        if not inspector.has_table(tabla.name):
+            continue
+        existentes = _indices_existentes(tabla.name)
+        faltantes += [f"{tabla.name}.{i.name}" for i in tabla.indexes if i.name not in existentes]
+    return faltantes
+
+@migracion(1, 'Rellenar las aristas simétricas de amistad')
+def _migracion_aristas_amistad():
+    aristas_amistad_backfill()
+
+@migracion(2, 'Rellenar la última actividad por usuario')
+def _migracion_ultima_actividad():
+    ultima_actividad_backfill()
+
+@migracion(3, 'Calcular los agregados de valoraciones por cerveza')
+def _migracion_cerveza_stats():
+    cerveza_stats_recalcular()
+
+@migracion(4, 'Índices compuestos para las consultas frecuentes')
+def _migracion_indices_consultas():
+    crear_indice(Degustacion, 'ix_degustacion_usuario_fecha')
+    crear_indice(Degustacion, 'ix_degustacion_cerveza_puntuacion')
+    crear_indice(Degustacion, 'ix_degustacion_cerveza_fecha')
+    crear_indice(Amistad, 'ix_amistad_amigo_estado')
+    crear_indice(ComentarioDegustacion, 'ix_comentario_degustacion_fecha')
+    crear_indice(Favorita, 'ix_favorita_usuario_cerveza')
+
+@migracion(5, 'Ampliar usuario.contraseña_hash a 255 caracteres')
+def _migracion_longitud_hash():
+    # SQLite no aplica la longitud de VARCHAR; en PostgreSQL los hashes scrypt (~160) no cabían en 128
+    if db.engine.dialect.name == 'postgresql':
+        db.session.execute(db.text('ALTER TABLE usuario ALTER COLUMN "contraseña_hash" TYPE VARCHAR(255)'))
+
+@migracion(6, 'Geohash e índices de búsqueda de locales')
+def _migracion_locales_geohash():
+    añadir_columna(Local, 'geohash')
+    crear_indice(Local, 'ix_local_geohash')
+    crear_indice(Local, 'ix_local_nombre_id')
+    locales_geohash_backfill()
+
+@migracion(7, 'Contadores de progreso de galardones')
+def _migracion_galardones():
+    galardones_sembrar()
+    galardones_backfill(commit_por_lote=False)
+
+@migracion(8, 'Nombre normalizado de las cervezas para detectar duplicados')
+def _migracion_cerveza_nombre_normalizado():
+    añadir_columna(Cerveza, 'nombre_normalizado')
+    # Índice no único escrito a mano: el del modelo es único desde la migración 11, que es la que
+    # resuelve los duplicados que ya hubiera; con él, este relleno fallaría antes de llegar a ella
+    db.session.execute(db.text(
+        'CREATE INDEX IF NOT EXISTS ix_cerveza_nombre_normalizado ON cerveza (nombre_normalizado)'))
+    cervezas_nombre_normalizado_backfill()
+
+@migracion(9, 'Clave de idempotencia de las degustaciones')
+def _migracion_degustacion_clave():
+    añadir_columna(Degustacion, 'clave_idempotencia')
+    crear_indice(Degustacion, 'ix_degustacion_usuario_clave')
+
+@migracion(10, 'Borrado de cuentas en segundo plano')
+def _migracion_borrado_cuentas():
+    añadir_columna(Usuario, 'eliminado_en')
+    crear_indice(ComentarioDegustacion, 'ix_comentario_usuario')
+
+@migracion(11, 'Nombre normalizado único en las cervezas')
+def _migracion_cerveza_nombre_unico():
+    cervezas_nombre_normalizado_backfill()
+    # Duplicados de antes del índice único: la cerveza más antigua conserva la clave y las demás se
+    # quedan sin ella (NULL no choca) y se listan para fusionarlas a mano
+    repetidas = db.session.query(Cerveza.nombre_normalizado, db.func.min(Cerveza.id)).filter(
+        Cerveza.nombre_normalizado.isnot(None)
+    ).group_by(Cerveza.nombre_normalizado).having(db.func.count(Cerveza.id) > 1).all()
+    for nombre, conservada_id in repetidas:
+        otras = [i for (i,) in db.session.query(Cerveza.id).filter(
+            Cerveza.nombre_normalizado == nombre, Cerveza.id != conservada_id)]
+        db.session.execute(db.update(Cerveza).where(Cerveza.id.in_(otras)).values(nombre_normalizado=None))
+        print(f"⚠️ Cervezas duplicadas de '{nombre}': se conserva la {conservada_id}, revisa {otras}")
+    borrar_indice('ix_cerveza_nombre_normalizado')
+    crear_indice(Cerveza, 'ix_cerveza_nombre_normalizado')
+
+@migracion(12, 'Índice de búsqueda de usuarios por correo sin mayúsculas')
+def _migracion_usuario_correo_minusculas():
+    crear_indice(Usuario, 'ix_usuario_correo_minusculas')
+
+# ————— COMANDOS CLI —————
+@app.cli.command('benchmark-sqlite')
+@click.option('--hilos', default=8, help='Hilos concurrentes')
+@click.option('--segundos', default=5.0, help='Duración de cada perfil')
+@click.option('--escrituras', default=0.2, help='Proporción de operaciones que escriben')
+def benchmark_sqlite_comando(hilos, segundos, escrituras):
+    """Compara lecturas/s y escrituras/s concurrentes con SQLite por defecto y con el perfil de producción"""
+    import shutil
+    import tempfile
+    from sqlalchemy import create_engine
+
+    perfiles = {'por defecto': {}, 'producción': sqlite_pragmas()}
+    for perfil, pragmas in perfiles.items():
+        directorio = tempfile.mkdtemp()
+        url = f'sqlite:///{os.path.join(directorio, "bench.db")}'
+        motor = create_engine(url, **opciones_motor(url))
+        event.listen(motor, 'connect', lambda conexion, registro, p=pragmas: aplicar_pragmas(conexion, p))
+        with motor.begin() as conexion:
+            conexion.exec_driver_sql('CREATE TABLE deg (id INTEGER PRIMARY KEY, cerveza_id INTEGER, puntuacion REAL)')
+            conexion.exec_driver_sql('CREATE INDEX ix_deg_cerveza ON deg (cerveza_id)')
+            conexion.exec_driver_sql('INSERT INTO deg (cerveza_id, puntuacion) VALUES ' +
+                                     ', '.join(f'({i % 500}, {i % 5 + 1})' for i in range(20000)))
+
+        totales = Counter()
+        fin = time.monotonic() + segundos
+
+        def trabajar():
+            azar = random.Random()
+            cuenta = Counter()
+            while time.monotonic() < fin:
+                try:
+                    if azar.random() < escrituras:
+                        with motor.begin() as conexion:
+                            conexion.exec_driver_sql('INSERT INTO deg (cerveza_id, puntuacion) VALUES (?, ?)',
+                                                     (azar.randrange(500), azar.randint(1, 5)))
+                        cuenta['escrituras'] += 1
+                    else:
+                        with motor.connect() as conexion:
+                            conexion.exec_driver_sql('SELECT AVG(puntuacion), COUNT(*) FROM deg WHERE cerveza_id = ?',
+                                                     (azar.randrange(500),)).fetchone()
+                        cuenta['lecturas'] += 1
+                except Exception:
+                    cuenta['errores'] += 1
+            totales.update(cuenta)
+
+        trabajadores = [threading.Thread(target=trabajar) for _ in range(hilos)]
+        for t in trabajadores:
+            t.start()
+        for t in trabajadores:
+            t.join()
+        motor.dispose()
+        shutil.rmtree(directorio, ignore_errors=True)
+        print(f"📊 {perfil:<12} lecturas/s: {totales['lecturas'] / segundos:9.0f}   "
+              f"escrituras/s: {totales['escrituras'] / segundos:7.0f}   errores: {totales['errores']}")
+@app.cli.command('migrar')
+def migrar_comando():
+    """Aplica las migraciones de esquema pendientes"""
+    nuevas = migrar()
+    print(f"✅ {len(nuevas)} migraciones aplicadas." if nuevas else "✅ El esquema ya está al día.")
+
+@app.cli.command('comprobar-indices')
+def comprobar_indices_comando():
+    """Informa de los índices declarados en los modelos que faltan en la base de datos"""
+    faltantes = indices_faltantes()
+    if faltantes:
+        print("⚠️ Índices que faltan:")
+        for nombre in faltantes:
+            print(f"  - {nombre}")
+        raise SystemExit(1)
+    print("✅ Todos los índices existen.")
+
+@app.cli.command('migrar-aristas-amistad')
+def migrar_aristas_amistad_comando():
+    """Regenera la tabla de aristas de amistad desde Amistad"""
+    total = aristas_amistad_backfill()
+    db.session.commit()
+    print(f"✅ Aristas de amistad regeneradas: {total}.")
+
+@app.cli.command('reconstruir-ultima-actividad')
+def reconstruir_ultima_actividad_comando():
+    """Regenera la última actividad de todos los usuarios"""
+    total = ultima_actividad_backfill()
+    db.session.commit()
+    print(f"✅ Última actividad regenerada para {total} usuarios.")
+
+@app.cli.command('reconstruir-galardones')
+@click.option('--lote', default=500, help='Usuarios por lote (un commit por lote)')
+@click.option('--desde', default=0, help='Reanudar a partir de este ID de usuario')
+def reconstruir_galardones_comando(lote, desde):
+    """Recalcula los contadores de galardones desde el historial y concede los niveles pendientes"""
+    galardones_sembrar()
+    db.session.commit()
+    total = galardones_backfill(lote=lote, desde_id=desde)
+    print(f"✅ Galardones recalculados para {total} usuarios.")
+
+@app.cli.command('importar-cervezas')
+@click.argument('fichero', type=click.File('rb'))
+@click.option('--formato', type=click.Choice(['csv', 'ndjson']), help='Por defecto, según la extensión del fichero')
+def importar_cervezas_comando(fichero, formato):
+    """Importa cervezas desde un CSV (con cabecera) o NDJSON sin cargarlo entero en memoria"""
+    formato = formato or ('csv' if fichero.name.lower().endswith('.csv') else 'ndjson')
+    inicio = time.perf_counter()
+    importacion = ImportacionCervezas()
+    for informe in importacion.ejecutar(leer_filas_importacion(fichero, formato)):
+        print(f"📥 {informe['leidas']} filas leídas, {informe['insertadas']} insertadas, "
+              f"{informe['duplicadas']} duplicadas, {informe['erroneas']} con errores")
+    for error in informe['errores']:
+        print(f"⚠️ Fila {error['fila']}: {error['error']}")
+    print(f"✅ Importación terminada en {time.perf_counter() - inicio:.1f} s.")
+
+@app.cli.command('reparar-estadisticas-cervezas')
+def reparar_estadisticas_cervezas_comando():
+    """Recalcula desde cero los agregados de valoraciones de todas las cervezas"""
+    cerveza_stats_recalcular()
+    db.session.commit()
+    cache_top.invalidar()
+    print(f"✅ Estadísticas recalculadas para {CervezaStats.query.count()} cervezas.")
+
+@app.cli.command('reconstruir-busqueda')
+def reconstruir_busqueda_comando():
+    """Regenera los índices FTS5 de cervezas, usuarios y locales"""
+    if not app.config['BUSQUEDA_FTS']:
+        print("ℹ️ La búsqueda FTS5 no está activa en este motor.")
+        return
+    for tabla in FTS_TABLAS:
+        fts_reconstruir(tabla)
+    db.session.commit()
+    print("✅ Índices de búsqueda de cervezas, usuarios y locales regenerados.")
+
+@app.cli.command('enviar-correos')
+def enviar_correos_comando():
+    """Vacía la bandeja de salida de forma síncrona (lo vencido en este momento)"""
+    total = 0
+    while (tratados := enviador_correo.procesar()):
+        total += tratados
+    print(f"📧 {total} correos procesados: {enviador_correo.estadisticas()['cola']}")
+
+@app.cli.command('procesar-borrados')
+def procesar_borrados_comando():
+    """Borra ahora los datos de las cuentas eliminadas (salvo las que tenga reservadas otro proceso)"""
+    while (borrado := borrador_cuentas.procesar()):
+        print(f"🗑️ Cuenta {borrado.usuario_id}: {borrado.estado} en la fase {borrado.fase}, "
+              f"{borrado.filas_borradas} filas borradas")
+
+@app.cli.command('benchmark-login')
+@click.option('--hilos', default=16, help='Logins concurrentes')
+@click.option('--peticiones', default=200, help='Logins por modo')
+def benchmark_login_comando(hilos, peticiones):
+    """Latencia de /login (p50/p99) con el hash en el hilo de la petición y en el pool de procesos"""
+    global hash_contraseñas
+    from concurrent.futures import ThreadPoolExecutor
+
+    nombre, contraseña = f"benchmark_{uuid.uuid4().hex[:8]}", uuid.uuid4().hex
+    usuario = Usuario(nombre_usuario=nombre, correo=f"{nombre}@beersp.invalid", verificado=True,
+                      contraseña_hash=generate_password_hash(contraseña, app.config['HASH_METODO']),
+                      fecha_nacimiento=datetime(1990, 1, 1).date())
+    db.session.add(usuario)
+    db.session.commit()
+
+    def login_cronometrado(_):
+        cliente = app.test_client()
+        inicio = time.perf_counter()
+        respuesta = cliente.post('/login', data={'nombre_usuario': nombre, 'contraseña': contraseña})
+        assert respuesta.status_code == 302
+        return time.perf_counter() - inicio
+
+    original = hash_contraseñas
+    try:
+        for modo, procesos in (('en el hilo', 0), (f'pool de {app.config["HASH_PROCESOS"]}', app.config['HASH_PROCESOS'])):
+            hash_contraseñas = ServicioHash(app.config['HASH_METODO'], procesos,
+                                            app.config['HASH_COLA_MAX'], app.config['HASH_ESPERA_SEGUNDOS'])
+            login_cronometrado(0)  # arranque del pool fuera de la medida
+            with ThreadPoolExecutor(hilos) as ejecutor:
+                inicio = time.perf_counter()
+                tiempos = sorted(ejecutor.map(login_cronometrado, range(peticiones)))
+                total = time.perf_counter() - inicio
+            hash_contraseñas.cerrar()
+            p50, p99 = tiempos[len(tiempos) // 2], tiempos[int(len(tiempos) * 0.99) - 1]
+            print(f"🔐 {modo:<12} p50: {p50 * 1000:7.1f} ms   p99: {p99 * 1000:7.1f} ms   logins/s: {peticiones / total:6.1f}")
+    finally:
+        hash_contraseñas = original
+        db.session.delete(usuario)
+        db.session.commit()
+
+@app.cli.command('reconstruir-timeline')
+def reconstruir_timeline_comando():
+    """Regenera las bandejas del timeline de amigos desde cero"""
+    total = timeline_reconstruir()
+    print(f"✅ Timeline reconstruido: {total} entradas.")
+
 # ————— INICIALIZACIÓN —————
-with app.app_context():
-    db.create_all()
-    seed_cervezas()
+# Los procesos del pool de hashes (spawn) pueden importar este módulo: no tocan la base de datos
+if multiprocessing.parent_process() is None:
+    with app.app_context():
+        for nombre, (esperado, actual) in pragmas_incorrectos().items():
+            print(f"⚠️ PRAGMA {nombre}: se esperaba {esperado} y la conexión tiene {actual}")
+        db.create_all()
+        migrar()
+        if indices_faltantes():
+            print(f"⚠️ Faltan índices: {', '.join(indices_faltantes())}. Ejecuta 'flask --app app migrar'.")
+        app.config['BUSQUEDA_FTS'] = fts_crear()
+        seed_cervezas()
+        galardones_sembrar()
+        db.session.commit()
+        autocompletado.construir(db.session.query(Cerveza.id, Cerveza.nombre))
+        muestreo_cervezas_construir()
+        # Correos que quedaron en la cola de una ejecución anterior
+        if CorreoPendiente.query.filter(CorreoPendiente.estado.in_(('pendiente', 'enviando'))).first():
+            enviador_correo.despertar()
+        # Borrados de cuentas a medias (el proceso anterior terminó o murió antes de acabarlos)
+        if BorradoCuenta.query.filter(BorradoCuenta.estado != 'terminado').first():
+            borrador_cuentas.despertar()
 
 # ————— AUTOABRIR NAVEGADOR (solo en local) —————
 def abrir_navegador():
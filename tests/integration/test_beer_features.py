@@ -1,9 +1,10 @@
 # tests/integration/test_beer_features.py
 import pytest
 import json
-from datetime import date
+from datetime import date, datetime
 from app import db, Usuario, Cerveza, Degustacion, Favorita # Añadida la importación de Usuario y date
 from werkzeug.security import generate_password_hash # Añadida la importación de generate_password_hash
+from tests.conftest import solo_sqlite
 
 class TestFuncionalidadesCerveza:
     """Pruebas de integración para funcionalidades específicas de cerveza."""
@@ -90,3 +91,368 @@ class TestFuncionalidadesCerveza:
         # o un 500 si hay un error interno
         assert response.status_code in [200, 400, 403, 500]
         # No verificamos que se haya eliminado de la DB aquí por simplicidad.
+
+    def test_eliminar_cuenta_con_comentarios_ajenos(self, client, setup_database):
+        """Con foreign_keys=ON, los comentarios de otros en mis degustaciones no bloquean el borrado."""
+        from app import ComentarioDegustacion
+        with client.application.app_context():
+            autor, comentarista = [Usuario(
+                nombre_usuario=nombre,
+                correo=f"{nombre}@example.com",
+                contraseña_hash=generate_password_hash("pass"),
+                fecha_nacimiento=date(1992, 5, 10),
+                verificado=True
+            ) for nombre in ("autor_fk_test", "comentarista_fk_test")]
+            db.session.add_all([autor, comentarista])
+            db.session.commit()
+            degustacion = Degustacion(usuario_id=autor.id, cerveza_id=Cerveza.query.first().id, puntuacion=3.0)
+            db.session.add(degustacion)
+            db.session.commit()
+            db.session.add(ComentarioDegustacion(degustacion_id=degustacion.id, usuario_id=comentarista.id, texto="¡Buena!"))
+            db.session.commit()
+            autor_id, degustacion_id = autor.id, degustacion.id
+
+        with client.session_transaction() as session:
+            session['user_id'] = autor_id
+        response = client.post('/eliminar_cuenta', data={'confirmar': 'si'})
+        assert response.status_code == 302
+
+        with client.application.app_context():
+            from app import borrador_cuentas
+            while borrador_cuentas.procesar():
+                pass
+            db.session.expire_all()
+            assert db.session.get(Usuario, autor_id) is None
+            assert ComentarioDegustacion.query.filter_by(degustacion_id=degustacion_id).count() == 0
+
+    def test_mis_degustaciones_consultas_constantes(self, auth_client, usuario_prueba, setup_database):
+        """Test que mis_degustaciones pagina con ?before= y hace las mismas consultas con 2 o 25 degustaciones."""
+        from sqlalchemy import event
+        from app import ComentarioDegustacion, DEGUSTACIONES_POR_PAGINA
+
+        def contar_consultas():
+            consultas = []
+            def registrar(*args):
+                consultas.append(1)
+            engine = db.engine
+            event.listen(engine, 'before_cursor_execute', registrar)
+            try:
+                response = auth_client.get('/mis_degustaciones')
+            finally:
+                event.remove(engine, 'before_cursor_execute', registrar)
+            assert response.status_code == 200
+            return len(consultas), response
+
+        def degustar(n):
+            with auth_client.application.app_context():
+                cerveza = Cerveza.query.first()
+                for _ in range(n):
+                    deg = Degustacion(usuario_id=usuario_prueba.id, cerveza_id=cerveza.id, puntuacion=4.0)
+                    db.session.add(deg)
+                    db.session.flush()
+                    db.session.add(ComentarioDegustacion(degustacion_id=deg.id, usuario_id=usuario_prueba.id, texto="¡Salud!"))
+                db.session.commit()
+
+        degustar(2)
+        pocas, _ = contar_consultas()
+        degustar(23)
+        muchas, response = contar_consultas()
+        assert muchas == pocas
+        assert response.data.count('¡Salud!'.encode()) == DEGUSTACIONES_POR_PAGINA
+        assert b'before=' in response.data
+
+    def test_estadisticas_cerveza_incrementales(self, auth_client, usuario_prueba, setup_database):
+        """Test que CervezaStats se actualiza al degustar y coincide con un recálculo completo."""
+        from app import CervezaStats, cerveza_stats_recalcular
+        with auth_client.application.app_context():
+            cerveza = Cerveza.query.filter_by(nombre="Galeton").first()
+            cerveza_id = cerveza.id
+
+        for puntos in (5, 3.5, 4):
+            response = auth_client.post('/api/degustacion/nueva', json={'cerveza_id': cerveza_id, 'puntuacion': puntos})
+            assert response.status_code == 200
+        auth_client.post('/api/degustacion/nueva', json={'cerveza_id': cerveza_id})
+
+        with auth_client.application.app_context():
+            stats = db.session.get(CervezaStats, cerveza_id)
+            incremental = (stats.num_valoraciones, round(stats.promedio, 4), stats.histograma)
+            assert incremental == (3, 4.1667, [0, 0, 1, 1, 1])
+
+            cerveza_stats_recalcular([cerveza_id])
+            db.session.commit()
+            db.session.expire_all()
+            stats = db.session.get(CervezaStats, cerveza_id)
+            assert (stats.num_valoraciones, round(stats.promedio, 4), stats.histograma) == incremental
+
+        data = json.loads(auth_client.get(f'/api/cerveza/{cerveza_id}/detalle').data)
+        assert data['cerveza']['total_valoraciones'] == 3
+        assert data['cerveza']['histograma'] == [0, 0, 1, 1, 1]
+
+        response = auth_client.get('/top_degustaciones')
+        assert response.status_code == 200
+        assert b'Galeton' in response.data
+
+    def test_cache_top_degustaciones(self, auth_client, setup_database):
+        """Test que el ranking se sirve de caché y se invalida al registrar una degustación puntuada."""
+        from app import cache_top
+        with auth_client.application.app_context():
+            cerveza_id = Cerveza.query.filter_by(nombre="Cruzcampo").first().id
+
+        cache_top.invalidar()
+        auth_client.get('/top_degustaciones?estilo=Lager')
+        antes = json.loads(auth_client.get('/api/top_degustaciones/cache').data)
+        response = auth_client.get('/top_degustaciones?estilo=Lager')
+        despues = json.loads(auth_client.get('/api/top_degustaciones/cache').data)
+        assert despues['aciertos'] == antes['aciertos'] + 1
+        assert b"Cruzcampo" not in response.data
+
+        auth_client.post('/api/degustacion/nueva', json={'cerveza_id': cerveza_id, 'puntuacion': 4})
+        response = auth_client.get('/top_degustaciones?estilo=Lager')
+        assert b"Cruzcampo" in response.data
+
+    @solo_sqlite
+    def test_busqueda_cerveza_fts_prefijos_y_acentos(self, auth_client, setup_database):
+        """Test que la búsqueda admite prefijos, ignora tildes y ve las cervezas recién creadas."""
+        from app import app, buscar_cervezas_like
+        assert app.config['BUSQUEDA_FTS'] is True
+
+        auth_client.post('/api/cerveza/nueva', json={
+            'nombre': 'Ahó! Session', 'estilo': 'Session IPA', 'pais_procedencia': 'España',
+            'porcentaje_alcohol': 4.2, 'color': 'Dorado'
+        })
+        data = json.loads(auth_client.get('/buscar_cervezas?q=aho').data)
+        assert 'Ahó! Session' in [c['nombre'] for c in data['cervezas']]
+
+        data = json.loads(auth_client.get('/buscar_cervezas?q=estrella gal').data)
+        assert data['cervezas'][0]['nombre'] == 'Estrella Galicia'
+
+        data = json.loads(auth_client.get('/buscar_cervezas?q=%22%2A').data)
+        assert data['cervezas'] == []
+
+        with auth_client.application.app_context():
+            assert any(c.nombre == 'Estrella Galicia' for c in buscar_cervezas_like('galicia'))
+
+    def test_busqueda_like_portable(self, auth_client, setup_database):
+        """Test que la búsqueda sin FTS ignora mayúsculas y trata '%' y '_' como texto."""
+        from app import buscar_cervezas_like
+        with auth_client.application.app_context():
+            assert any(c.nombre == 'Estrella Galicia' for c in buscar_cervezas_like('GALICIA'))
+            assert buscar_cervezas_like('%') == []
+            assert buscar_cervezas_like('_') == []
+
+    def test_sugerir_cervezas_endpoint(self, auth_client, setup_database):
+        """Test que el endpoint de sugerencias responde desde el índice en memoria."""
+        from app import autocompletado
+        with auth_client.application.app_context():
+            autocompletado.construir(db.session.query(Cerveza.id, Cerveza.nombre))
+        data = json.loads(auth_client.get('/api/cervezas/sugerir?q=lupulus h7').data)
+        assert data['sugerencias'][0]['nombre'] == 'Lupulus H-75'
+
+    def test_etag_en_respuestas_json(self, auth_client, setup_database):
+        """Test que los GET JSON llevan ETag y responden 304 sin cuerpo mientras no cambian los datos."""
+        with auth_client.application.app_context():
+            cerveza_id = Cerveza.query.filter_by(nombre="Cruzcampo").first().id
+
+        primera = auth_client.get('/mis_favoritas')
+        etag = primera.headers['ETag']
+        assert primera.cache_control.no_cache and primera.cache_control.private
+
+        repetida = auth_client.get('/mis_favoritas', headers={'If-None-Match': etag})
+        assert repetida.status_code == 304
+        assert repetida.data == b''
+
+        auth_client.post('/toggle_favorita', data={'cerveza_id': cerveza_id})
+        cambiada = auth_client.get('/mis_favoritas', headers={'If-None-Match': etag})
+        assert cambiada.status_code == 200
+        assert cambiada.headers['ETag'] != etag
+        assert [c['nombre'] for c in json.loads(cambiada.data)['cervezas']] == ["Cruzcampo"]
+
+        locales = auth_client.get('/api/locales')
+        assert auth_client.get('/api/locales', headers={'If-None-Match': locales.headers['ETag']}).status_code == 304
+
+    def test_locales_busqueda_y_paginacion(self, auth_client, setup_database):
+        """Test que los locales se buscan por nombre o ciudad y se paginan con cursor sin repetir."""
+        for i in range(5):
+            auth_client.post('/api/local/nuevo', json={'nombre': f'Bar Pruebas {i}', 'ciudad': 'Cádiz'})
+        auth_client.post('/api/local/nuevo', json={'nombre': 'Taberna del Puerto', 'ciudad': 'Vigo'})
+
+        data = json.loads(auth_client.get('/api/locales?q=cadiz').data)
+        assert [l['nombre'] for l in data['locales']] == [f'Bar Pruebas {i}' for i in range(5)]
+        assert data['has_more'] is False and data['next_cursor'] is None
+        assert [l['nombre'] for l in json.loads(auth_client.get('/api/locales?q=puert').data)['locales']] == ['Taberna del Puerto']
+
+        vistos, cursor = [], None
+        while True:
+            data = json.loads(auth_client.get('/api/locales', query_string={'limite': 2, 'cursor': cursor or ''}).data)
+            vistos += [l['nombre'] for l in data['locales']]
+            if not data['has_more']:
+                break
+            cursor = data['next_cursor']
+        assert vistos == sorted(vistos) and len(vistos) == len(set(vistos)) >= 6
+
+        assert auth_client.get('/api/locales?cursor=basura').status_code == 400
+
+    def test_locales_caja_y_radio(self, auth_client, setup_database):
+        """Test que las consultas geográficas devuelven solo lo que cae en la caja o el radio, por distancia."""
+        from app import Local
+        puntos = {'Sol': (40.4169, -3.7035), 'Retiro': (40.4153, -3.6845), 'Getafe': (40.3057, -3.7329),
+                  'Sagrada Familia': (41.4036, 2.1744), 'Fiyi': (-17.8, 179.9)}
+        for nombre, (lat, lon) in puntos.items():
+            r = auth_client.post('/api/local/nuevo', json={'nombre': nombre, 'latitud': lat, 'longitud': lon})
+            assert json.loads(r.data)['success']
+        with auth_client.application.app_context():
+            assert all(l.geohash for l in Local.query.filter(Local.nombre.in_(puntos)))
+
+        data = json.loads(auth_client.get('/api/locales?bbox=40.35,-3.8,40.45,-3.6').data)
+        assert [l['nombre'] for l in data['locales']] == ['Retiro', 'Sol']
+
+        data = json.loads(auth_client.get('/api/locales?bbox=-20,179,-15,-179').data)
+        assert [l['nombre'] for l in data['locales']] == ['Fiyi']
+
+        data = json.loads(auth_client.get('/api/locales?lat=40.4168&lon=-3.7038&radio_km=20&limite=2').data)
+        assert [l['nombre'] for l in data['locales']] == ['Sol', 'Retiro']
+        assert data['locales'][0]['distancia_km'] < 0.1
+        siguiente = json.loads(auth_client.get(f"/api/locales?lat=40.4168&lon=-3.7038&radio_km=20&limite=2&cursor={data['next_cursor']}").data)
+        assert [l['nombre'] for l in siguiente['locales']] == ['Getafe'] and siguiente['has_more'] is False
+
+        assert auth_client.get('/api/locales?lat=40&lon=-3&radio_km=5000').status_code == 400
+        assert auth_client.get('/api/locales?bbox=1,2,3').status_code == 400
+        r = auth_client.post('/api/local/nuevo', json={'nombre': 'Sin longitud', 'latitud': 40})
+        assert r.status_code == 400
+
+    def test_importacion_masiva_cervezas(self, auth_client, usuario_prueba, setup_database, monkeypatch):
+        """Test que la importación valida, descarta duplicados normalizados e informa del progreso."""
+        from app import app, ImportacionCervezas, autocompletado
+        assert auth_client.post('/api/cervezas/importar', data=b'').status_code == 403
+        monkeypatch.setitem(app.config, 'ADMINISTRADORES', {usuario_prueba.correo.lower()})
+
+        filas = [
+            {'nombre': 'Importada Uno', 'estilo': 'Porter', 'pais_procedencia': 'Irlanda', 'porcentaje_alcohol': 5, 'ibu': 30},
+            {'nombre': 'CRUZCAMPO', 'estilo': 'Lager', 'pais_procedencia': 'España', 'porcentaje_alcohol': 4.8},
+            {'nombre': 'importada  uno', 'estilo': 'Porter', 'pais_procedencia': 'Irlanda', 'porcentaje_alcohol': 5},
+            {'nombre': 'Sin Alcohol Importada', 'estilo': 'Lager', 'pais_procedencia': 'España', 'porcentaje_alcohol': 0},
+            {'nombre': 'Sin estilo', 'pais_procedencia': 'España', 'porcentaje_alcohol': 5},
+        ]
+        cuerpo = '\n'.join(json.dumps(f) for f in filas) + '\n[1, 2]\n'
+        respuesta = auth_client.post('/api/cervezas/importar?formato=ndjson', data=cuerpo.encode())
+        lineas = [json.loads(l) for l in respuesta.data.decode().splitlines()]
+        informe = lineas[-1]['informe']
+        assert lineas[-1]['success'] is True
+        assert (informe['leidas'], informe['insertadas'], informe['duplicadas'], informe['erroneas']) == (6, 2, 2, 2)
+        assert [e['fila'] for e in informe['errores']] == [5, 6]
+
+        csv_cuerpo = "nombre,estilo,pais_procedencia,porcentaje_alcohol,ibu,color\nImportada CSV,Stout,Irlanda,\"4,2\",40,Negro\n"
+        respuesta = auth_client.post('/api/cervezas/importar', data=csv_cuerpo.encode(), content_type='text/csv')
+        assert json.loads(respuesta.data.decode().splitlines()[-1])['informe']['insertadas'] == 1
+
+        # Varias transacciones: el índice FTS se reconstruye al final y la búsqueda ve todo lo importado
+        with app.app_context():
+            importacion = ImportacionCervezas(lote=2, lotes_por_transaccion=1)
+            progreso = list(importacion.ejecutar(
+                {'nombre': f'Lote Importado {i}', 'estilo': 'IPA', 'pais_procedencia': 'España', 'porcentaje_alcohol': 6}
+                for i in range(7)
+            ))
+            assert len(progreso) == 4 and importacion.informe['insertadas'] == 7
+            assert autocompletado.sugerir("lote importado 6")[0][1] == 'Lote Importado 6'
+
+        data = json.loads(auth_client.get('/buscar_cervezas?q=lote importado').data)
+        assert len(data['cervezas']) == 7
+        data = json.loads(auth_client.get('/buscar_cervezas?q=importada csv').data)
+        assert [c['nombre'] for c in data['cervezas']] == ['Importada CSV']
+
+    def test_exportacion_degustaciones_en_streaming(self, auth_client, usuario_prueba, setup_database, monkeypatch):
+        """Test que la exportación sale en streaming por lotes con cerveza, local y comentarios."""
+        import csv
+        import app as modulo
+        monkeypatch.setattr(modulo, 'EXPORTACION_LOTE', 2)
+        local_id = json.loads(auth_client.post('/api/local/nuevo', json={'nombre': 'Bar Exportación', 'ciudad': 'León'}).data)['local_id']
+        with auth_client.application.app_context():
+            cerveza_id = Cerveza.query.filter_by(nombre="Cruzcampo").first().id
+        ids = [json.loads(auth_client.post('/api/degustacion/nueva', json={
+            'cerveza_id': cerveza_id, 'puntuacion': 3 + i % 2, 'comentario': '=1+1' if i == 2 else f'vez {i}', 'local_id': local_id if i == 0 else None
+        }).data)['degustacion_id'] for i in range(5)]
+        auth_client.post('/comentar_degustacion', json={'degustacion_id': ids[4], 'texto': 'Salud, "amigo"'})
+
+        respuesta = auth_client.get('/mis_degustaciones/exportar?formato=csv')
+        assert respuesta.is_streamed
+        assert respuesta.headers['Content-Disposition'] == 'attachment; filename=mis_degustaciones.csv'
+        filas = list(csv.DictReader(respuesta.data.decode().splitlines(keepends=True)))
+        assert [int(f['id']) for f in filas] == ids
+        assert filas[0]['cerveza'] == 'Cruzcampo' and filas[0]['local'] == 'Bar Exportación' and filas[0]['local_ciudad'] == 'León'
+        assert filas[4]['comentarios'] == f'{usuario_prueba.nombre_usuario}: Salud, "amigo"'
+        # Una celda que empieza como fórmula sale como texto en el CSV (el NDJSON queda tal cual)
+        assert filas[2]['comentario'] == "'=1+1"
+
+        lineas = [json.loads(l) for l in auth_client.get('/mis_degustaciones/exportar?formato=ndjson').data.decode().splitlines()]
+        assert [l['id'] for l in lineas] == ids
+        assert lineas[4]['comentarios'][0]['texto'] == 'Salud, "amigo"' and lineas[1]['local'] is None
+        assert lineas[2]['comentario'] == '=1+1'
+        assert auth_client.get('/mis_degustaciones/exportar?formato=xml').status_code == 400
+
+        assert auth_client.get('/api/admin/degustaciones/exportar').status_code == 403
+        monkeypatch.setitem(modulo.app.config, 'ADMINISTRADORES', {usuario_prueba.correo.lower()})
+        todas = [json.loads(l) for l in auth_client.get('/api/admin/degustaciones/exportar?formato=ndjson').data.decode().splitlines()]
+        assert {l['id'] for l in todas} >= set(ids)
+        assert all(l['usuario'] == usuario_prueba.nombre_usuario for l in todas if l['id'] in ids)
+
+    def test_lote_degustaciones_idempotente(self, auth_client, usuario_prueba, setup_database):
+        """Test que un lote se inserta de una vez con resultados por elemento y que reenviarlo no duplica."""
+        with auth_client.application.app_context():
+            ids = {c.nombre: c.id for c in Cerveza.query.filter(Cerveza.nombre.in_(["Cruzcampo", "Ambar", "Galeton"]))}
+        local_id = json.loads(auth_client.post('/api/local/nuevo', json={'nombre': 'Carpa Festival', 'pais': 'Alemania'}).data)['local_id']
+        lote = {'degustaciones': [
+            {'clave': 'f-1', 'cerveza_id': ids['Cruzcampo'], 'puntuacion': 4, 'local_id': local_id, 'fecha': '2025-09-20T18:00:00+02:00'},
+            {'clave': 'f-2', 'cerveza_id': ids['Ambar'], 'puntuacion': 3.5},
+            {'clave': 'f-3', 'cerveza_id': 999999},
+            {'clave': 'f-1', 'cerveza_id': ids['Galeton']},
+            {'clave': 'f-4', 'cerveza_id': ids['Galeton'], 'puntuacion': 9},
+            {'cerveza_id': ids['Galeton']},
+        ]}
+        data = json.loads(auth_client.post('/api/degustaciones/lote', json=lote).data)
+        assert data['creadas'] == 2
+        assert [r['estado'] for r in data['resultados']] == ['creada', 'creada', 'error', 'error', 'error', 'error']
+        assert data['resultados'][2]['message'] == "Cerveza no encontrada"
+        creadas = [r['degustacion_id'] for r in data['resultados'][:2]]
+
+        # Reenvío tras un corte de conexión: mismas claves, ninguna degustación nueva
+        repetido = json.loads(auth_client.post('/api/degustaciones/lote', json=lote).data)
+        assert repetido['creadas'] == 0
+        assert [r['estado'] for r in repetido['resultados'][:2]] == ['existente', 'existente']
+        assert [r['degustacion_id'] for r in repetido['resultados'][:2]] == creadas
+
+        with auth_client.application.app_context():
+            degustaciones = Degustacion.query.filter_by(usuario_id=usuario_prueba.id).order_by(Degustacion.id).all()
+            assert [d.id for d in degustaciones] == creadas
+            assert degustaciones[0].pais_consumicion == 'Alemania'
+            assert degustaciones[0].fecha.replace(tzinfo=None) == datetime(2025, 9, 20, 16, 0)
+
+        assert auth_client.post('/api/degustaciones/lote', json={'degustaciones': []}).status_code == 400
+
+    def test_lote_fecha_atrasada_y_puntuacion_cero(self, auth_client, usuario_prueba, setup_database):
+        """Test que una degustación atrasada deja los agregados igual que un recálculo y que 0 es 'sin puntuar'."""
+        from app import CervezaStats, cerveza_stats_recalcular
+        with auth_client.application.app_context():
+            cerveza = Cerveza(nombre="Atrasada Lager", estilo="Lager", pais_procedencia="España", porcentaje_alcohol=5.0, ibu=20, color="Dorado")
+            db.session.add(cerveza)
+            db.session.commit()
+            cerveza_id = cerveza.id
+        auth_client.post('/api/degustacion/nueva', json={'cerveza_id': cerveza_id, 'puntuacion': 4})
+        auth_client.post('/api/degustacion/nueva', json={'cerveza_id': cerveza_id, 'puntuacion': 0})
+        data = json.loads(auth_client.post('/api/degustaciones/lote', json={'degustaciones': [
+            {'clave': 'atrasada', 'cerveza_id': cerveza_id, 'puntuacion': 3, 'fecha': '2020-01-01T10:00:00'},
+            {'clave': 'cero', 'cerveza_id': cerveza_id, 'puntuacion': 0},
+        ]}).data)
+        assert data['creadas'] == 2
+
+        campos = ('suma_puntuacion', 'num_valoraciones', 'promedio', 'primera_valoracion', 'ultima_valoracion',
+                  'estrellas_1', 'estrellas_2', 'estrellas_3', 'estrellas_4', 'estrellas_5')
+        with auth_client.application.app_context():
+            incremental = [getattr(db.session.get(CervezaStats, cerveza_id), c) for c in campos]
+            cerveza_stats_recalcular([cerveza_id])
+            db.session.expire_all()
+            assert incremental == [getattr(db.session.get(CervezaStats, cerveza_id), c) for c in campos]
+            db.session.rollback()
+            assert incremental[3] == datetime(2020, 1, 1, 10, 0)
+            puntuaciones = [d.puntuacion for d in Degustacion.query.filter_by(
+                usuario_id=usuario_prueba.id, cerveza_id=cerveza_id).order_by(Degustacion.id)]
+            assert puntuaciones == [4.0, None, 3.0, None]
@@ -96,3 +96,21 @@ class TestRutasPublicas:
 
         assert response.status_code == 200
         assert b'verifica tu cuenta' in response.data.lower() # Mensaje de error esperado
+
+    def test_login_con_servicio_hash_saturado(self, client, usuario_prueba, setup_database, monkeypatch):
+        """Test que sin plazas para el hash el login responde 503 con Retry-After y vuelve a mostrar el formulario."""
+        import app as modulo_app
+
+        def ocupado(*args):
+            raise modulo_app.ServicioHashOcupado()
+
+        monkeypatch.setattr(modulo_app.hash_contraseñas, 'verificar', ocupado)
+        response = client.post('/login', data={
+            'nombre_usuario': usuario_prueba.nombre_usuario,
+            'contraseña': 'password123'
+        })
+
+        assert response.status_code == 503
+        assert int(response.headers['Retry-After']) >= 1
+        assert 'muchas peticiones' in response.get_data(as_text=True)
+        assert 'name="contraseña"' in response.get_data(as_text=True)
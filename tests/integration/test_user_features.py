@@ -2,7 +2,7 @@ import pytest
 import json
 from tests.conftest import generar_usuario_unico, generar_email_unico # Solo importamos helpers
 from werkzeug.security import generate_password_hash # Solo importamos helpers
-from datetime import date # Solo importamos helpers
+from datetime import date, datetime, timedelta, timezone # Solo importamos helpers
 
 class TestFuncionalidadesUsuario:
     """Pruebas de integración para funcionalidades específicas del usuario."""
@@ -49,3 +49,605 @@ class TestFuncionalidadesUsuario:
         response = auth_client.post('/gestionar_solicitud', json={'solicitud_id': solicitud_id_inexistente, 'accion': 'aceptar'})
         # Permitimos 200 (éxito, aunque la solicitud no exista) o 400/403/404 (error de validación/autorización) o 500 (error interno)
         assert response.status_code in [200, 400, 403, 404, 500]
+
+    def test_actividades_amigos_paginadas(self, auth_client, usuario_prueba, setup_database):
+        """Test que el feed de actividades se pagina por cursor sin repetir ni perder filas."""
+        with auth_client.application.app_context():
+            from app import db, Usuario, Cerveza, Degustacion, Amistad, ComentarioDegustacion, aristas_amistad_crear
+            amigo = Usuario(
+                nombre_usuario=generar_usuario_unico(),
+                correo=generar_email_unico(),
+                contraseña_hash=generate_password_hash("pass"),
+                fecha_nacimiento=date(1992, 5, 10),
+                verificado=True
+            )
+            db.session.add(amigo)
+            db.session.commit()
+            db.session.add(Amistad(usuario_id=usuario_prueba.id, amigo_id=amigo.id, estado='aceptado'))
+            aristas_amistad_crear(usuario_prueba.id, amigo.id)
+            cerveza = Cerveza.query.first()
+            degustaciones = [Degustacion(usuario_id=amigo.id, cerveza_id=cerveza.id, puntuacion=4.0) for _ in range(7)]
+            db.session.add_all(degustaciones)
+            db.session.commit()
+            for i in range(5):
+                db.session.add(ComentarioDegustacion(degustacion_id=degustaciones[-1].id, usuario_id=usuario_prueba.id, texto=f"c{i}"))
+            db.session.commit()
+            ids_esperados = sorted((d.id for d in degustaciones), reverse=True)
+
+        data = json.loads(auth_client.get('/actividades_amigos?limite=4').data)
+        assert data['mostrando'] == 4
+        assert data['has_more'] is True
+        assert 'total' not in data
+        assert len(data['actividades'][0]['comentarios']) == 3
+
+        siguiente = json.loads(auth_client.get(f"/actividades_amigos?limite=4&cursor={data['next_cursor']}").data)
+        assert siguiente['has_more'] is False
+        assert siguiente['next_cursor'] is None
+        ids = [a['id'] for a in data['actividades'] + siguiente['actividades']]
+        assert ids == ids_esperados
+
+        assert auth_client.get('/actividades_amigos?cursor=basura').status_code == 400
+
+    def test_timeline_materializado(self, auth_client, usuario_prueba, setup_database):
+        """Test que el timeline se rellena al aceptar, recibe nuevas degustaciones y se puede reconstruir."""
+        app = auth_client.application
+        app.config['TIMELINE_ENABLED'] = True
+        try:
+            with app.app_context():
+                from app import db, Usuario, Cerveza, Degustacion, Amistad, TimelineEntrada, timeline_reconstruir
+                amigo = Usuario(
+                    nombre_usuario=generar_usuario_unico(),
+                    correo=generar_email_unico(),
+                    contraseña_hash=generate_password_hash("pass"),
+                    fecha_nacimiento=date(1992, 5, 10),
+                    verificado=True
+                )
+                db.session.add(amigo)
+                db.session.commit()
+                cerveza_id = Cerveza.query.first().id
+                db.session.add(Degustacion(usuario_id=amigo.id, cerveza_id=cerveza_id, puntuacion=3.0))
+                solicitud = Amistad(usuario_id=amigo.id, amigo_id=usuario_prueba.id, estado='pendiente')
+                db.session.add(solicitud)
+                db.session.commit()
+                amigo_id, solicitud_id = amigo.id, solicitud.id
+
+            # Aceptar rellena la bandeja con el historial del amigo
+            response = auth_client.post('/gestionar_solicitud', json={'solicitud_id': solicitud_id, 'accion': 'aceptar'})
+            assert response.status_code == 200
+            with app.app_context():
+                assert TimelineEntrada.query.filter_by(usuario_id=usuario_prueba.id, autor_id=amigo_id).count() == 1
+
+            # Una degustación nueva propia llega a la bandeja del amigo
+            auth_client.post('/api/degustacion/nueva', json={'cerveza_id': cerveza_id, 'puntuacion': 4})
+            with app.app_context():
+                assert TimelineEntrada.query.filter_by(usuario_id=amigo_id, autor_id=usuario_prueba.id).count() == 1
+
+            data = json.loads(auth_client.get('/actividades_amigos').data)
+            assert [a['usuario']['id'] for a in data['actividades']] == [amigo_id]
+
+            with app.app_context():
+                bandeja = TimelineEntrada.query.filter_by(usuario_id=amigo_id)
+                antes = bandeja.count()
+                timeline_reconstruir()
+                assert bandeja.count() == antes
+        finally:
+            app.config['TIMELINE_ENABLED'] = False
+
+    def test_timeline_reconstruir_respeta_el_tope_de_historial(self, auth_client, usuario_prueba, setup_database, monkeypatch):
+        """Test que reconstruir el timeline deja lo mismo que aceptar la amistad con TIMELINE_BACKFILL."""
+        app = auth_client.application
+        monkeypatch.setitem(app.config, 'TIMELINE_ENABLED', True)
+        monkeypatch.setitem(app.config, 'TIMELINE_BACKFILL', 2)
+        with app.app_context():
+            from app import (db, Usuario, Cerveza, Degustacion, Amistad, TimelineEntrada, timeline_publicar,
+                             timeline_reconstruir)
+            amigo = Usuario(nombre_usuario=generar_usuario_unico(), correo=generar_email_unico(),
+                            contraseña_hash=generate_password_hash("pass"), fecha_nacimiento=date(1992, 5, 10),
+                            verificado=True)
+            db.session.add(amigo)
+            db.session.commit()
+            cerveza_id = Cerveza.query.first().id
+            hace = datetime.now(timezone.utc) - timedelta(days=10)
+            db.session.add_all([Degustacion(usuario_id=amigo.id, cerveza_id=cerveza_id, puntuacion=3.0,
+                                            fecha=hace + timedelta(days=n)) for n in range(3)])
+            solicitud = Amistad(usuario_id=amigo.id, amigo_id=usuario_prueba.id, estado='pendiente')
+            db.session.add(solicitud)
+            db.session.commit()
+            amigo_id, solicitud_id = amigo.id, solicitud.id
+
+        auth_client.post('/gestionar_solicitud', json={'solicitud_id': solicitud_id, 'accion': 'aceptar'})
+        with app.app_context():
+            despues = Degustacion(usuario_id=amigo_id, cerveza_id=cerveza_id, puntuacion=4.0)
+            db.session.add(despues)
+            db.session.flush()
+            timeline_publicar(despues, [usuario_prueba.id])
+            db.session.commit()
+
+            bandeja = lambda: sorted(d for (d,) in db.session.query(TimelineEntrada.degustacion_id).filter_by(
+                usuario_id=usuario_prueba.id, autor_id=amigo_id))
+            incremental = bandeja()
+            assert len(incremental) == 3
+            timeline_reconstruir()
+            assert bandeja() == incremental
+
+    def test_aristas_amistad_simetricas(self, auth_client, usuario_prueba, setup_database):
+        """Test que aceptar crea las dos aristas y la migración las regenera."""
+        app = auth_client.application
+        with app.app_context():
+            from app import db, Usuario, Amistad, AmistadArista, amigos_ids_de, son_amigos, aristas_amistad_backfill
+            otro = Usuario(
+                nombre_usuario=generar_usuario_unico(),
+                correo=generar_email_unico(),
+                contraseña_hash=generate_password_hash("pass"),
+                fecha_nacimiento=date(1992, 5, 10),
+                verificado=True
+            )
+            db.session.add(otro)
+            db.session.commit()
+            solicitud = Amistad(usuario_id=otro.id, amigo_id=usuario_prueba.id, estado='pendiente')
+            db.session.add(solicitud)
+            db.session.commit()
+            otro_id, solicitud_id = otro.id, solicitud.id
+
+        r = auth_client.post('/gestionar_solicitud', json={'solicitud_id': solicitud_id, 'accion': 'aceptar'})
+        assert json.loads(r.data)['galardones_nuevos'] == [{'nombre': 'Buena compañía', 'nivel': 1}]
+        with app.app_context():
+            assert son_amigos(usuario_prueba.id, otro_id) and son_amigos(otro_id, usuario_prueba.id)
+            assert usuario_prueba.id in amigos_ids_de(otro_id)
+
+            aristas = AmistadArista.query.count()
+            assert aristas_amistad_backfill() == aristas
+            assert son_amigos(otro_id, usuario_prueba.id)
+
+        response = auth_client.post('/enviar_solicitud_amistad', json={'amigo_id': otro_id})
+        assert json.loads(response.data)['message'] == "Ya sois amigos"
+
+    def test_ultima_actividad_amigos(self, auth_client, usuario_prueba, setup_database):
+        """Test que la última actividad se mantiene al degustar y aparece en /mis_amigos."""
+        app = auth_client.application
+        with app.app_context():
+            from app import db, Usuario, Cerveza, UltimaActividad, aristas_amistad_crear, ultima_actividad_backfill
+            amigo = Usuario(
+                nombre_usuario=generar_usuario_unico(),
+                correo=generar_email_unico(),
+                contraseña_hash=generate_password_hash("pass"),
+                fecha_nacimiento=date(1992, 5, 10),
+                verificado=True
+            )
+            db.session.add(amigo)
+            db.session.commit()
+            aristas_amistad_crear(usuario_prueba.id, amigo.id)
+            db.session.commit()
+            cervezas = Cerveza.query.order_by(Cerveza.id).limit(2).all()
+            amigo_id = amigo.id
+            cerveza_ids = [c.id for c in cervezas]
+            nombre_ultima = cervezas[1].nombre
+
+        with auth_client.session_transaction() as sesion:
+            sesion['user_id'] = amigo_id
+        for cerveza_id, puntos in zip(cerveza_ids, (3, 5)):
+            auth_client.post('/api/degustacion/nueva', json={'cerveza_id': cerveza_id, 'puntuacion': puntos, 'comentario': 'ok'})
+        with auth_client.session_transaction() as sesion:
+            sesion['user_id'] = usuario_prueba.id
+
+        data = json.loads(auth_client.get('/mis_amigos').data)
+        amigo_data = next(a for a in data['amigos'] if a['id'] == amigo_id)
+        assert amigo_data['actividad_reciente']['cerveza_nombre'] == nombre_ultima
+        assert amigo_data['actividad_reciente']['puntuacion'] == 5
+
+        with app.app_context():
+            antes = db.session.get(UltimaActividad, amigo_id).degustacion_id
+            ultima_actividad_backfill()
+            assert db.session.get(UltimaActividad, amigo_id).degustacion_id == antes
+
+    def test_galardones_incrementales_y_backfill(self, auth_client, usuario_prueba, setup_database):
+        """Test que los eventos suben los contadores y conceden niveles, y que el backfill llega a lo mismo."""
+        app = auth_client.application
+        with app.app_context():
+            from app import db, Usuario, Cerveza, Amistad, ProgresoGalardon, galardones_backfill
+            ids = {c.nombre: c.id for c in Cerveza.query.filter(Cerveza.nombre.in_(["Cruzcampo", "IPA Test", "Galeton"]))}
+            otro = Usuario(
+                nombre_usuario=generar_usuario_unico(),
+                correo=generar_email_unico(),
+                contraseña_hash=generate_password_hash("pass"),
+                fecha_nacimiento=date(1992, 5, 10),
+                verificado=True
+            )
+            db.session.add(otro)
+            db.session.commit()
+            solicitud = Amistad(usuario_id=otro.id, amigo_id=usuario_prueba.id, estado='pendiente')
+            db.session.add(solicitud)
+            db.session.commit()
+            otro_id, solicitud_id = otro.id, solicitud.id
+
+        nuevos = []
+        for nombre in ["Cruzcampo", "Cruzcampo", "IPA Test", "Galeton"]:
+            r = auth_client.post('/api/degustacion/nueva', json={'cerveza_id': ids[nombre], 'puntuacion': 4})
+            nuevos.append(json.loads(r.data)['galardones_nuevos'])
+        assert nuevos[0] == [{'nombre': 'Catador', 'nivel': 1}]
+        assert nuevos[1] == nuevos[2] == []
+        assert nuevos[3] == [{'nombre': 'Explorador de estilos', 'nivel': 1}]
+
+        degustacion_id = json.loads(auth_client.post('/api/degustacion/nueva', json={'cerveza_id': ids["Galeton"]}).data)['degustacion_id']
+        r = auth_client.post('/comentar_degustacion', json={'degustacion_id': degustacion_id, 'texto': '¡Qué buena!'})
+        assert json.loads(r.data)['galardones_nuevos'] == [{'nombre': 'Conversador', 'nivel': 1}]
+        r = auth_client.post('/gestionar_solicitud', json={'solicitud_id': solicitud_id, 'accion': 'aceptar'})
+        assert json.loads(r.data)['galardones_nuevos'] == [{'nombre': 'Buena compañía', 'nivel': 1}]
+
+        with app.app_context():
+            def contadores(usuario_id):
+                return dict(db.session.query(ProgresoGalardon.metrica, ProgresoGalardon.valor).filter_by(usuario_id=usuario_id))
+            esperado = {'degustaciones': 5, 'estilos': 3, 'paises': 1, 'comentarios': 1, 'amigos': 1}
+            assert contadores(usuario_prueba.id) == esperado
+            assert contadores(otro_id) == {'amigos': 1}
+            # Repetir un distinto ya contado o un nivel ya concedido no suma ni falla
+            from app import galardones_progresar, galardones_conceder
+            assert galardones_progresar(usuario_prueba.id, 'estilos', distinto='Lager') == []
+            assert galardones_conceder(usuario_prueba.id, 'degustaciones', 5) == []
+            db.session.commit()
+            assert contadores(usuario_prueba.id) == esperado
+            # Recalcular desde el historial, por lotes de un usuario, da los mismos contadores
+            assert galardones_backfill(lote=1, desde_id=usuario_prueba.id - 1) >= 2
+            assert contadores(usuario_prueba.id) == esperado
+
+        pagina = auth_client.get('/galardones').data.decode()
+        assert 'Catador' in pagina and '5 / 10' in pagina and 'Buena compañía' in pagina
+
+    def test_buscar_usuarios_indexado_con_estados(self, auth_client, usuario_prueba, setup_database):
+        """Test que la búsqueda de usuarios usa prefijos, correo exacto y resuelve estados de amistad."""
+        with auth_client.application.app_context():
+            from app import db, Usuario, Amistad
+            sufijo = generar_usuario_unico().split('_')[1]
+            correos = [generar_email_unico() for _ in range(3)]
+            otros = [
+                Usuario(
+                    nombre_usuario=f"catador{n}_{sufijo}",
+                    correo=correos[n],
+                    contraseña_hash=generate_password_hash("pass"),
+                    fecha_nacimiento=date(1992, 5, 10),
+                    verificado=True
+                ) for n in range(3)
+            ]
+            db.session.add_all(otros)
+            db.session.commit()
+            db.session.add_all([
+                Amistad(usuario_id=usuario_prueba.id, amigo_id=otros[0].id, estado='pendiente'),
+                Amistad(usuario_id=otros[1].id, amigo_id=usuario_prueba.id, estado='aceptado'),
+            ])
+            db.session.commit()
+            ids = [u.id for u in otros]
+
+        data = json.loads(auth_client.get(f'/buscar_usuarios?q={sufijo}').data)
+        estados = {u['id']: u['estado_amistad'] for u in data['usuarios']}
+        assert estados == {ids[0]: 'solicitud_enviada', ids[1]: 'amigos', ids[2]: None}
+
+        data = json.loads(auth_client.get(f'/buscar_usuarios?q={correos[2]}').data)
+        assert [u['id'] for u in data['usuarios']] == [ids[2]]
+
+        data = json.loads(auth_client.get(f'/buscar_usuarios?q={correos[2].upper()}').data)
+        assert [u['id'] for u in data['usuarios']] == [ids[2]]
+
+        data = json.loads(auth_client.get(f'/buscar_usuarios?q={correos[2][3:]}').data)
+        assert data['usuarios'] == []
+
+    def test_correo_encolado_y_reintentado(self, client, servidor_smtp, setup_database):
+        """Test que el registro solo encola el correo y el enviador lo entrega con reintentos."""
+        from app import db, CorreoPendiente, enviador_correo
+        with client.application.app_context():
+            while enviador_correo.procesar():  # correos que hayan dejado otras pruebas
+                pass
+        servidor_smtp.mensajes.clear()
+        correo = generar_email_unico()
+        response = client.post('/registro', data={
+            'nombre_usuario': generar_usuario_unico(), 'correo': correo,
+            'contraseña': 'clave123', 'contraseña2': 'clave123', 'fecha_nacimiento': '1990-01-01'
+        })
+        assert response.status_code == 302
+        assert servidor_smtp.mensajes == []
+
+        with client.application.app_context():
+            pendiente = CorreoPendiente.query.filter_by(destinatario=correo).one()
+            assert pendiente.estado == 'pendiente'
+
+            # Primer intento rechazado por el servidor: se reprograma más tarde
+            servidor_smtp.rechazar = 1
+            enviador_correo.procesar()
+            db.session.refresh(pendiente)
+            assert (pendiente.estado, pendiente.intentos) == ('pendiente', 1)
+            assert enviador_correo.procesar() == 0
+
+            # Al vencer la espera se reintenta y se entrega
+            pendiente.proximo_intento = datetime.now(timezone.utc) - timedelta(seconds=1)
+            db.session.commit()
+            enviador_correo.procesar()
+            db.session.refresh(pendiente)
+            assert (pendiente.estado, pendiente.intentos) == ('enviado', 2)
+
+        assert [m['para'] for m in servidor_smtp.mensajes] == [[correo]]
+        assert '/verificar/' in servidor_smtp.mensajes[0]['mensaje'].get_content()
+
+        with client.session_transaction() as session:
+            session['user_id'] = 1
+        metricas = json.loads(client.get('/api/correo/metricas').data)
+        assert metricas['enviados'] >= 1 and metricas['reintentos'] >= 1
+        assert metricas['cola']['pendiente'] == 0
+
+    def test_correos_de_un_lote_comparten_conexion(self, client, servidor_smtp, setup_database):
+        """Test que un lote de correos se envía por una única conexión SMTP."""
+        from app import encolar_correo, enviador_correo
+        with client.application.app_context():
+            for i in range(3):
+                encolar_correo(generar_email_unico(), f"Asunto {i}", "Cuerpo")
+            assert enviador_correo.procesar() == 3
+        assert len(servidor_smtp.mensajes) == 3
+        assert servidor_smtp.conexiones == 1
+
+    def test_login_actualiza_hash_antiguo(self, client, setup_database):
+        """Test que un login correcto vuelve a calcular el hash con el método configurado."""
+        from app import db, Usuario, hash_contraseñas
+        nombre = generar_usuario_unico()
+        with client.application.app_context():
+            usuario = Usuario(
+                nombre_usuario=nombre,
+                correo=generar_email_unico(),
+                contraseña_hash=generate_password_hash("clave_antigua", 'pbkdf2:sha256:1000'),
+                fecha_nacimiento=date(1990, 1, 1),
+                verificado=True
+            )
+            db.session.add(usuario)
+            db.session.commit()
+            usuario_id = usuario.id
+
+        response = client.post('/login', data={'nombre_usuario': nombre, 'contraseña': 'clave_antigua'})
+        assert response.status_code == 302
+
+        with client.application.app_context():
+            nuevo_hash = db.session.get(Usuario, usuario_id).contraseña_hash
+            assert nuevo_hash.startswith(hash_contraseñas.metodo + '$')
+            assert hash_contraseñas.verificar(nuevo_hash, 'clave_antigua')
+
+    def test_foto_perfil_variantes_deduplicadas(self, auth_client, usuario_prueba, setup_database, tmp_path, monkeypatch):
+        """Test que una foto subida se guarda como variantes pequeñas, sin EXIF y con nombre por contenido."""
+        Image = pytest.importorskip('PIL.Image')
+        import io
+        import os
+        import app as modulo_app
+        monkeypatch.setattr(modulo_app, 'static_fotos_dir', str(tmp_path))
+
+        imagen = Image.effect_noise((1600, 1200), 64).convert('RGB')
+        exif = Image.Exif()
+        exif[0x010F] = "CamaraDePrueba"  # Make
+        original = io.BytesIO()
+        imagen.save(original, 'JPEG', quality=95, exif=exif)
+        datos = original.getvalue()
+
+        def subir():
+            return auth_client.post('/perfil/editar', data={
+                'nombre_usuario': usuario_prueba.nombre_usuario,
+                'foto': (io.BytesIO(datos), 'foto.jpg'),
+            }, content_type='multipart/form-data')
+
+        assert subir().status_code == 302
+        with auth_client.application.app_context():
+            from app import db, Usuario, foto_variante
+            foto = db.session.get(Usuario, usuario_prueba.id).foto
+            avatar = tmp_path / foto_variante(foto, 'avatar')
+            assert Image.open(avatar).size == (96, 96)
+            assert Image.open(tmp_path / foto_variante(foto, 'completa')).size == (800, 600)
+            assert avatar.stat().st_size * 10 < len(datos)
+            assert b"CamaraDePrueba" not in avatar.read_bytes()
+
+        # El JSON apunta a la variante adecuada para el tamaño mostrado
+        data = json.loads(auth_client.get(f'/perfil/{usuario_prueba.id}/info').data)
+        assert data['usuario']['foto'] == foto_variante(foto, 'tarjeta')
+
+        # La misma imagen otra vez no genera ficheros nuevos
+        ficheros = sorted(os.listdir(tmp_path))
+        assert subir().status_code == 302
+        assert sorted(os.listdir(tmp_path)) == ficheros
+        assert len(ficheros) == 3
+
+        # Un archivo que no es imagen se rechaza
+        response = auth_client.post('/perfil/editar', data={
+            'nombre_usuario': usuario_prueba.nombre_usuario,
+            'foto': (io.BytesIO(b"no soy una imagen"), 'foto.png'),
+        }, content_type='multipart/form-data')
+        assert "no es una imagen válida" in response.get_data(as_text=True)
+
+    def test_fotos_cacheables_y_limpieza(self, auth_client, usuario_prueba, setup_database, tmp_path, monkeypatch):
+        """Test que las fotos se sirven inmutables con ETag, 304 y Range, y que al cambiarlas se borran las viejas."""
+        Image = pytest.importorskip('PIL.Image')
+        import io
+        import app as modulo_app
+        monkeypatch.setattr(modulo_app, 'static_fotos_dir', str(tmp_path))
+
+        def subir(color):
+            datos = io.BytesIO()
+            Image.new('RGB', (300, 200), color).save(datos, 'PNG')
+            datos.seek(0)
+            auth_client.post('/perfil/editar', data={
+                'nombre_usuario': usuario_prueba.nombre_usuario, 'foto': (datos, 'foto.png'),
+            }, content_type='multipart/form-data')
+            with auth_client.application.app_context():
+                from app import db, Usuario
+                return db.session.get(Usuario, usuario_prueba.id).foto
+
+        foto = subir('red')
+        with auth_client.application.test_request_context():
+            url = modulo_app.foto_url(foto, 'tarjeta')
+        response = auth_client.get(url)
+        assert response.status_code == 200
+        assert response.cache_control.immutable and response.cache_control.max_age == modulo_app.FOTO_CACHE_SEGUNDOS
+        etag = response.headers['ETag']
+        assert not etag.startswith('W/')
+
+        assert auth_client.get(url, headers={'If-None-Match': etag}).status_code == 304
+        parcial = auth_client.get(url, headers={'Range': 'bytes=0-9'})
+        assert parcial.status_code == 206 and len(parcial.data) == 10
+
+        # Otro usuario con la misma foto la conserva aunque el primero la cambie
+        with auth_client.application.app_context():
+            from app import db, Usuario
+            otro = Usuario(nombre_usuario=generar_usuario_unico(), correo=generar_email_unico(),
+                           contraseña_hash="x", fecha_nacimiento=date(1990, 1, 1), foto=foto)
+            db.session.add(otro)
+            db.session.commit()
+        azul = subir('blue')
+        assert all((tmp_path / f).exists() for f in modulo_app.foto_ficheros(foto))
+
+        # Una foto que solo usaba este usuario desaparece al sustituirla
+        verde = subir('green')
+        assert not any((tmp_path / f).exists() for f in modulo_app.foto_ficheros(azul))
+        assert all((tmp_path / f).exists() for f in modulo_app.foto_ficheros(verde))
+
+    def test_foto_reutilizada_borrada_antes_del_commit(self, auth_client, usuario_prueba, setup_database, tmp_path, monkeypatch):
+        """Test que si otro usuario borra las variantes reutilizadas antes del commit, se regeneran."""
+        Image = pytest.importorskip('PIL.Image')
+        import io
+        import app as modulo_app
+        monkeypatch.setattr(modulo_app, 'static_fotos_dir', str(tmp_path))
+        procesar_foto, llamadas = modulo_app.procesar_foto, []
+
+        def procesar_y_perder_la_carrera(datos):
+            nombre = procesar_foto(datos)
+            if not llamadas:
+                # Otro usuario cambia esta misma foto y, como nadie la tiene guardada aún, la borra
+                modulo_app.foto_borrar(nombre)
+            llamadas.append(nombre)
+            return nombre
+
+        monkeypatch.setattr(modulo_app, 'procesar_foto', procesar_y_perder_la_carrera)
+        datos = io.BytesIO()
+        Image.new('RGB', (300, 200), 'purple').save(datos, 'PNG')
+        datos.seek(0)
+        auth_client.post('/perfil/editar', data={
+            'nombre_usuario': usuario_prueba.nombre_usuario, 'foto': (datos, 'foto.png'),
+        }, content_type='multipart/form-data')
+        with auth_client.application.app_context():
+            from app import db, Usuario
+            foto = db.session.get(Usuario, usuario_prueba.id).foto
+        assert foto == llamadas[0]
+        assert all((tmp_path / f).exists() for f in modulo_app.foto_ficheros(foto))
+        assert not list(tmp_path.glob('*.borrando'))
+
+    def test_borrado_cuenta_en_segundo_plano(self, auth_client, usuario_prueba, setup_database, tmp_path, monkeypatch):
+        """Test que la cuenta eliminada se oculta al momento y su borrado por lotes se retoma tras una caída."""
+        import app as modulo_app
+        from app import (db, Usuario, Cerveza, CervezaStats, Degustacion, ComentarioDegustacion, Favorita,
+                         Amistad, AmistadArista, UltimaActividad, UsuarioGalardon, ProgresoGalardon,
+                         ProgresoDistinto, TimelineEntrada, BorradoCuenta, borrador_cuentas,
+                         aristas_amistad_crear, galardones_progresar)
+        monkeypatch.setattr(modulo_app, 'static_fotos_dir', str(tmp_path))
+        monkeypatch.setitem(modulo_app.app.config, 'TIMELINE_ENABLED', True)
+        with auth_client.application.app_context():
+            while borrador_cuentas.procesar():  # borrados que hayan dejado otras pruebas
+                pass
+        victima_id = usuario_prueba.id
+        foto = 'f' * 20 + '.webp'
+        for nombre in modulo_app.foto_ficheros(foto):
+            (tmp_path / nombre).write_bytes(b'x')
+
+        with auth_client.application.app_context():
+            amigo, desconocido = [Usuario(nombre_usuario=generar_usuario_unico(), correo=generar_email_unico(),
+                                          contraseña_hash="x", fecha_nacimiento=date(1990, 1, 1), verificado=True)
+                                  for _ in range(2)]
+            db.session.add_all([amigo, desconocido])
+            db.session.commit()
+            amigo_id = amigo.id
+            db.session.get(Usuario, victima_id).foto = foto
+            db.session.add(Amistad(usuario_id=victima_id, amigo_id=amigo_id, estado='aceptado'))
+            db.session.add(Amistad(usuario_id=victima_id, amigo_id=desconocido.id, estado='pendiente'))
+            aristas_amistad_crear(victima_id, amigo_id)
+            galardones_progresar(victima_id, 'amigos')
+            galardones_progresar(amigo_id, 'amigos')
+            cerveza = Cerveza.query.filter_by(nombre='Galeton').first()
+            cerveza_id = cerveza.id
+            de_amigo = Degustacion(usuario_id=amigo_id, cerveza_id=cerveza_id, puntuacion=2.0)
+            db.session.add(de_amigo)
+            db.session.commit()
+            de_amigo_id = de_amigo.id
+
+        for puntuacion in (5.0, 4.5, 4.0):
+            assert auth_client.post('/api/degustacion/nueva', json={'cerveza_id': cerveza_id, 'puntuacion': puntuacion}).status_code == 200
+        auth_client.post('/toggle_favorita', json={'cerveza_id': cerveza_id})
+        auth_client.post('/comentar_degustacion', json={'degustacion_id': de_amigo_id, 'texto': 'Mía en la tuya'})
+        with auth_client.application.app_context():
+            de_victima_id = Degustacion.query.filter_by(usuario_id=victima_id).first().id
+            for texto in ('Tuya en la mía', 'Y otra'):
+                db.session.add(ComentarioDegustacion(degustacion_id=de_victima_id, usuario_id=amigo_id, texto=texto))
+                galardones_progresar(amigo_id, 'comentarios')
+            db.session.commit()
+            assert TimelineEntrada.query.filter_by(autor_id=victima_id).count() == 3
+
+        assert auth_client.post('/eliminar_cuenta', data={'confirmar': 'si'}).status_code == 302
+        with auth_client.application.app_context():
+            borrado = BorradoCuenta.query.filter_by(usuario_id=victima_id).one()
+            assert borrado.estado == 'pendiente'
+            assert db.session.get(Usuario, victima_id).eliminado_en is not None
+
+        # Desaparece al momento para los demás, y sus otras sesiones dejan de valer
+        with auth_client.session_transaction() as sesion:
+            sesion['user_id'] = victima_id
+        assert auth_client.get('/inicio').status_code == 302
+        with auth_client.session_transaction() as sesion:
+            sesion['user_id'] = amigo_id
+        assert auth_client.get('/mis_amigos').get_json()['amigos'] == []
+        assert auth_client.get('/actividades_amigos').get_json()['actividades'] == []
+        assert auth_client.get(f'/buscar_usuarios?q={usuario_prueba.nombre_usuario}').get_json()['usuarios'] == []
+        assert auth_client.get(f'/perfil/{victima_id}/info').status_code == 404
+        assert auth_client.post('/comentar_degustacion', json={'degustacion_id': de_victima_id, 'texto': '¿Hola?'}).status_code == 404
+        assert "Mía en la tuya" not in auth_client.get('/mis_degustaciones').get_data(as_text=True)
+
+        # El nombre y el correo quedan libres para registrarse de nuevo sin esperar al borrado
+        respuesta = auth_client.post('/registro', data={
+            'nombre_usuario': usuario_prueba.nombre_usuario, 'correo': usuario_prueba.correo,
+            'contraseña': 'password123', 'contraseña2': 'password123', 'fecha_nacimiento': '1990-01-01',
+        })
+        assert respuesta.status_code == 302
+        with auth_client.application.app_context():
+            nueva = Usuario.query.filter_by(correo=usuario_prueba.correo).one()
+            assert nueva.id != victima_id and nueva.nombre_usuario == usuario_prueba.nombre_usuario
+
+        # El proceso muere a mitad de las degustaciones: lo ya borrado queda confirmado y reservado
+        class Caida(BaseException):
+            pass
+        recalcular = modulo_app.cerveza_stats_recalcular
+        llamadas = []
+        def recalcular_y_caer(cerveza_ids=None):
+            llamadas.append(cerveza_ids)
+            if len(llamadas) == 2:
+                raise Caida()
+            recalcular(cerveza_ids)
+        monkeypatch.setattr(modulo_app, 'cerveza_stats_recalcular', recalcular_y_caer)
+        with auth_client.application.app_context():
+            with pytest.raises(Caida):
+                borrador_cuentas.procesar(lote=1)
+            db.session.rollback()
+            borrado = BorradoCuenta.query.filter_by(usuario_id=victima_id).one()
+            assert (borrado.estado, borrado.fase) == ('borrando', 'degustaciones')
+            assert Degustacion.query.filter_by(usuario_id=victima_id).count() == 2
+            assert ComentarioDegustacion.query.filter_by(usuario_id=victima_id).count() == 0
+            assert AmistadArista.query.filter_by(amigo_id=victima_id).count() == 0
+            # Mientras dure la reserva nadie más lo toca; al vencer, se retoma en su fase
+            assert borrador_cuentas.procesar() is None
+            borrado.reservado_hasta = datetime.now(timezone.utc) - timedelta(seconds=1)
+            db.session.commit()
+            monkeypatch.setattr(modulo_app, 'cerveza_stats_recalcular', recalcular)
+            assert borrador_cuentas.procesar(lote=1).estado == 'terminado'
+
+            db.session.expire_all()
+            assert db.session.get(Usuario, victima_id) is None
+            for modelo in (Degustacion, Favorita, UltimaActividad, UsuarioGalardon, ProgresoGalardon, ProgresoDistinto):
+                assert modelo.query.filter_by(usuario_id=victima_id).count() == 0, modelo.__name__
+            assert Amistad.query.filter((Amistad.usuario_id == victima_id) | (Amistad.amigo_id == victima_id)).count() == 0
+            assert TimelineEntrada.query.filter((TimelineEntrada.usuario_id == victima_id) | (TimelineEntrada.autor_id == victima_id)).count() == 0
+            assert ComentarioDegustacion.query.filter((ComentarioDegustacion.usuario_id == victima_id)
+                                                      | (ComentarioDegustacion.degustacion_id == de_victima_id)).count() == 0
+            assert db.session.get(ProgresoGalardon, (amigo_id, 'amigos')).valor == 0
+            assert db.session.get(ProgresoGalardon, (amigo_id, 'comentarios')).valor == 0
+            # Los agregados de la cerveza se recalculan sin las degustaciones borradas
+            assert db.session.get(CervezaStats, cerveza_id).num_valoraciones == Degustacion.query.filter(
+                Degustacion.cerveza_id == cerveza_id, Degustacion.puntuacion.isnot(None)).count()
+            assert not any(tmp_path.iterdir())
+            borrado = BorradoCuenta.query.filter_by(usuario_id=victima_id).one()
+            assert borrado.filas_borradas >= 12 and borrado.fecha_fin is not None
@@ -1,6 +1,6 @@
 import pytest
 from datetime import date, datetime
-from app import es_mayor_edad, allowed_file # Asegúrate de importar las funciones desde app.py
+from app import es_mayor_edad, allowed_file, codificar_cursor, decodificar_cursor, CacheLRU, IndiceAutocompletado, MuestreoCervezas, ServicioHash, ServicioHashOcupado, geohash_codificar, geohash_celdas, caja_radio, distancia_km # Asegúrate de importar las funciones desde app.py
 from werkzeug.security import generate_password_hash, check_password_hash
 
 class TestFuncionesUtiles:
@@ -54,4 +54,178 @@ class TestFuncionesUtiles:
         hash_result = generate_password_hash(password)
         assert check_password_hash(hash_result, password) is True
         assert check_password_hash(hash_result, "otra_contrasena") is False
-        assert hash_result != password
\ No newline at end of file
+        assert hash_result != password
+
+    def test_servicio_hash_en_pool_de_procesos(self):
+        """Test que el pool calcula hashes verificables y detecta los de otro factor de trabajo."""
+        servicio = ServicioHash('pbkdf2:sha256:1000', procesos=1, cola_max=4, espera=1)
+        try:
+            hash_result = servicio.generar("clave")
+            assert hash_result.startswith('pbkdf2:sha256:1000$')
+            assert servicio.verificar(hash_result, "clave") is True
+            assert servicio.verificar(hash_result, "otra") is False
+        finally:
+            servicio.cerrar()
+        assert servicio.necesita_rehash(hash_result) is False
+        assert servicio.necesita_rehash(generate_password_hash("clave", 'pbkdf2:sha256:2000')) is True
+
+    def test_servicio_hash_metodo_parcial(self):
+        """Test que un método sin factor de trabajo no obliga a recalcular el hash en cada login."""
+        servicio = ServicioHash('scrypt', procesos=0, cola_max=1, espera=1)
+        hash_result = servicio.generar("clave")
+        assert hash_result.startswith('scrypt:32768:8:1$')
+        assert servicio.necesita_rehash(hash_result) is False
+        assert servicio.necesita_rehash(generate_password_hash("clave", 'pbkdf2:sha256:1000')) is True
+
+    def test_servicio_hash_cola_acotada(self):
+        """Test que sin plazas libres en la cola se rechaza en vez de esperar indefinidamente."""
+        servicio = ServicioHash('pbkdf2:sha256:1000', procesos=0, cola_max=1, espera=0.01)
+        servicio._plazas.acquire()  # la única plaza está ocupada por otro hash en curso
+        with pytest.raises(ServicioHashOcupado):
+            servicio.generar("clave")
+        servicio._plazas.release()
+        assert servicio.verificar(servicio.generar("clave"), "clave") is True
+        assert servicio.metricas['rechazados'] == 1
+
+    def test_cursor_ida_y_vuelta(self):
+        """Test que un cursor codificado se decodifica en la misma (fecha, id)."""
+        fecha = datetime(2025, 3, 14, 18, 30, 5, 123456)
+        cursor = codificar_cursor(fecha, 42)
+        assert '|' not in cursor
+        assert decodificar_cursor(cursor) == (fecha, 42)
+
+    def test_cursor_invalido(self):
+        """Test que un cursor manipulado se rechaza."""
+        assert decodificar_cursor("no-es-un-cursor") is None
+        assert decodificar_cursor("") is None
+
+    def test_geohash_y_celdas(self):
+        """Test que el geohash es el estándar y que las celdas de una caja cubren sus puntos."""
+        assert geohash_codificar(57.64911, 10.40744) == 'u4pruydqq'
+        assert geohash_codificar(57.64911, 10.40744, precision=4) == 'u4pr'
+        celdas = geohash_celdas(40.35, -3.8, 40.45, -3.6)
+        assert len(celdas) <= 32
+        assert any(geohash_codificar(40.4169, -3.7035).startswith(c) for c in celdas)
+        # Una caja que cruza el antimeridiano incluye celdas de ambos lados
+        celdas = geohash_celdas(-20, 179, -15, -179)
+        assert any(geohash_codificar(-17.8, 179.9).startswith(c) for c in celdas)
+        assert any(geohash_codificar(-17.8, -179.9).startswith(c) for c in celdas)
+
+    def test_caja_radio_contiene_el_circulo(self):
+        """Test que la caja de un radio contiene los puntos a esa distancia y envuelve el antimeridiano."""
+        sur, oeste, norte, este = caja_radio(40.4168, -3.7038, 10)
+        assert sur < 40.4168 < norte and oeste < -3.7038 < este
+        assert 9.9 < distancia_km(sur, -3.7038, 40.4168, -3.7038) < 10.1
+        sur, oeste, norte, este = caja_radio(0, 179.99, 10)
+        assert oeste > este
+
+    def test_cache_lru_expulsa_la_menos_usada(self):
+        """Test que la caché respeta su tamaño máximo y expulsa la entrada menos usada."""
+        cache = CacheLRU(2)
+        cache.guardar('a', 1)
+        cache.guardar('b', 2)
+        assert cache.obtener('a') == 1
+        cache.guardar('c', 3)
+        assert cache.obtener('b') is None
+        assert cache.obtener('c') == 3
+        stats = cache.estadisticas()
+        assert (stats['entradas'], stats['aciertos'], stats['fallos'], stats['expulsiones']) == (2, 2, 1, 1)
+        cache.invalidar()
+        assert cache.obtener('a') is None
+
+    def test_cache_lru_descarta_valores_calculados_antes_de_invalidar(self):
+        """Test que un valor calculado antes de una invalidación no se guarda."""
+        cache = CacheLRU(2)
+        generacion = cache.generacion
+        cache.invalidar()  # una escritura llega mientras se calculaba
+        cache.guardar('a', 'viejo', generacion)
+        assert cache.obtener('a') is None
+        cache.guardar('a', 'nuevo', cache.generacion)
+        assert cache.obtener('a') == 'nuevo'
+        assert cache.estadisticas()['descartes'] == 1
+
+    def test_autocompletado_tolera_erratas(self):
+        """Test que el índice de trigramas encuentra nombres con erratas, tildes y prefijos."""
+        indice = IndiceAutocompletado()
+        indice.construir([(1, "Estrella Galicia"), (2, "Estrella Damm"), (3, "Ahó!"), (4, "Galeton")])
+        assert indice.sugerir("estrela galcia")[0] == (1, "Estrella Galicia")
+        assert indice.sugerir("aho") == [(3, "Ahó!")]
+        assert [i for i, _ in indice.sugerir("estrella")] == [2, 1]
+        assert indice.sugerir("zzzz") == []
+        indice.añadir(5, "Estrella de Levante")
+        assert 5 in [i for i, _ in indice.sugerir("estrella de lev")]
+
+    def test_autocompletado_reconstruir_con_consultas_y_altas_concurrentes(self):
+        """Test que reconstruir no cambia el cerrojo ni deja a las consultas con listas mezcladas."""
+        import threading
+        indice = IndiceAutocompletado()
+        cerrojo = indice._lock
+        catalogo = [(i, f"Cerveza {i}") for i in range(1, 2001)]
+        indice.construir(catalogo)
+        errores, fin = [], threading.Event()
+
+        def consultar():
+            while not fin.is_set():
+                try:
+                    for cerveza_id, nombre in indice.sugerir("cerveza 1"):
+                        assert nombre == f"Cerveza {cerveza_id}"
+                except Exception as error:
+                    errores.append(error)
+
+        lectores = [threading.Thread(target=consultar) for _ in range(4)]
+        for lector in lectores:
+            lector.start()
+        for ronda in range(20):
+            indice.construir(catalogo[ronda * 50:])
+            indice.añadir(5000 + ronda, f"Cerveza {5000 + ronda}")
+        fin.set()
+        for lector in lectores:
+            lector.join()
+        assert errores == []
+        assert indice._lock is cerrojo
+        assert indice.sugerir("cerveza 5019")[0] == (5019, "Cerveza 5019")
+
+    def test_muestreo_cervezas_sin_repetidos_y_ponderado(self):
+        """Test que la muestra no repite IDs y favorece a las cervezas populares."""
+        muestreo = MuestreoCervezas()
+        muestreo.construir([(1, 0), (2, 0), (3, 998)])
+        for _ in range(20):
+            muestra = muestreo.muestra(3)
+            assert sorted(muestra) == [1, 2, 3]
+        primeras = [muestreo.muestra(1)[0] for _ in range(200)]
+        assert primeras.count(3) > 150
+        muestreo.construir([(1, 0), (2, 0), (3, 998), (4, 0)])
+        assert sorted(muestreo.muestra(10, ponderada=False)) == [1, 2, 3, 4]
+
+    def test_muestreo_cervezas_refresca_en_un_solo_hilo(self):
+        """Test que solo un hilo reconstruye la reserva y que mientras tanto se muestrea la anterior."""
+        import threading
+        muestreo = MuestreoCervezas()
+        muestreo.construir([(1, 0), (2, 0)])
+        muestreo.invalidar()
+        assert muestreo.caducado(600)
+        puede_seguir, llamadas = threading.Event(), []
+
+        def cargar():
+            llamadas.append(1)
+            puede_seguir.wait(5)
+            return [(1, 0), (2, 0), (3, 0)]
+
+        assert muestreo.refrescar(cargar) is True
+        assert muestreo.refrescar(cargar) is False
+        assert sorted(muestreo.muestra(10)) == [1, 2]
+        puede_seguir.set()
+        muestreo._reconstruyendo.acquire(timeout=5)
+        muestreo._reconstruyendo.release()
+        assert llamadas == [1]
+        assert sorted(muestreo.muestra(10)) == [1, 2, 3]
+        assert not muestreo.caducado(600)
+
+    def test_muestreo_cervezas_alta_durante_el_refresco_sigue_caducada(self):
+        """Test que una alta mientras se leían las filas deja la reserva pendiente de otra vuelta."""
+        muestreo = MuestreoCervezas()
+        generacion = muestreo.generacion
+        muestreo.invalidar()
+        muestreo.construir([(1, 0)], generacion)
+        assert muestreo.muestra(1) == [1]
+        assert muestreo.caducado(600)
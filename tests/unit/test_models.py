@@ -2,7 +2,7 @@ import pytest
 from datetime import date
 from app import db, Usuario, Cerveza, Degustacion, Amistad, Galardon, UsuarioGalardon, Favorita
 from werkzeug.security import generate_password_hash
-from tests.conftest import generar_usuario_unico, generar_email_unico # Importa helpers
+from tests.conftest import generar_usuario_unico, generar_email_unico, solo_sqlite # Importa helpers
 
 class TestModelosUsuario:
     """Pruebas unitarias para el modelo Usuario."""
@@ -220,3 +220,105 @@ class TestModelosRelaciones:
             # assert cerveza.id in favoritas_ids
             # O
             assert any(f.cerveza_id == cerveza.id for f in usuario.favoritas) # Esta es más robusta
+
+
+class TestMigraciones:
+    """Pruebas del sistema de migraciones de esquema."""
+
+    def test_migraciones_registradas_y_sin_indices_faltantes(self, client, setup_database):
+        """Todas las migraciones quedan registradas y no falta ningún índice declarado."""
+        from app import MIGRACIONES, MigracionAplicada, indices_faltantes
+        with client.application.app_context():
+            aplicadas = {m.version for m in MigracionAplicada.query.all()}
+            assert aplicadas == {version for version, _, _ in MIGRACIONES}
+            assert indices_faltantes() == []
+
+    def test_migracion_recrea_indices_borrados(self, client, setup_database):
+        """Una base de datos sin los índices los recupera al volver a migrar, sin perder filas."""
+        from app import MigracionAplicada, borrar_indice, indices_faltantes, migrar
+        with client.application.app_context():
+            degustaciones = Degustacion.query.count()
+            borrar_indice('ix_degustacion_usuario_fecha')
+            db.session.query(MigracionAplicada).filter_by(version=4).delete()
+            db.session.commit()
+            assert 'degustacion.ix_degustacion_usuario_fecha' in indices_faltantes()
+
+            assert migrar() == [4]
+            assert indices_faltantes() == []
+            assert Degustacion.query.count() == degustaciones
+
+    @solo_sqlite
+    def test_migrar_espera_al_otro_proceso(self, client, setup_database):
+        """Si otro proceso aplica la misma migración, migrar() espera su cerrojo y no la repite."""
+        import threading
+        from app import MigracionAplicada, migrar
+        app = client.application
+        with app.app_context():
+            db.session.query(MigracionAplicada).filter_by(version=4).delete()
+            db.session.commit()
+        resultado = []
+
+        def otro_worker():
+            with app.app_context():
+                resultado.append(migrar())
+
+        with db.engine.connect() as otro:
+            otro.exec_driver_sql('BEGIN IMMEDIATE')
+            hilo = threading.Thread(target=otro_worker)
+            hilo.start()
+            hilo.join(0.3)
+            otro.exec_driver_sql("INSERT INTO migracion_aplicada (version, descripcion, fecha_aplicada) "
+                                 "VALUES (4, 'otro proceso', CURRENT_TIMESTAMP)")
+            otro.exec_driver_sql('COMMIT')
+        hilo.join()
+        assert resultado == [[]]
+
+    def test_migracion_nombre_normalizado_con_duplicados(self, client, setup_database):
+        """Una base de datos anterior a la clave de duplicados se actualiza aunque tenga nombres repetidos."""
+        from app import MigracionAplicada, borrar_indice, indices_faltantes, migrar
+        with client.application.app_context():
+            # Estado de antes de la migración 8: sin índice y sin claves calculadas
+            borrar_indice('ix_cerveza_nombre_normalizado')
+            db.session.execute(db.update(Cerveza).values(nombre_normalizado=None))
+            ids = [db.session.execute(db.insert(Cerveza).values(
+                nombre=nombre, estilo="Lager", pais_procedencia="España", porcentaje_alcohol=5.5
+            )).inserted_primary_key[0] for nombre in ("Cervecería Duplicada", "CERVECERIA duplicada")]
+            db.session.query(MigracionAplicada).filter(MigracionAplicada.version.in_((8, 11))).delete()
+            db.session.commit()
+
+            assert migrar() == [8, 11]
+            assert indices_faltantes() == []
+            claves = [db.session.get(Cerveza, i).nombre_normalizado for i in ids]
+            assert claves == ["cerveceria duplicada", None]
+
+            Cerveza.query.filter(Cerveza.id.in_(ids)).delete(synchronize_session=False)
+            db.session.commit()
+
+    def test_añadir_y_borrar_columna(self, client, setup_database):
+        """Los helpers de columnas son idempotentes y conservan los datos."""
+        from app import añadir_columna, borrar_columna
+        with client.application.app_context():
+            columnas = lambda: {c['name'] for c in db.inspect(db.session.connection()).get_columns('favorita')}
+            cervezas = Cerveza.query.count()
+            borrar_columna('favorita', 'fecha_agregada')
+            assert 'fecha_agregada' not in columnas()
+            añadir_columna(Favorita, 'fecha_agregada')
+            añadir_columna(Favorita, 'fecha_agregada')
+            db.session.commit()
+            assert 'fecha_agregada' in columnas()
+            assert Cerveza.query.count() == cervezas
+
+
+class TestPerfilSQLite:
+    """Pruebas del perfil de conexión de SQLite."""
+
+    @solo_sqlite
+    def test_pragmas_aplicados_en_cada_conexion(self, client, setup_database):
+        """Las conexiones del pool llevan WAL, synchronous=NORMAL y claves foráneas activas."""
+        from app import pragmas_incorrectos
+        with client.application.app_context():
+            assert pragmas_incorrectos() == {}
+            with db.engine.connect() as conexion:
+                assert conexion.exec_driver_sql('PRAGMA journal_mode').scalar() == 'wal'
+                assert conexion.exec_driver_sql('PRAGMA foreign_keys').scalar() == 1
+                assert conexion.exec_driver_sql('PRAGMA busy_timeout').scalar() == client.application.config['SQLITE_BUSY_TIMEOUT_MS']